@@ -0,0 +1,142 @@
+'''
+This file contains the cluster mode's user placement and routing.
+
+In a cluster, several chat server nodes each own a slice of the users. A username belongs to the
+first node clockwise from its position on a consistent hash ring, where every node is placed at
+CLUSTER_VIRTUAL_NODES points. Adding a node to N others therefore only moves the users that land
+on its points, about 1 / (N + 1) of them, and removing one only moves its own users.
+
+ClusterStub stands in for a ChatServiceStub: calls about one user go to the node that owns them,
+and calls about everybody (online users, user listings, stats, profiling) go to every node and
+are merged. Router.py serves it to clients that only know one address, and nodes use it to
+forward messages to recipients they do not own.
+'''
+
+import bisect
+import hashlib
+import hmac
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+from Constants import CLUSTER_VIRTUAL_NODES
+from PageTokens import encode_users_page_token
+
+# Marks a call one node made to another, so that it is never passed on a second time and is
+# trusted to act for users whose sessions live on other nodes. Its value is the cluster secret
+# every node is started with, so a client cannot pass its own calls off as forwarded
+FORWARDED_METADATA_KEY = "chat-forwarded"
+
+# The user each single-user RPC is about
+ROUTING_KEYS = {
+    "CheckUsername": lambda request: request.username,
+    "CheckPassword": lambda request: request.username,
+    "CreateUser": lambda request: request.username,
+    "ConfirmLogin": lambda request: request.username,
+    "Login": lambda request: request.username,
+    "ConfirmLogout": lambda request: request.username,
+    "Heartbeat": lambda request: request.username,
+    # The sender's node checks their session, then passes the message on to its recipients' owners
+    "SendMessage": lambda request: request.message.sender,
+    "GetMessage": lambda request: request.username,
+    "GetCounts": lambda request: request.username,
+    "SyncMessages": lambda request: request.username,
+    "ConfirmRead": lambda request: request.username,
+    "SearchMessages": lambda request: request.username,
+    "DeleteMessage": lambda request: request.username,
+    "DeleteUser": lambda request: request.username,
+    "SubscribeMessages": lambda request: request.username,
+}
+
+def ring_position(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+def forwarded_metadata(secret):
+    '''Returns the metadata that marks a call as forwarded by a node holding secret'''
+    return ((FORWARDED_METADATA_KEY, secret),)
+
+def is_forwarded(context, secret):
+    '''Returns whether the call behind context was forwarded by another node, i.e. carries the cluster secret'''
+    if context is None or not secret:
+        return False
+    return any(key == FORWARDED_METADATA_KEY and hmac.compare_digest(value.encode(), secret.encode())
+               for key, value in context.invocation_metadata() or ())
+
+class HashRing:
+    def __init__(self, nodes, virtual_nodes=CLUSTER_VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((ring_position(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self.positions = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        '''Returns the node owning key: the one at the first point at or after key's position, wrapping around'''
+        return self.owners[bisect.bisect_left(self.positions, ring_position(key)) % len(self.positions)]
+
+class ClusterStub:
+    '''ChatServiceStub look-alike that sends each call to the node owning its user, or to every node and merges the answers'''
+    def __init__(self, nodes, compression=grpc.Compression.NoCompression):
+        self.ring = HashRing(nodes)
+        self.channels = {node: grpc.insecure_channel(node, compression=compression) for node in self.ring.nodes}
+        self.stubs = {node: chat_pb2_grpc.ChatServiceStub(channel) for node, channel in self.channels.items()}
+
+    def owner(self, username):
+        return self.ring.owner(username)
+
+    def __getattr__(self, name):
+        if name not in ROUTING_KEYS:
+            raise AttributeError(name)
+        key = ROUTING_KEYS[name]
+        def call(request, **kwargs):
+            # Without a user there is no owner to ask, and DeleteMessage would otherwise delete by id on a random node
+            if not key(request) and name != "SubscribeMessages":
+                return getattr(chat_pb2, f"{name}Response")(status=chat_pb2.Status.ERROR)
+            return getattr(self.stubs[self.owner(key(request))], name)(request, **kwargs)
+        return call
+
+    def each(self, name, request, **kwargs):
+        '''Makes the call on every node at once and returns {node: response}'''
+        pending = {node: getattr(stub, name).future(request, **kwargs) for node, stub in self.stubs.items()}
+        return {node: future.result() for node, future in pending.items()}
+
+    def GetOnlineUsers(self, request, **kwargs):
+        responses = self.each("GetOnlineUsers", request, **kwargs).values()
+        users = sorted(user for response in responses for user in response.users)
+        return chat_pb2.GetOnlineUsersResponse(status=chat_pb2.Status.SUCCESS, users=users)
+
+    def GetUsers(self, request, **kwargs):
+        responses = list(self.each("GetUsers", request, **kwargs).values())
+        for response in responses:
+            if response.status != chat_pb2.Status.SUCCESS:
+                return chat_pb2.GetUsersResponse(status=response.status)
+        users = sorted(user for response in responses for user in response.users)
+        if request.limit <= 0:
+            return chat_pb2.GetUsersResponse(status=chat_pb2.Status.SUCCESS, users=users)
+        # Every node returned its first limit names after the token, so the first limit of them all are the page
+        more = len(users) > request.limit or any(response.next_page_token for response in responses)
+        users = users[:request.limit]
+        next_page_token = encode_users_page_token(users[-1]) if more and users else ""
+        return chat_pb2.GetUsersResponse(status=chat_pb2.Status.SUCCESS, users=users, next_page_token=next_page_token)
+
+    def GetServerStats(self, request, **kwargs):
+        '''Every node's stats, with each method name prefixed by its node (percentiles cannot be merged)'''
+        responses = self.each("GetServerStats", request, **kwargs)
+        methods = []
+        for node, response in sorted(responses.items()):
+            for stats in response.methods:
+                stats.method = f"{node} {stats.method}"
+                methods.append(stats)
+        return chat_pb2.GetServerStatsResponse(status=chat_pb2.Status.SUCCESS, methods=methods,
+                                               uptime_seconds=min(response.uptime_seconds for response in responses.values()))
+
+    def StartProfiling(self, request, **kwargs):
+        '''Arms every node. status is the worst of theirs, and output_path lists each node's file'''
+        responses = self.each("StartProfiling", request, **kwargs)
+        statuses = {response.status for response in responses.values()}
+        status = next((status for status in (chat_pb2.Status.ERROR, chat_pb2.Status.MATCH) if status in statuses), chat_pb2.Status.SUCCESS)
+        paths = ", ".join(f"{node} {response.output_path}" for node, response in sorted(responses.items()) if response.output_path)
+        return chat_pb2.StartProfilingResponse(status=status, output_path=paths)
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
@@ -0,0 +1,46 @@
+'''
+This file contains the compression settings shared by the chat servers and clients.
+
+On the wire, a channel or server built with grpc_compression(name) compresses the messages it
+sends. gRPC advertises the algorithms each side can decode, so a compressing server and a plain
+client (or the other way around) still understand each other.
+
+In messages.db, a Body whose UTF-8 encoding is longer than the threshold is stored as a zlib
+compressed BLOB instead of TEXT, when that is actually smaller. SQLite keeps the type of each
+value, so stored bodies are told apart by type and older rows stay readable as they are. The
+search index triggers decode bodies in SQL, so every connection that writes Messages must have
+decompress_body registered with register_sql_functions.
+'''
+
+import zlib
+
+import grpc
+from Constants import BODY_COMPRESSION_LEVEL
+
+CHANNEL_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+def grpc_compression(name):
+    '''Returns the grpc.Compression for a CHANNEL_COMPRESSION name'''
+    return CHANNEL_COMPRESSION[name]
+
+def compress_body(body, threshold):
+    '''Returns the value to store in Messages.Body: body itself, or its compressed bytes if longer than threshold (0 never compresses)'''
+    encoded = body.encode()
+    if threshold <= 0 or len(encoded) <= threshold:
+        return body
+    compressed = zlib.compress(encoded, BODY_COMPRESSION_LEVEL)
+    return compressed if len(compressed) < len(encoded) else body
+
+def decompress_body(value):
+    '''Returns the message body for a value read from Messages.Body'''
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode()
+    return value
+
+def register_sql_functions(connection):
+    '''Makes decompress_body(value) callable from SQL on connection'''
+    connection.create_function("decompress_body", 1, decompress_body, deterministic=True)
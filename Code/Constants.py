@@ -9,4 +9,90 @@ MESSAGES_DATABASE = Path(__file__).parent / "User_Data/messages.db"
 PASSWORD_DATABASE_SCHEMA = "Passwords (Username TEXT PRIMARY KEY, Password TEXT NOT NULL)"
 MESSAGES_DATABASE_SCHEMA = ("Messages (Id INTEGER PRIMARY KEY AUTOINCREMENT, Sender TEXT NOT NULL, " +
                             "Recipient TEXT NOT NULL, Time_sent TEXT NOT NULL, Read BOOLEAN NOT NULL DEFAULT 0, " + 
-                            "Subject TEXT, Body TEXT)")
\ No newline at end of file
+                            "Subject TEXT, Body TEXT)")
+
+# Default number of server worker threads for calls other than streams
+MAX_WORKERS = 10
+# Most SubscribeMessages streams GRPCServer.py keeps open at once. Each holds a worker thread
+# for as long as the user is logged in, so its pool defaults to MAX_STREAMS + MAX_WORKERS
+# threads; streams past the limit are turned away with RESOURCE_EXHAUSTED rather than waiting
+# for a thread that may never come free
+MAX_STREAMS = 100
+# Seconds a subscription stream waits on its delivery queue before checking the client is still connected
+SUBSCRIPTION_POLL_INTERVAL = 1.0
+# Most inbox changes a single SyncMessages response returns when the client does not set a limit
+SYNC_PAGE_SIZE = 500
+# Deletion tombstones in each shard's SyncMessages change log older than its last
+# TOMBSTONE_RETENTION changes are pruned every TOMBSTONE_PRUNE_INTERVAL seconds, at most
+# TOMBSTONE_PRUNE_BATCH per commit. Clients that last synced before them are told to resync
+TOMBSTONE_RETENTION = 1000000
+TOMBSTONE_PRUNE_INTERVAL = 60.0
+TOMBSTONE_PRUNE_BATCH = 10000
+# Most hits a single SearchMessages response returns when the client does not set a limit
+SEARCH_PAGE_SIZE = 20
+# Message bodies longer than this many UTF-8 bytes are stored zlib compressed at this level
+# (0 stores every body as plain text)
+BODY_COMPRESSION_THRESHOLD = 512
+BODY_COMPRESSION_LEVEL = 6
+# Compression gRPC applies to the messages the servers and clients send: "none", "deflate" or "gzip"
+DEFAULT_CHANNEL_COMPRESSION = "gzip"
+# Number of files the messages database is split into by recipient. Fixed for a data directory:
+# changing it starts from a new, empty set of shard files
+MESSAGE_SHARDS = 1
+# Points each cluster node gets on the consistent hash ring; more spread users more evenly
+CLUSTER_VIRTUAL_NODES = 128
+# Seconds a node waits on another when forwarding a message to it
+CLUSTER_FORWARD_TIMEOUT = 10.0
+# Environment variable holding the secret cluster nodes mark their forwarded calls with
+CLUSTER_SECRET_VARIABLE = "CHAT_CLUSTER_SECRET"
+# Replication. A primary keeps its last REPLICATION_LOG_SIZE committed batches per database for
+# replicas to catch up from, and streams them REPLICATION_STREAM_BATCHES at a time; a replica
+# further behind is sent a snapshot in REPLICATION_SNAPSHOT_CHUNK byte pieces
+REPLICATION_LOG_SIZE = 10_000
+REPLICATION_STREAM_BATCHES = 256
+REPLICATION_SNAPSHOT_CHUNK = 1 << 20
+# Seconds a replica read waits to catch up to its min_commit_token before answering PENDING,
+# and waits before reconnecting to a primary it lost
+REPLICA_READ_WAIT = 2.0
+REPLICA_RETRY_INTERVAL = 1.0
+# Environment variable holding the secret replicas present to their primary to be sent its databases
+REPLICATION_SECRET_VARIABLE = "CHAT_REPLICATION_SECRET"
+# Presence. A user is logged out once PRESENCE_LEASE seconds pass without a Heartbeat call or an
+# open SubscribeMessages stream; the reaper looks for lapsed leases every PRESENCE_REAP_INTERVAL
+# seconds, and clients without a stream heartbeat every PRESENCE_HEARTBEAT_INTERVAL seconds
+PRESENCE_LEASE = 60.0
+PRESENCE_REAP_INTERVAL = 5.0
+PRESENCE_HEARTBEAT_INTERVAL = 20.0
+# Most messages queued for a user's stream; any more wait in their inbox for the next sync
+DELIVERY_QUEUE_LIMIT = 1000
+# Seconds a session token stays valid after login, and the width in seconds of the buckets
+# sessions are expired in (a session can last up to one bucket longer)
+SESSION_LIFETIME = 24 * 60 * 60
+SESSION_EXPIRY_BUCKET = 60
+# Seconds a connection waits on another connection's write lock before giving up
+DATABASE_BUSY_TIMEOUT = 30.0
+
+# Durability modes map to SQLite's synchronous setting. "full" fsyncs every commit, "normal" only
+# fsyncs on WAL checkpoints (a power loss can drop the latest commits), and "async" leaves
+# flushing to the operating system entirely (an OS crash can also damage the database)
+DURABILITY_MODES = {"full": "FULL", "normal": "NORMAL", "async": "OFF"}
+DEFAULT_DURABILITY = "full"
+# Seconds the writer waits for more writes to join a batch, and the most writes one transaction holds
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_MAX_BATCH = 256
+
+# Above this many users the in-memory username directory swaps its exact set for a Bloom filter
+# with this false positive rate, checking SQLite only when the filter says a name might exist
+USER_DIRECTORY_BLOOM_THRESHOLD = 1_000_000
+USER_DIRECTORY_ERROR_RATE = 0.01
+
+# Server logging. Calls to the RPCs in SAMPLED_RPCS are logged one in every LOG_SAMPLE_EVERY
+DEFAULT_LOG_LEVEL = "INFO"
+LOG_SAMPLE_EVERY = 100
+SAMPLED_RPCS = {"Heartbeat", "CheckUsername", "GetUsers", "SendMessage", "GetMessage", "GetCounts", "SyncMessages", "ConfirmRead"}
+
+# On-demand profiling. Profiles are written here; SIGUSR1 profiles the next PROFILE_SIGNAL_CALLS calls
+# of any method, and StartProfiling takes at most PROFILE_MAX_CALLS
+PROFILE_DIRECTORY = Path(__file__).parent / "Analytics/Profiles"
+PROFILE_SIGNAL_CALLS = 100
+PROFILE_MAX_CALLS = 100_000
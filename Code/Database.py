@@ -0,0 +1,281 @@
+'''
+This file contains the SQLite connection handling shared by the GRPC servers
+'''
+
+import sqlite3
+import threading
+import queue
+import time
+import zlib
+from concurrent import futures
+from pathlib import Path
+
+from Constants import PASSWORD_DATABASE, MESSAGES_DATABASE, DATABASE_BUSY_TIMEOUT, DURABILITY_MODES, DEFAULT_DURABILITY
+from Constants import GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH
+from Migrations import migrate, MESSAGES_MIGRATIONS
+from Metrics import TimedConnection, add_sqlite_time
+from Compression import register_sql_functions
+from Replication import RecordingConnection, encode_batch, log_batch
+
+def snapshot_path(passwords_path):
+    '''Returns where the username directory snapshot for a passwords database lives'''
+    return Path(passwords_path).with_suffix(".users")
+
+def database_paths(data_dir=None):
+    '''Returns the passwords and messages database paths, placed in data_dir if one is given'''
+    if data_dir is None:
+        return PASSWORD_DATABASE, MESSAGES_DATABASE
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir / PASSWORD_DATABASE.name, data_dir / MESSAGES_DATABASE.name
+
+def shard_paths(messages_path, shards=1, directories=None):
+    '''
+    Returns the files a messages database is split into: messages_path itself for a single shard,
+    otherwise NAME_i_of_N.db next to it, or in directories[i] (one shard per directory) if given
+    '''
+    messages_path = Path(messages_path)
+    if directories:
+        shards = len(directories)
+    elif shards == 1:
+        return [messages_path]
+    paths = []
+    for i in range(shards):
+        directory = Path(directories[i]) if directories else messages_path.parent
+        directory.mkdir(parents=True, exist_ok=True)
+        paths.append(directory / f"{messages_path.stem}_{i}_of_{shards}{messages_path.suffix}")
+    return paths
+
+class ConnectionPool:
+    '''
+    Hands every worker thread its own connection to a single database file, so that
+    handlers running on different threads never share a cursor. Connections are opened
+    lazily the first time a thread asks for one and are kept for the lifetime of the pool.
+    Writes go through write(), which group commits them on the pool's WriteBatcher. The file
+    is brought up to date with migrations before any connection is handed out.
+    '''
+    def __init__(self, path, migrations, durability=DEFAULT_DURABILITY, commit_window=GROUP_COMMIT_WINDOW, replicated=False):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        migrate(path, migrations)
+        self.writer = WriteBatcher(path, durability, commit_window, replicated)
+
+    def connection(self):
+        '''Returns the calling thread's connection, opening it if needed'''
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # TimedConnection charges the time its statements take to the RPC that runs them
+            connection = sqlite3.connect(self.path, timeout=DATABASE_BUSY_TIMEOUT, check_same_thread=False, factory=TimedConnection)
+            # WAL lets readers on other threads proceed while a writer holds the lock
+            connection.execute("PRAGMA journal_mode=WAL")
+            register_sql_functions(connection)
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def write(self, write):
+        '''Runs write(connection) in the next group commit and returns its result once committed'''
+        start = time.perf_counter()
+        try:
+            return self.writer.submit(write)
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def write_async(self, write):
+        '''Queues write(connection) for the next group commit and returns a Future for its result'''
+        return self.writer.submit_async(write)
+
+    def close(self):
+        self.writer.close()
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+
+class WriteBatcher:
+    '''
+    Funnels every write to one database file through a single writer thread. Writes that
+    arrive within commit_window of the first one in a batch share a single transaction, and
+    therefore a single fsync. Each write runs inside its own savepoint, so a write that raises
+    (e.g. an IntegrityError) is rolled back and reported to its caller alone, without failing
+    the rest of the batch. Callers are only released once their batch has committed.
+
+    When replicated, the statements of the writes that succeed are stored as one batch in the
+    ReplicationLog within the same transaction, and seq is the last committed batch's Seq.
+    '''
+    def __init__(self, path, durability=DEFAULT_DURABILITY, commit_window=GROUP_COMMIT_WINDOW, replicated=False):
+        # Autocommit mode, so that the writer issues BEGIN and COMMIT itself
+        self.connection = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={DURABILITY_MODES[durability]}")
+        register_sql_functions(self.connection)
+        self.commit_window = commit_window
+        self.replicated = replicated
+        self.seq = 0
+        self.committed = threading.Condition()
+        if replicated:
+            self.seq = self.connection.execute("SELECT COALESCE(MAX(Seq), 0) FROM ReplicationLog").fetchone()[0]
+            if self.seq == 0:
+                # An empty batch, so that a snapshot of even an unchanged file has a Seq to resume from
+                self.seq = log_batch(self.connection, encode_batch([]))
+        self.pending = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, write):
+        '''Queues write(connection) for the writer thread and blocks until it has committed'''
+        return self.submit_async(write).result()
+
+    def submit_async(self, write):
+        '''Queues write(connection) for the writer thread and returns a Future resolved once it has committed'''
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot write to a closed database")
+        future = futures.Future()
+        self.pending.put((write, future, False))
+        return future
+
+    def submit_alone(self, function):
+        '''Runs function(connection) on the writer thread between batches, outside any transaction, and returns its result'''
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot write to a closed database")
+        future = futures.Future()
+        self.pending.put((function, future, True))
+        return future.result()
+
+    def wait_for_commit(self, seq, timeout):
+        '''Waits up to timeout seconds for a batch after seq to commit, and returns whether one has'''
+        with self.committed:
+            return self.committed.wait_for(lambda: self.seq > seq, timeout)
+
+    def run(self):
+        while True:
+            first = self.pending.get()
+            if first is None:
+                return
+            if first[2]:
+                self.run_alone(first)
+                continue
+            batch = [first]
+            stop = False
+            alone = None
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                try:
+                    # Take whatever is already queued, then wait out the rest of the window
+                    item = self.pending.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if item[2]:
+                    alone = item
+                    break
+                batch.append(item)
+            self.commit(batch)
+            if alone is not None:
+                self.run_alone(alone)
+            if stop:
+                return
+
+    def run_alone(self, item):
+        function, future, _ = item
+        try:
+            future.set_result(function(self.connection))
+        except Exception as e:
+            future.set_exception(e)
+
+    def commit(self, batch):
+        '''Runs the batch's writes in one transaction and then resolves their futures'''
+        outcomes = []
+        statements = []
+        seq = None
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for write, future, _ in batch:
+                self.connection.execute("SAVEPOINT write")
+                connection = RecordingConnection(self.connection) if self.replicated else self.connection
+                try:
+                    outcomes.append((future, write(connection), None))
+                    self.connection.execute("RELEASE write")
+                    if self.replicated:
+                        statements.extend(connection.statements)
+                except Exception as e:
+                    self.connection.execute("ROLLBACK TO write")
+                    self.connection.execute("RELEASE write")
+                    outcomes.append((future, None, e))
+            if statements:
+                seq = log_batch(self.connection, encode_batch(statements))
+            self.connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        if seq is not None:
+            with self.committed:
+                self.seq = seq
+                self.committed.notify_all()
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
+        self.connection.close()
+
+class MessageShards:
+    '''
+    The messages database split across shard files by a hash of Recipient. Every shard is a
+    complete messages database with its own ConnectionPool, and so its own writer, and a user's
+    whole inbox (messages, counters, change log and search index) lives in a single shard.
+
+    Message ids handed to clients are global: the shard's own Id times the number of shards,
+    plus the shard number. Any id can be routed back to its shard, ids in one inbox keep their
+    order, and with a single shard they are simply the Ids in the file.
+    '''
+    def __init__(self, paths, durability=DEFAULT_DURABILITY, commit_window=GROUP_COMMIT_WINDOW, replicated=False):
+        self.pools = [ConnectionPool(path, MESSAGES_MIGRATIONS, durability, commit_window, replicated) for path in paths]
+        self.count = len(self.pools)
+
+    def shard(self, username):
+        '''Returns the shard holding username's inbox. crc32 is stable across processes, unlike hash()'''
+        return zlib.crc32(username.encode()) % self.count
+
+    def pool(self, username):
+        return self.pools[self.shard(username)]
+
+    def global_id(self, shard, local_id):
+        return local_id * self.count + shard
+
+    def local_id(self, message_id):
+        '''Returns the (shard, Id in that shard) of a global message id'''
+        local_id, shard = divmod(message_id, self.count)
+        return shard, local_id
+
+    def write_each(self, writes):
+        '''
+        Runs {shard: write} on every named shard's writer at once and returns {shard: Future} once
+        they have all finished. Each shard commits on its own, so some may fail while others succeed
+        '''
+        start = time.perf_counter()
+        pending = {shard: self.pools[shard].write_async(write) for shard, write in writes.items()}
+        futures.wait(pending.values())
+        add_sqlite_time(time.perf_counter() - start)
+        return pending
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,236 @@
+'''
+asyncio (grpc.aio) entry point for the chat service.
+
+Connections and open SubscribeMessages and WatchPresence streams are coroutines on a single event loop, so an
+idle logged-in user costs a suspended coroutine rather than a worker thread. Unary handlers are
+the same ones GRPCServer.py serves, run on a bounded executor because they do SQLite work.
+'''
+
+import asyncio
+import argparse
+import contextvars
+import functools
+import os
+import threading
+from concurrent import futures
+from pathlib import Path
+
+import grpc
+import chat_pb2_grpc
+from Constants import MAX_WORKERS, DURABILITY_MODES, DEFAULT_DURABILITY, GROUP_COMMIT_WINDOW, PROFILE_DIRECTORY
+from Constants import BODY_COMPRESSION_THRESHOLD, DEFAULT_CHANNEL_COMPRESSION, MESSAGE_SHARDS, CLUSTER_SECRET_VARIABLE
+from Constants import PRESENCE_LEASE, REPLICATION_SECRET_VARIABLE
+from Database import database_paths
+from GRPCServer import ChatServiceServicer
+from Replication import is_replica
+from ServerLog import logger, log_request, add_logging_arguments, configure_logging_from_args
+from Metrics import AsyncMetricsInterceptor
+from Compression import CHANNEL_COMPRESSION, grpc_compression
+
+class AsyncDeliveryQueue:
+    '''
+    Delivery queue backed by an asyncio.Queue. Handlers running on executor threads put
+    messages into it; the subscription coroutine awaits them on the event loop.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    def qsize(self):
+        # Leaves out puts still waiting to run on the loop, which is close enough for a limit
+        return self.queue.qsize()
+
+    async def get(self):
+        return await self.queue.get()
+
+def offloaded(name):
+    '''Builds a coroutine handler that runs the ChatServiceServicer handler of the same name on the executor'''
+    async def handler(self, request, context):
+        loop = asyncio.get_running_loop()
+        # Carry the call's context (and so its metrics) over to the executor thread, and profile it there if armed
+        run = functools.partial(contextvars.copy_context().run, self.servicer.profiler.call, name,
+                                getattr(self.servicer, name), request, context)
+        return await loop.run_in_executor(self.executor, run)
+    handler.__name__ = name
+    return handler
+
+class AsyncChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
+    def __init__(self, loop, executor, passwords_path, messages_path, durability=DEFAULT_DURABILITY, commit_window=GROUP_COMMIT_WINDOW,
+                 profile_dir=PROFILE_DIRECTORY, body_compression_threshold=BODY_COMPRESSION_THRESHOLD, shards=MESSAGE_SHARDS,
+                 shard_dirs=None, cluster_nodes=None, node=None, compression=grpc.Compression.NoCompression, primary=False,
+                 replica_of=None, require_sessions=False, cluster_secret=None, presence_lease=PRESENCE_LEASE,
+                 replication_secret=None):
+        self.executor = executor
+        self.servicer = ChatServiceServicer(passwords_path, messages_path, delivery_queue=lambda: AsyncDeliveryQueue(loop),
+                                            durability=durability, commit_window=commit_window, profile_dir=profile_dir,
+                                            body_compression_threshold=body_compression_threshold, shards=shards, shard_dirs=shard_dirs,
+                                            cluster_nodes=cluster_nodes, node=node, compression=compression,
+                                            primary=primary, replica_of=replica_of, require_sessions=require_sessions,
+                                            cluster_secret=cluster_secret, presence_lease=presence_lease,
+                                            replication_secret=replication_secret)
+
+    # User Account Management
+
+    CheckUsername = offloaded("CheckUsername")
+    CheckPassword = offloaded("CheckPassword")
+    CreateUser = offloaded("CreateUser")
+    ConfirmLogin = offloaded("ConfirmLogin")
+    Login = offloaded("Login")
+    ConfirmLogout = offloaded("ConfirmLogout")
+    GetOnlineUsers = offloaded("GetOnlineUsers")
+    Heartbeat = offloaded("Heartbeat")
+    GetUsers = offloaded("GetUsers")
+
+    # Messages
+
+    SendMessage = offloaded("SendMessage")
+    GetMessage = offloaded("GetMessage")
+    GetCounts = offloaded("GetCounts")
+    SyncMessages = offloaded("SyncMessages")
+    ConfirmRead = offloaded("ConfirmRead")
+    SearchMessages = offloaded("SearchMessages")
+    DeleteMessage = offloaded("DeleteMessage")
+    DeleteUser = offloaded("DeleteUser")
+
+    # Monitoring
+
+    GetServerStats = offloaded("GetServerStats")
+    StartProfiling = offloaded("StartProfiling")
+
+    # Replication
+
+    async def Replicate(self, request, context):
+        log_request("Replicate", request)
+        if not is_replica(context, self.servicer.replication_secret):
+            await context.abort(grpc.StatusCode.PERMISSION_DENIED, "Replicate needs the replication secret")
+        pool = self.servicer.replication_pool(request.database)
+        if pool is None:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, f"Not a primary with a database {request.database!r}")
+        # Waiting for the next commit blocks, so each stream fetches its batches on a thread of its
+        # own rather than tying up one of the executor's. A replica going away cancels this
+        # coroutine, which clears active; the thread's wait ends within a poll interval and the
+        # generator then stops
+        active = threading.Event()
+        active.set()
+        batches = self.servicer.replication_batches(pool, request.since_seq, active.is_set)
+        thread = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"Replicate-{request.database}")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                batch = await loop.run_in_executor(thread, next, batches, None)
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            active.clear()
+            thread.shutdown(wait=False)
+
+    # Live Delivery
+
+    async def SubscribeMessages(self, request, context):
+        log_request("SubscribeMessages", request)
+        with self.servicer.online_lock:
+            delivery_queue = self.servicer.online_username.get(request.username)
+        if delivery_queue is None or not self.servicer.authorized(request.username, context):
+            return
+        # The user stays online for as long as the stream is open
+        self.servicer.presence.stream_opened(request.username)
+        try:
+            # Stream until the user logs out; a client cancelling cancels this coroutine
+            while True:
+                message = await delivery_queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.servicer.presence.stream_closed(request.username)
+
+    async def WatchPresence(self, request, context):
+        log_request("WatchPresence", request)
+        if self.servicer.replica is not None:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Replicas do not track who is online; watch the primary")
+        watcher, snapshot = self.servicer.watch_presence()
+        try:
+            yield snapshot
+            while True:
+                await watcher.wake.get()
+                update = self.servicer.presence_update(watcher)
+                if update is not None:
+                    yield update
+        finally:
+            self.servicer.unwatch_presence(watcher)
+
+async def serve(host, port, workers, data_dir, durability, commit_window, profile_dir=PROFILE_DIRECTORY,
+                compression=DEFAULT_CHANNEL_COMPRESSION, body_compression_threshold=BODY_COMPRESSION_THRESHOLD,
+                shards=MESSAGE_SHARDS, shard_dirs=None, cluster_nodes=None, primary=False, replica_of=None,
+                require_sessions=False, cluster_secret=None, replication_secret=None):
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    servicer = AsyncChatServiceServicer(asyncio.get_running_loop(), executor, *database_paths(data_dir), durability, commit_window,
+                                        profile_dir, body_compression_threshold, shards, shard_dirs,
+                                        cluster_nodes, f"{host}:{port}", grpc_compression(compression), primary, replica_of,
+                                        require_sessions, cluster_secret, replication_secret=replication_secret)
+    server = grpc.aio.server(interceptors=[AsyncMetricsInterceptor(servicer.servicer.metrics)],
+                             compression=grpc_compression(compression))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    server.add_insecure_port(f"{host}:{port}")
+    await server.start()
+    logger.info("gRPC asyncio Server started on %s:%s with %d database workers", host, port, workers)
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(0)
+        executor.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the asyncio gRPC chat server")
+    parser.add_argument("host", help="hostname to listen on")
+    parser.add_argument("port", help="port to listen on")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="number of threads running database work")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="directory holding passwords.db and messages.db (defaults to User_Data)")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default=DEFAULT_DURABILITY,
+                        help="full fsyncs every commit, normal only on checkpoints, async never waits on the disk")
+    parser.add_argument("--commit-window", type=float, default=GROUP_COMMIT_WINDOW,
+                        help="seconds the writer waits for concurrent writes to share a commit")
+    parser.add_argument("--profile-dir", type=Path, default=PROFILE_DIRECTORY,
+                        help="directory StartProfiling and SIGUSR1 write .pstats files to")
+    parser.add_argument("--compression", choices=CHANNEL_COMPRESSION, default=DEFAULT_CHANNEL_COMPRESSION,
+                        help="compression applied to responses")
+    parser.add_argument("--body-compression-threshold", type=int, default=BODY_COMPRESSION_THRESHOLD,
+                        help="store message bodies longer than this many bytes compressed (0 disables)")
+    parser.add_argument("--shards", type=int, default=MESSAGE_SHARDS,
+                        help="number of files messages are split across by recipient, each with its own writer")
+    parser.add_argument("--shard-dirs", type=Path, nargs="+", default=None,
+                        help="one directory per shard (e.g. on separate disks), overriding --shards")
+    parser.add_argument("--cluster", nargs="+", default=None, metavar="NODE",
+                        help="HOST:PORT of every node in the cluster, this one included, the same on every node")
+    parser.add_argument("--cluster-secret", default=os.environ.get(CLUSTER_SECRET_VARIABLE),
+                        help="secret shared by every node in the cluster, which marks the calls they forward to each other " +
+                             f"(defaults to ${CLUSTER_SECRET_VARIABLE}, which keeps it out of the process list)")
+    parser.add_argument("--replication-secret", default=os.environ.get(REPLICATION_SECRET_VARIABLE),
+                        help="secret shared by a primary and its replicas, without which Replicate is refused " +
+                             f"(defaults to ${REPLICATION_SECRET_VARIABLE})")
+    replication = parser.add_mutually_exclusive_group()
+    replication.add_argument("--primary", action="store_true",
+                             help="log committed writes so that replicas can follow this server")
+    replication.add_argument("--replica-of", metavar="PRIMARY",
+                             help="HOST:PORT of a primary to copy the databases from and serve reads for")
+    parser.add_argument("--require-sessions", action="store_true",
+                        help="only serve calls acting as a user if they carry that user's session token")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if args.require_sessions and args.replica_of:
+        parser.error("--require-sessions cannot be used with --replica-of: sessions are only known to the server that issued them")
+    if args.cluster and not args.cluster_secret:
+        parser.error(f"--cluster needs --cluster-secret or ${CLUSTER_SECRET_VARIABLE}, the same on every node")
+    if (args.primary or args.replica_of) and not args.replication_secret:
+        parser.error(f"--primary and --replica-of need --replication-secret or ${REPLICATION_SECRET_VARIABLE}, the same on each server")
+    configure_logging_from_args(args)
+    asyncio.run(serve(args.host, args.port, args.workers, args.data_dir, args.durability, args.commit_window, args.profile_dir,
+                      args.compression, args.body_compression_threshold, args.shards, args.shard_dirs, args.cluster,
+                      args.primary, args.replica_of, args.require_sessions, args.cluster_secret,
+                      args.replication_secret))
@@ -1,4 +1,4 @@
-import sys
+import argparse
 import time
 from datetime import datetime, timezone
 import tkinter as tk
@@ -6,12 +6,17 @@ from tkinter import ttk
 from tkinter import messagebox
 import hashlib
 import threading
+import queue
 import signal
 
 import grpc
 import chat_pb2, chat_pb2_grpc
+from Constants import DEFAULT_CHANNEL_COMPRESSION, PRESENCE_HEARTBEAT_INTERVAL
+from Compression import CHANNEL_COMPRESSION, grpc_compression
+from Sessions import SessionStub
+from Replication import ReplicaStub
 
-# run python client.py HOSTNAME PORTNAME
+# run python GRPCClient.py HOSTNAME PORTNAME [none|deflate|gzip] [--replica HOST:PORT]
 
 class LoginClient:
     def __init__(self, stub):
@@ -80,19 +85,25 @@ class LoginClient:
             return
         
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        # One call checks the password, logs in and fetches the first page of messages and accounts
         try:
-            response = self.stub.CheckPassword(chat_pb2.CheckPasswordRequest(username=username, password=hashed_password))
+            response = self.stub.Login(chat_pb2.LoginRequest(
+                username=username, password=hashed_password, message_limit=UserClient.MESSAGES_LIST_LEN,
+                users_limit=UserClient.ACCOUNTS_LIST_LEN))
         except grpc.RpcError as e:
             messagebox.showerror("gRPC Error", str(e))
             return
         
-        if response.status == chat_pb2.MATCH:
-            messagebox.showinfo("Success", "Currently Logging In")
+        if response.status == chat_pb2.SUCCESS:
+            messagebox.showinfo("Success", "Logged In")
             self.window.destroy()
-            UserClient(self.stub, username)
+            UserClient(self.stub, username, response)
         elif response.status == chat_pb2.NO_MATCH:
             messagebox.showerror("Login Failed", "Wrong password!")
             return
+        elif response.status == chat_pb2.MATCH:
+            messagebox.showerror("Error", "Already Logged In Elsewhere")
+            return
         else:
             messagebox.showerror("Error", "Unexpected server response.")
 
@@ -184,15 +195,27 @@ class RegisterClient:
 
 class UserClient:
     ACCOUNTS_LIST_LEN = 19
+    # Newest messages shown on login
+    MESSAGES_LIST_LEN = 15
 
-    def __init__(self, stub, username):
-        self.stub = stub
+    def __init__(self, stub, username, login):
+        # Every call made while logged in carries the session token; the login window goes back to the plain stub
+        self.login_stub = stub
+        self.stub = SessionStub(stub, login.session_token)
         self.username = username
         self.accounts = []
         self.accounts_offset = 0
+        # Accounts are fetched a page at a time; the token continues the current search
+        self.accounts_prefix = ""
+        self.accounts_page_token = ""
         self.unread_count = 0
         self.message_count = 0
         self.curr_displayed_msgs = []
+        # Local copy of the inbox (message id -> MessageObject) and how far it has been synced
+        self.inbox = {}
+        self.sync_seq = 0
+        self.subscription = None
+        self.incoming_messages = queue.Queue()
 
         self.window = tk.Tk()
         self.window.geometry("1500x500")
@@ -201,11 +224,12 @@ class UserClient:
         signal.signal(signal.SIGINT, lambda sig, frame: self.close_connection())
 
         self.create_chat_ui()
-        self.check_user_status()
-        self.query_accounts()
+        self.show_login(login)
 
         self.window.protocol("WM_DELETE_WINDOW", self.close_connection)
+        self.subscribe_messages()
         self.check_incoming_messages()
+        self.window.after(int(PRESENCE_HEARTBEAT_INTERVAL * 1000), self.send_heartbeat)
         self.window.mainloop()
     
     def create_chat_ui(self):        
@@ -218,6 +242,8 @@ class UserClient:
         self.accounts_searchbar.grid(row=0, column=1, padx=1, pady=5, sticky="W")
         self.accounts_search_button = tk.Button(self.window, text="Search", command=self.query_accounts)
         self.accounts_search_button.grid(row=0, column=2, padx=1, pady=5, sticky="W")
+        # Search as you type
+        self.accounts_searchbar.bind("<KeyRelease>", lambda event: self.query_accounts())
         self.accounts_list = tk.Text(self.window, wrap=tk.WORD, state=tk.DISABLED, height=20, width=50)
         self.accounts_list.grid(row=1, column=0, columnspan=3, padx=10, pady=5, sticky="W")
         self.accounts_back_button = tk.Button(self.window, text="<", command=self.prev_account)
@@ -272,6 +298,10 @@ class UserClient:
         # Delete message
         self.delete_button = tk.Button(self.window, text="Delete Selected Messages", command=self.delete_selected_messages)
         self.delete_button.grid(row=2, column=3, columnspan=3, pady=5, padx=10, sticky="W")
+        self.mark_read_button = tk.Button(self.window, text="Mark Selected Read", command=self.mark_selected_read)
+        self.mark_read_button.grid(row=2, column=4, pady=5, sticky="E")
+        self.mark_all_read_button = tk.Button(self.window, text="Mark All Read", command=self.mark_all_read)
+        self.mark_all_read_button.grid(row=2, column=5, pady=5, padx=10, sticky="W")
 
         # Logout and Delete Account Buttons
         self.logout_button = tk.Button(self.window, text="Logout", command=self.logout)
@@ -280,50 +310,40 @@ class UserClient:
         self.delete_account_button.grid(row=4, column=1, padx=5, pady=10, sticky="W")
         self.window.update_idletasks()
 
-    def check_user_status(self):
-        """Verifies this user is not currently logged in on another machine. Runs immediately upon login."""
-
-        # Call ConfirmLogin RPC to verify status and get unread/total messages
-        try:
-            response = self.stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username=self.username))
-        except grpc.RpcError as e:
-            messagebox.showerror("gRPC Error", str(e))
-            self.close_connection()
-            return
-
-        if response.status == chat_pb2.SUCCESS:
-            messagebox.showinfo("Sucess", "Logged In")
-            self.unread_count = response.num_unread_msgs
-            self.message_count = response.num_total_msgs
-            self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
-        elif response.status == chat_pb2.MATCH:
-            messagebox.showerror("Error", "Already Logged In Elsewhere")
-            self.window.destroy()
-            LoginClient(self.stub)
-            return
-        else:
-            messagebox.showerror("Server Error", "Unexpected login response.")
-            self.window.destroy()
-            LoginClient(self.stub)
-            return
+    def show_login(self, login):
+        """Fills in the first screen from the Login response: counts, the newest messages and the first accounts"""
+        self.unread_count = login.num_unread_msgs
+        self.message_count = login.num_total_msgs
+        self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
+        self.accounts = [account for account in login.users if account != self.username]
+        self.accounts_page_token = login.users_next_page_token
+        self.display_accounts()
+        self.display_messages(list(login.messages))
 
     def query_accounts(self):
-        """Queries server user process for list of accounts matching wildcard pattern"""
-        query = self.accounts_searchbar.get().strip()
-        if not query:
-            query = r"%"
+        """Queries server for the first page of accounts starting with the search text"""
+        self.accounts_prefix = self.accounts_searchbar.get().strip()
+        self.accounts = []
+        self.accounts_offset = 0
+        self.accounts_page_token = ""
+        if self.fetch_accounts():
+            self.display_accounts()
 
+    def fetch_accounts(self):
+        """Appends the next page of matching accounts (not including user) to self.accounts"""
         try:
-            response = self.stub.GetUsers(chat_pb2.GetUsersRequest(query=query))
+            response = self.stub.GetUsers(chat_pb2.GetUsersRequest(
+                prefix=self.accounts_prefix, limit=self.ACCOUNTS_LIST_LEN, page_token=self.accounts_page_token))
         except grpc.RpcError as e:
             messagebox.showerror("gRPC Error", str(e))
-            return
+            return False
 
         if response.status == chat_pb2.SUCCESS:
-            self.accounts = [account for account in response.users if account != self.username]
-            self.display_accounts()
-        else:
-            messagebox.showerror("Error", "Error fetching users.")
+            self.accounts += [account for account in response.users if account != self.username]
+            self.accounts_page_token = response.next_page_token
+            return True
+        messagebox.showerror("Error", "Error fetching users.")
+        return False
     
     def display_accounts(self):
         """Displays list of requested accounts (not including user)"""
@@ -331,7 +351,7 @@ class UserClient:
         self.accounts_list.delete(1.0, tk.END)
         self.accounts_list.config(state=tk.DISABLED)
         
-        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts):
+        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts) and not self.accounts_page_token:
             self.accounts_next_button.config(state=tk.DISABLED)
         else:
             self.accounts_next_button.config(state=tk.NORMAL)
@@ -346,9 +366,12 @@ class UserClient:
             self.accounts_list.config(state=tk.DISABLED)
     
     def next_account(self):
-        """Displays next page of accounts"""
+        """Displays next page of accounts, fetching it from the server if needed"""
         self.accounts_offset += self.ACCOUNTS_LIST_LEN
-        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts):
+        while self.ACCOUNTS_LIST_LEN + self.accounts_offset > len(self.accounts) and self.accounts_page_token:
+            if not self.fetch_accounts():
+                break
+        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts) and not self.accounts_page_token:
             self.accounts_next_button.config(state=tk.DISABLED)
         else:
             self.accounts_next_button.config(state=tk.NORMAL)
@@ -361,7 +384,7 @@ class UserClient:
     def prev_account(self):
         """Displays previous page of accounts"""
         self.accounts_offset -= self.ACCOUNTS_LIST_LEN
-        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts):
+        if self.ACCOUNTS_LIST_LEN + self.accounts_offset >= len(self.accounts) and not self.accounts_page_token:
             self.accounts_next_button.config(state=tk.DISABLED)
         else:
             self.accounts_next_button.config(state=tk.NORMAL)
@@ -371,60 +394,67 @@ class UserClient:
             self.accounts_back_button.config(state=tk.NORMAL)
         self.display_accounts()
 
-    def query_messages(self, active=True):
-        """Queries server for all of user's messages"""
-
-        limit = self.message_count_entry.get().strip()
+    def refresh_counts(self):
+        """Fetches the user's total and unread message counts and updates the header"""
+        try:
+            response = self.stub.GetCounts(chat_pb2.GetCountsRequest(username=self.username))
+        except grpc.RpcError as e:
+            messagebox.showerror("gRPC Error", str(e))
+            return
+        if response.status == chat_pb2.SUCCESS:
+            self.unread_count = response.num_unread_msgs
+            self.message_count = response.num_total_msgs
+            self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
 
-        if active:
-            # If no valid number is provided or the value is less than 1, default to 1.
-            if not limit or not limit.isdigit() or int(limit) < 1:
-                limit = 1
-            elif int(limit) > self.message_count:
-                limit = self.message_count
-            else:
-                limit = int(limit)
-            # if we changed the number of messages to be displayed
+    def sync_messages(self):
+        """Brings the local inbox up to date with only the changes since the last sync"""
+        while True:
             try:
-                response = self.stub.GetMessage(chat_pb2.GetMessageRequest(
-                    offset=0, limit=-1, unread_only=False, username=self.username
-                ))
+                response = self.stub.SyncMessages(chat_pb2.SyncMessagesRequest(username=self.username, since_seq=self.sync_seq))
             except grpc.RpcError as e:
                 messagebox.showerror("gRPC Error", str(e))
-                return
-            if response.status == chat_pb2.SUCCESS:
-                # visually update limit
-                self.message_count_entry.delete(0, tk.END)
-                self.message_count_entry.insert(0, limit)
-                num_new_messages = len(response.messages) - self.message_count
-                self.unread_count += num_new_messages
-                self.message_count = len(response.messages)
-                self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
-                self.display_messages(response.messages[-limit:])
-            else:
-                messagebox.showerror("Error", "Error fetching messages")
-                return
+                return False
+            if response.status != chat_pb2.SUCCESS:
+                return False
+            if response.resync:
+                # Too far behind for the server's tombstones: fetch the whole inbox again
+                self.inbox.clear()
+                self.sync_seq = 0
+                continue
+            for message in response.messages:
+                self.inbox[message.id] = message
+            for message_id in response.deleted_ids:
+                self.inbox.pop(message_id, None)
+            for message_id in response.read_ids:
+                if message_id in self.inbox:
+                    self.inbox[message_id].read = True
+            self.sync_seq = response.next_seq
+            if not response.has_more:
+                return True
+
+    def query_messages(self):
+        """Shows the user's most recent messages from the synced local inbox"""
+
+        # Counts come from the server, which already includes anything still waiting on the stream
+        self.drain_incoming_messages()
+        if not self.sync_messages():
+            messagebox.showerror("Error", "Error fetching messages")
+            return
+        self.refresh_counts()
+        limit = self.message_count_entry.get().strip()
+
+        # If no valid number is provided or the value is less than 1, default to 1.
+        if not limit or not limit.isdigit() or int(limit) < 1:
+            limit = 1
+        elif int(limit) > self.message_count:
+            limit = self.message_count
         else:
-            # Fetch all messages
-            try:
-                response = self.stub.GetMessage(chat_pb2.GetMessageRequest(
-                    offset=0, limit=-1, unread_only =False, username=self.username
-                ))
-            except grpc.RpcError as e:
-                messagebox.showerror("gRPC Error", str(e))
-                self.close_connection()
-                return
-            if response.status == chat_pb2.SUCCESS:
-                num_new_messages = len(response.messages) - self.message_count
-                if num_new_messages == 0:
-                    return
-                # update unread_count and total count and increment limit (and ui)
-                self.unread_count += num_new_messages
-                self.message_count = len(response.messages)
-                self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
-            else:
-                messagebox.showerror("Error", "Error fetching messages")
-                return
+            limit = int(limit)
+        newest = sorted(self.inbox.values(), key=lambda msg: (msg.time_sent, msg.id), reverse=True)
+        # visually update limit
+        self.message_count_entry.delete(0, tk.END)
+        self.message_count_entry.insert(0, limit)
+        self.display_messages(newest[:limit])
             
     def display_messages(self, messages):
         """Displays user messages upon receipt"""
@@ -464,17 +494,36 @@ class UserClient:
             message_window.grab_set()
 
             # Mark message as read
-            try:
-                response = self.stub.ConfirmRead(chat_pb2.ConfirmReadRequest(
-                    message_id=int(message_id), username=self.username
-                ))
-                if response.status == chat_pb2.SUCCESS:
-                    self.unread_count -= 1
-                    self.query_messages()
-            except grpc.RpcError as e:
-                messagebox.showerror("gRPC Error", str(e))
-                return
+            self.confirm_read(chat_pb2.ConfirmReadRequest(message_id=int(message_id), username=self.username))
     
+    def confirm_read(self, request):
+        """Sends a ConfirmRead request and redisplays the messages if it succeeded"""
+        try:
+            response = self.stub.ConfirmRead(request)
+        except grpc.RpcError as e:
+            messagebox.showerror("gRPC Error", str(e))
+            return
+        if response.status == chat_pb2.SUCCESS:
+            self.query_messages()
+        else:
+            messagebox.showerror("Error", "An error has occurred while marking messages as read.")
+
+    def mark_selected_read(self):
+        """Marks every message selected in chat_area as read in one request"""
+        selected_items = self.chat_area.selection()
+        if not selected_items:
+            messagebox.showwarning("No Selection", "Please select a message to mark as read.")
+            return
+        message_ids = [int(self.chat_area.item(item, "values")[0]) for item in selected_items]
+        self.confirm_read(chat_pb2.ConfirmReadRequest(message_ids=message_ids, username=self.username))
+
+    def mark_all_read(self):
+        """Marks every message in the synced inbox as read in one request"""
+        self.sync_messages()
+        if not self.inbox:
+            return
+        self.confirm_read(chat_pb2.ConfirmReadRequest(up_to_id=max(self.inbox), username=self.username))
+
     def send_message(self):
         """Server request to send message"""
         recipient = self.recipient_entry.get().strip()
@@ -487,23 +536,30 @@ class UserClient:
         # Message timestamp (different from request ID)
         current_time = datetime.now(timezone.utc).isoformat(timespec='seconds')
         
+        # Several comma separated recipients are sent in one multicast request
+        recipients = [name.strip() for name in recipient.split(",") if name.strip()]
+
         # Create a MessageObject. ID is assigned by the server
         message_obj = chat_pb2.MessageObject(
             id=0,
             sender=self.username,
-            recipient=recipient,
+            recipient=recipients[0] if len(recipients) == 1 else "",
             time_sent=current_time,
             read=False,
             subject=subject,
             body=body
         )
         try:
-            response = self.stub.SendMessage(chat_pb2.SendMessageRequest(message=message_obj))
+            response = self.stub.SendMessage(chat_pb2.SendMessageRequest(
+                message=message_obj, recipients=recipients if len(recipients) > 1 else []))
         except grpc.RpcError as e:
             messagebox.showerror("gRPC Error", str(e))
             return
 
-        if response.status == chat_pb2.SUCCESS:
+        unknown = [status.recipient for status in response.recipient_statuses if status.status != chat_pb2.SUCCESS]
+        if response.status == chat_pb2.SUCCESS and unknown:
+            messagebox.showwarning("Partly Sent", f"Your message was not sent to: {', '.join(unknown)}")
+        elif response.status == chat_pb2.SUCCESS:
             messagebox.showinfo("Sent", "Your message has been sent")
         else:
             messagebox.showerror("Error", "An error has occurred while sending your message.")
@@ -522,14 +578,11 @@ class UserClient:
         
         message_ids = []
         num_messages = 0
-        num_unread = 0
         for item in selected_items:
             values = self.chat_area.item(item, "values")
             msg_id = values[0]
             message_ids.append(int(msg_id))
             num_messages += 1
-            if "(*)" in values[1]:
-                num_unread += 1
 
         # Confirm deletion
         confirm = messagebox.askyesno("Confirm Deletion", f"Are you sure you want to delete {len(message_ids)} message(s)?")
@@ -540,28 +593,23 @@ class UserClient:
         for item in selected_items:
             self.chat_area.delete(item)
 
-        # Update text
-        self.message_count -= num_messages
-        self.unread_count -= num_unread
+        # Update number of messages to show on UI
         num_to_read = self.message_count_entry.get().strip()
-
-        # Update number of messages on UI
         if int(num_to_read) <= num_messages:
             self.message_count_entry.delete(0, tk.END)
-            self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
         else:
             num_to_read = str(int(num_to_read) - num_messages)
             self.message_count_entry.delete(0, tk.END)
             self.message_count_entry.insert(0, num_to_read)
-            self.message_count_label.config(text=f"You have {self.message_count} messages ({self.unread_count} unread). How many messages would you like to see?")
     
         try:
-            response = self.stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=message_ids))
+            response = self.stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=message_ids, username=self.username))
         except grpc.RpcError as e:
             messagebox.showerror("gRPC Error", str(e))
             return
         if response.status != chat_pb2.SUCCESS:
             messagebox.showerror("Error", "An error has occurred while deleting messages.")
+        self.refresh_counts()
 
     def logout(self):
         """Sends server request to log user out"""
@@ -572,7 +620,7 @@ class UserClient:
             return
         if response.status == chat_pb2.SUCCESS:
             self.close_connection()
-            LoginClient(self.stub)
+            LoginClient(self.login_stub)
         else:
             messagebox.showerror("Error", "Logout failed")
     
@@ -590,16 +638,61 @@ class UserClient:
         if response.status == chat_pb2.SUCCESS:
             messagebox.showinfo("Account Deleted", "Your account has been deleted.")
             self.close_connection()
-            LoginClient(self.stub)
+            LoginClient(self.login_stub)
         else:
             messagebox.showerror("Error", "Account deletion failed")
 
+    def subscribe_messages(self):
+        """Opens a server stream that delivers messages sent to this user while logged in"""
+        try:
+            self.subscription = self.stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=self.username))
+        except grpc.RpcError as e:
+            messagebox.showerror("gRPC Error", str(e))
+            return
+        threading.Thread(target=self.receive_messages, args=(self.subscription,), daemon=True).start()
+
+    def receive_messages(self, subscription):
+        """Runs on a background thread, handing streamed messages to the Tkinter thread"""
+        try:
+            for message in subscription:
+                self.incoming_messages.put(message)
+        except grpc.RpcError:
+            # The stream is cancelled on logout or when the server goes away
+            return
+
+    def drain_incoming_messages(self):
+        """Returns (and clears) the messages streamed in since the last drain"""
+        messages = []
+        while True:
+            try:
+                messages.append(self.incoming_messages.get_nowait())
+            except queue.Empty:
+                return messages
+
     def check_incoming_messages(self):
-        self.query_messages(active=False)
+        """Refreshes the message counts if any messages were streamed in since the last check"""
+        if self.drain_incoming_messages():
+            self.refresh_counts()
         # Schedule check_incoming_messages to run again after 500 milliseconds
         self.window.after(500, self.check_incoming_messages)
 
+    def send_heartbeat(self):
+        """Keeps the user online should the message stream drop. Runs every PRESENCE_HEARTBEAT_INTERVAL seconds."""
+        try:
+            response = self.stub.Heartbeat(chat_pb2.HeartbeatRequest(username=self.username))
+        except grpc.RpcError:
+            # Try again next time; the lease outlasts a missed heartbeat or two
+            response = None
+        if response is not None and response.status == chat_pb2.NO_MATCH:
+            messagebox.showerror("Logged Out", "You were logged out after losing contact with the server.")
+            self.window.destroy()
+            LoginClient(self.login_stub)
+            return
+        self.window.after(int(PRESENCE_HEARTBEAT_INTERVAL * 1000), self.send_heartbeat)
+
     def close_connection(self):
+        if self.subscription is not None:
+            self.subscription.cancel()
         try:
             response = self.stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username=self.username))
         except grpc.RpcError as e:
@@ -612,11 +705,19 @@ class UserClient:
             messagebox.showerror("Error", "Logout failed")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python client.py HOSTNAME PORTNAME")
-        exit(1)
-    host, port = sys.argv[1], int(sys.argv[2])
-    channel = grpc.insecure_channel(f"{host}:{port}")
+    parser = argparse.ArgumentParser(description="Chat in a Tkinter window")
+    parser.add_argument("host", help="hostname of the server")
+    parser.add_argument("port", type=int, help="port of the server")
+    # Compress requests; the server picks its own compression for responses
+    parser.add_argument("compression", nargs="?", choices=CHANNEL_COMPRESSION, default=DEFAULT_CHANNEL_COMPRESSION,
+                        help="compression applied to requests")
+    parser.add_argument("--replica", metavar="HOST:PORT",
+                        help="replica of the server to read inboxes, counts and users from (see Replication.py)")
+    args = parser.parse_args()
+    channel = grpc.insecure_channel(f"{args.host}:{args.port}", compression=grpc_compression(args.compression))
     stub = chat_pb2_grpc.ChatServiceStub(channel)
+    if args.replica:
+        replica_channel = grpc.insecure_channel(args.replica, compression=grpc_compression(args.compression))
+        stub = ReplicaStub(stub, chat_pb2_grpc.ChatServiceStub(replica_channel))
 
     LoginClient(stub)
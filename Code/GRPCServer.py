@@ -5,209 +5,1050 @@ import sqlite3
 import atexit
 import signal
 import sys
+import threading
+import argparse
+import json
+import os
+from pathlib import Path
 
 import grpc
 import chat_pb2
 import chat_pb2_grpc
-from Constants import PASSWORD_DATABASE, MESSAGES_DATABASE, PASSWORD_DATABASE_SCHEMA, MESSAGES_DATABASE_SCHEMA
+from Constants import PASSWORD_DATABASE, MESSAGES_DATABASE
+from Constants import MAX_WORKERS, MAX_STREAMS, SUBSCRIPTION_POLL_INTERVAL, DURABILITY_MODES, DEFAULT_DURABILITY, GROUP_COMMIT_WINDOW
+from Constants import SYNC_PAGE_SIZE, SEARCH_PAGE_SIZE, PROFILE_DIRECTORY, PROFILE_SIGNAL_CALLS, PROFILE_MAX_CALLS
+from Constants import BODY_COMPRESSION_THRESHOLD, DEFAULT_CHANNEL_COMPRESSION, MESSAGE_SHARDS, CLUSTER_FORWARD_TIMEOUT
+from Constants import CLUSTER_SECRET_VARIABLE, REPLICATION_SECRET_VARIABLE
+from Constants import REPLICATION_STREAM_BATCHES, REPLICATION_SNAPSHOT_CHUNK
+from Constants import PRESENCE_LEASE, PRESENCE_REAP_INTERVAL, DELIVERY_QUEUE_LIMIT
+from Constants import TOMBSTONE_RETENTION, TOMBSTONE_PRUNE_INTERVAL, TOMBSTONE_PRUNE_BATCH
+from Database import ConnectionPool, MessageShards, database_paths, shard_paths, snapshot_path
+from Migrations import PASSWORDS_MIGRATIONS
+from UserDirectory import UserDirectory
+from ServerLog import logger, log_request, add_logging_arguments, configure_logging_from_args
+from Metrics import ServerMetrics, MetricsInterceptor
+from Profiler import CallProfiler, ProfilingInterceptor, is_local
+from Compression import CHANNEL_COMPRESSION, grpc_compression, compress_body, decompress_body
+from PageTokens import encode_page_token, decode_page_token, encode_users_page_token, decode_users_page_token
+from PageTokens import encode_search_page_token, decode_search_page_token
+from Cluster import ClusterStub, forwarded_metadata, is_forwarded
+from Replication import Replica, database_name, encode_commit_token, is_replica, snapshot
+from Sessions import SessionTable, session_token
+from Presence import Presence, PresenceWatcher
+
+# RPCs that change the databases. A replica turns them away, and a primary's responses to them carry a commit token
+WRITE_RPCS = ("CreateUser", "ConfirmLogin", "Login", "ConfirmLogout", "SendMessage", "ConfirmRead", "DeleteMessage", "DeleteUser")
+
+# The user each RPC acts as, whose session token it must carry when sessions are required.
+# SubscribeMessages checks its own, as it streams
+SESSION_USERS = {
+    "ConfirmLogin": lambda request: request.username,
+    "ConfirmLogout": lambda request: request.username,
+    "SendMessage": lambda request: request.message.sender,
+    "GetMessage": lambda request: request.username,
+    "GetCounts": lambda request: request.username,
+    "SyncMessages": lambda request: request.username,
+    "ConfirmRead": lambda request: request.username,
+    "SearchMessages": lambda request: request.username,
+    "DeleteMessage": lambda request: request.username,
+    "DeleteUser": lambda request: request.username,
+    "Heartbeat": lambda request: request.username,
+}
+
+def search_expression(username, query):
+    '''Builds the FTS5 query matching every word of query in username's subjects and bodies, or None if query is blank'''
+    words = query.split()
+    if not words:
+        return None
+    # Quoting each word as a phrase keeps FTS5 operators and punctuation in query from being interpreted
+    phrase = lambda text: '"' + text.replace('"', '""') + '"'
+    return f"Recipient : {phrase(username)} AND {{Subject Body}} : ({' '.join(phrase(word) for word in words)})"
 
 class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
-    def __init__(self):
+    def __init__(self, passwords_path=PASSWORD_DATABASE, messages_path=MESSAGES_DATABASE, delivery_queue=queue.Queue,
+                 durability=DEFAULT_DURABILITY, commit_window=GROUP_COMMIT_WINDOW, profile_dir=PROFILE_DIRECTORY,
+                 body_compression_threshold=BODY_COMPRESSION_THRESHOLD, shards=MESSAGE_SHARDS, shard_dirs=None,
+                 cluster_nodes=None, node=None, compression=grpc.Compression.NoCompression, primary=False, replica_of=None,
+                 require_sessions=False, presence_lease=PRESENCE_LEASE, cluster_secret=None, max_streams=None,
+                 tombstone_retention=TOMBSTONE_RETENTION, replication_secret=None):
+        # online_username maps each logged in user to their delivery queue, guarded by online_lock.
+        # delivery_queue builds those queues; it only needs a thread-safe put() and qsize()
         self.online_username = {}
+        self.online_lock = threading.Lock()
+        self.delivery_queue = delivery_queue
+        # Users stay online while they hold a lease (see Presence.py), and WatchPresence streams
+        # are told as they come and go. Both are changed under online_lock
+        self.presence = Presence(presence_lease, min(PRESENCE_REAP_INTERVAL, presence_lease))
+        self.presence_watchers = set()
+        self.reaper_stopped = threading.Event()
+        # Each SubscribeMessages or Replicate stream served by a thread pool holds one of its
+        # threads, so at most max_streams are let in (None for no limit, as on grpc.aio where
+        # they hold none)
+        self.max_streams = max_streams
+        self.stream_slots = threading.BoundedSemaphore(max_streams) if max_streams is not None else None
+        # Filled in by the server's metrics interceptor and reported by GetServerStats
+        self.metrics = ServerMetrics()
+        # Wraps calls in cProfile once armed by StartProfiling or SIGUSR1
+        self.profiler = CallProfiler(profile_dir)
+        # Bodies longer than this are stored compressed
+        self.body_compression_threshold = body_compression_threshold
+        # In a cluster this node only stores the inboxes of the users it owns, and forwards
+        # messages for everyone else to their owners
+        self.cluster = ClusterStub(cluster_nodes, compression) if cluster_nodes else None
+        self.node = node
+        if self.cluster is not None and node not in self.cluster.ring.nodes:
+            raise ValueError(f"{node} is not one of the cluster's nodes {self.cluster.ring.nodes}")
+        # Nodes prove the calls they forward to each other with a secret shared by the whole cluster
+        if self.cluster is not None and not cluster_secret:
+            raise ValueError("A cluster node needs the cluster secret to forward calls to the others")
+        self.cluster_secret = cluster_secret
+        # A primary only streams its databases to replicas holding the secret they share
+        if (primary or replica_of) and not replication_secret:
+            raise ValueError("A primary and its replicas need the replication secret to stream the databases")
+        self.replication_secret = replication_secret
+
+        # Every worker thread gets its own connection to each database for reads, while writes
+        # are group committed by each database's writer thread. Messages are split by recipient
+        # across shards, each with its own writer
+        self.passwords = ConnectionPool(passwords_path, PASSWORDS_MIGRATIONS, durability, commit_window, primary)
+        self.messages = MessageShards(shard_paths(messages_path, shards, shard_dirs), durability, commit_window, primary)
+        # Username existence checks are answered from memory, warm started from a snapshot
+        self.users = UserDirectory(self.passwords, snapshot_path(passwords_path))
+
+        # A primary logs every committed write for its replicas (see Replication.py). A replica
+        # applies that log to its own copy of the databases and only serves reads
+        self.primary = primary
+        self.replica = None
+        if primary:
+            # Nobody is logged in to a server that has just started
+            self.passwords.write(lambda db: db.execute("DELETE FROM OnlineUsers"))
+            for name in WRITE_RPCS:
+                setattr(self, name, self.with_commit_token(getattr(self, name)))
+        elif replica_of:
+            self.passwords.write(self.follow_users)
+            self.replica = Replica(replica_of, self.databases(), self.restored, replication_secret)
+            for name in WRITE_RPCS:
+                setattr(self, name, lambda request, context, name=name: getattr(chat_pb2, f"{name}Response")(status=chat_pb2.Status.ERROR))
 
-        self.passwords = sqlite3.connect(PASSWORD_DATABASE, check_same_thread=False)
-        self.passwords_cursor = self.passwords.cursor()
-        self.passwords_cursor.execute(f"CREATE TABLE IF NOT EXISTS {PASSWORD_DATABASE_SCHEMA}")
-        self.passwords.commit()
+        # Logged in users' session tokens (see Sessions.py). When they are required, calls acting
+        # as a user are turned away unless they carry one of that user's tokens
+        self.sessions = SessionTable()
+        self.require_sessions = require_sessions
+        if require_sessions:
+            if replica_of:
+                raise ValueError("A replica cannot check the sessions its primary issues")
+            for name in SESSION_USERS:
+                setattr(self, name, self.with_session(name, getattr(self, name)))
 
-        self.messages = sqlite3.connect(MESSAGES_DATABASE, check_same_thread=False)
-        self.messages_cursor = self.messages.cursor()
-        self.messages_cursor.execute(f"CREATE TABLE IF NOT EXISTS {MESSAGES_DATABASE_SCHEMA}")
-        self.messages.commit()
+        # Only the primary (or a lone server) has users logging in, and prunes the change log
+        # (a replica replays its pruning)
+        self.tombstone_retention = tombstone_retention
+        if self.replica is None:
+            threading.Thread(target=self.reap_presence, name="PresenceReaper", daemon=True).start()
+            threading.Thread(target=self.prune_periodically, name="TombstonePruner", daemon=True).start()
 
         # Handle kills and interupts by closing
         atexit.register(self.close)
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.profiler.arm("", PROFILE_SIGNAL_CALLS))
 
     def close(self):
+        if self.passwords.writer.closed:
+            return
+        self.reaper_stopped.set()
+        if self.replica is not None:
+            self.replica.close()
+        self.users.save()
         self.passwords.close()
         self.messages.close()
+        if self.cluster is not None:
+            self.cluster.close()
 
     def _signal_handler(self, signum, frame):
         self.close()
         sys.exit(0) 
 
+    def databases(self):
+        '''Returns the ConnectionPool of every database file, passwords.db first'''
+        return [self.passwords] + self.messages.pools
+
+    def commit_token(self):
+        '''Returns a commit token for every write this primary has committed so far'''
+        return encode_commit_token({database_name(pool): pool.writer.seq for pool in self.databases()})
+
+    def with_commit_token(self, handler):
+        '''Wraps a write handler so that its response carries the commit token of the writes it made'''
+        def tagged(request, context):
+            response = handler(request, context)
+            response.commit_token = self.commit_token()
+            return response
+        return tagged
+
+    def authorized(self, username, context):
+        '''Returns whether the call behind context may act as username'''
+        if not self.require_sessions or is_forwarded(context, self.cluster_secret):
+            return True
+        return self.sessions.username(session_token(context)) == username
+
+    def with_session(self, name, handler):
+        '''Wraps the handler for name so that it answers ERROR unless the caller holds a session for the user it acts as'''
+        def checked(request, context):
+            if not self.authorized(SESSION_USERS[name](request), context):
+                return getattr(chat_pb2, f"{name}Response")(status=chat_pb2.Status.ERROR)
+            return handler(request, context)
+        return checked
+
+    def follow_users(self, db):
+        '''Keeps a replica's username directory in step as the replayed writes add and remove users'''
+        db.create_function("user_added", 1, lambda username: self.users.add(db, username))
+        db.create_function("user_removed", 1, self.users.remove)
+        db.execute("CREATE TEMP TRIGGER IF NOT EXISTS Replica_User_Insert AFTER INSERT ON main.Passwords BEGIN " +
+                   "SELECT user_added(NEW.Username); END")
+        db.execute("CREATE TEMP TRIGGER IF NOT EXISTS Replica_User_Delete AFTER DELETE ON main.Passwords BEGIN " +
+                   "SELECT user_removed(OLD.Username); END")
+
+    def restored(self, pool):
+        '''Called on a replica once a snapshot from the primary has replaced pool's file'''
+        if pool is self.passwords:
+            self.users.rebuild(self.passwords.connection())
+
+    def stale_status(self, min_commit_token):
+        '''Returns None if a read can go ahead, or PENDING if this replica has not caught up to min_commit_token in time'''
+        if self.replica is None or not min_commit_token:
+            return None
+        try:
+            return None if self.replica.caught_up(min_commit_token) else chat_pb2.Status.PENDING
+        except ValueError:
+            return chat_pb2.Status.ERROR
+
+    def owner(self, username):
+        '''Returns the cluster node owning username, or None if it is this one'''
+        if self.cluster is None:
+            return None
+        owner = self.cluster.owner(username)
+        return None if owner == self.node else owner
+
+    def inbox_counts(self, username):
+        '''Returns the user's (total, unread) message counts from the counters kept by the Messages triggers'''
+        result = self.messages.pool(username).connection().execute(
+            "SELECT Total, Unread FROM InboxCounts WHERE Username = ?", (username,)).fetchone()
+        return result if result else (0, 0)
+
+    def prune_periodically(self):
+        '''Runs on the pruner thread, which stops with the reaper'''
+        while not self.reaper_stopped.wait(TOMBSTONE_PRUNE_INTERVAL):
+            try:
+                pruned = self.prune_tombstones()
+            except sqlite3.Error:
+                logger.exception("Could not prune deletion tombstones")
+                continue
+            if pruned:
+                logger.info("Pruned %d deletion tombstones", pruned)
+
+    def prune_tombstones(self):
+        '''
+        Drops the deletion tombstones older than each shard's last tombstone_retention changes, and
+        returns how many. Shards with none to drop are only read
+        '''
+        def prune(horizon):
+            def write(db):
+                seqs = [seq for seq, in db.execute(
+                    "SELECT Seq FROM MessageEvents WHERE Kind = 'delete' AND Seq <= ? ORDER BY Seq LIMIT ?",
+                    (horizon, TOMBSTONE_PRUNE_BATCH))]
+                if seqs:
+                    db.execute("DELETE FROM MessageEvents WHERE Kind = 'delete' AND Seq <= ?", (seqs[-1],))
+                    db.execute("UPDATE MessageEventsPruned SET Seq = ? WHERE Id = 1 AND Seq < ?", (seqs[-1], seqs[-1]))
+                return len(seqs)
+            return write
+        total = 0
+        for pool in self.messages.pools:
+            connection = pool.connection()
+            latest = connection.execute("SELECT MAX(Seq) FROM MessageEvents").fetchone()[0] or 0
+            horizon = latest - self.tombstone_retention
+            oldest = connection.execute("SELECT Seq FROM MessageEvents WHERE Kind = 'delete' AND Seq <= ? ORDER BY Seq LIMIT ?",
+                                        (horizon, 1)).fetchone()
+            if oldest is None:
+                continue
+            # One batch per commit, so that a large backlog does not hold up the writer
+            while True:
+                pruned = pool.write(prune(horizon))
+                total += pruned
+                if pruned < TOMBSTONE_PRUNE_BATCH:
+                    break
+        return total
+
     # User Account Management
     
     def CheckUsername(self, request, context):
-        print(f"Checking Username given {request}")
+        log_request("CheckUsername", request)
         if not request.username:
             return chat_pb2.CheckUsernameResponse(status=chat_pb2.Status.ERROR)
-        self.passwords_cursor.execute("SELECT Username FROM Passwords WHERE Username = ?", (request.username,))
-        result = self.passwords_cursor.fetchone()
-        status = chat_pb2.Status.MATCH if result else chat_pb2.Status.NO_MATCH
+        status = chat_pb2.Status.MATCH if self.users.contains(request.username) else chat_pb2.Status.NO_MATCH
         return chat_pb2.CheckUsernameResponse(status=status)
 
     def CheckPassword(self, request, context):
-        print(f"Checking Password given {request}")
+        log_request("CheckPassword", request)
         if not request.username or not request.password:
             return chat_pb2.CheckPasswordResponse(status=chat_pb2.Status.ERROR)
-        self.passwords_cursor.execute("SELECT Password FROM Passwords WHERE Username = ?", (request.username,))
-        result = self.passwords_cursor.fetchone()
-        print(f"Got: {result}")
-        status = chat_pb2.Status.MATCH if (str(result[0]) == str(request.password)) else chat_pb2.Status.NO_MATCH
-        return chat_pb2.CheckPasswordResponse(status=status)
+        if not self.password_matches(request.username, request.password):
+            return chat_pb2.CheckPasswordResponse(status=chat_pb2.Status.NO_MATCH)
+        return chat_pb2.CheckPasswordResponse(status=chat_pb2.Status.MATCH, session_token=self.sessions.issue(request.username))
+
+    def password_matches(self, username, password):
+        passwords = self.passwords.connection()
+        result = passwords.execute("SELECT Password FROM Passwords WHERE Username = ?", (username,)).fetchone()
+        logger.debug("Password check found user %s: %s", username, result is not None)
+        return result is not None and str(result[0]) == str(password)
 
     def CreateUser(self, request, context):
-        print(f"Creating user given {request}")
+        log_request("CreateUser", request)
         if not request.username or not request.password:
             return chat_pb2.CreateUserResponse(status=chat_pb2.Status.ERROR)
+        # Taken usernames are turned away without queueing a write
+        if self.users.contains(request.username):
+            return chat_pb2.CreateUserResponse(status=chat_pb2.Status.MATCH)
+        def create_user(db):
+            db.execute("INSERT INTO Passwords (Username, Password) VALUES (?, ?)", (request.username, request.password))
+            self.users.add(db, request.username)
         try:
-            self.passwords_cursor.execute("INSERT INTO Passwords (Username, Password) VALUES (?, ?)", (request.username, request.password))
-            self.passwords.commit()
+            self.passwords.write(create_user)
             return chat_pb2.CreateUserResponse(status=chat_pb2.Status.SUCCESS)
         except sqlite3.IntegrityError:
             return chat_pb2.CreateUserResponse(status=chat_pb2.Status.MATCH)
+        except sqlite3.Error:
+            # The batch failed to commit after the directory had already been told
+            self.users.remove(request.username)
+            return chat_pb2.CreateUserResponse(status=chat_pb2.Status.ERROR)
 
     def ConfirmLogin(self, request, context):
-        print(f"Confirming Login given {request}")
+        log_request("ConfirmLogin", request)
         if not request.username:
             return chat_pb2.ConfirmLoginResponse(
             status=chat_pb2.Status.ERROR, 
             num_unread_msgs=0, 
             num_total_msgs=0)
-        elif request.username in self.online_username:
+        if not self.mark_online(request.username):
             return chat_pb2.ConfirmLoginResponse(
             status=chat_pb2.Status.MATCH, 
             num_unread_msgs=0, 
             num_total_msgs=0)
         else:
-            self.online_username[request.username] = queue.Queue()
-
-            self.messages_cursor.execute(
-            "SELECT COUNT(*) FROM Messages WHERE Recipient = ? AND Read = 0;", (request.username,))
-            unread = self.messages_cursor.fetchone()[0]
-            self.messages_cursor.execute(
-                "SELECT COUNT(*) FROM Messages WHERE Recipient = ?", (request.username,))
-            total = self.messages_cursor.fetchone()[0]
+            total, unread = self.inbox_counts(request.username)
+            # Clients that log in without CheckPassword are only let through when sessions are not required
+            token = session_token(context)
+            if self.sessions.username(token) != request.username:
+                token = self.sessions.issue(request.username)
             return chat_pb2.ConfirmLoginResponse(
                 status=chat_pb2.Status.SUCCESS, 
                 num_unread_msgs=unread, 
-                num_total_msgs=total
+                num_total_msgs=total,
+                session_token=token
             )
 
+    def mark_online(self, username):
+        '''Gives username a delivery queue and returns True, or returns False if they are already online'''
+        with self.online_lock:
+            if username in self.online_username:
+                return False
+            self.online_username[username] = self.delivery_queue()
+            self.presence.renew(username)
+            for watcher in self.presence_watchers:
+                watcher.changed(username, True)
+            # Queued under the lock, so that a logout right after is written after it
+            if self.primary:
+                online = self.passwords.write_async(
+                    lambda db: db.execute("INSERT OR IGNORE INTO OnlineUsers (Username) VALUES (?)", (username,)))
+        if self.primary:
+            online.result()
+        return True
+
+    def Login(self, request, context):
+        log_request("Login", request)
+        if not request.username or not request.password:
+            return chat_pb2.LoginResponse(status=chat_pb2.Status.ERROR)
+        if not self.password_matches(request.username, request.password):
+            return chat_pb2.LoginResponse(status=chat_pb2.Status.NO_MATCH)
+        if not self.mark_online(request.username):
+            return chat_pb2.LoginResponse(status=chat_pb2.Status.MATCH)
+        total, unread = self.inbox_counts(request.username)
+        response = chat_pb2.LoginResponse(status=chat_pb2.Status.SUCCESS, session_token=self.sessions.issue(request.username),
+                                          num_unread_msgs=unread, num_total_msgs=total)
+        if request.message_limit > 0:
+            page = self.message_page(chat_pb2.GetMessageRequest(
+                username=request.username, limit=request.message_limit, unread_only=request.unread_only))
+            response.messages.extend(page.messages)
+            response.messages_next_page_token = page.next_page_token
+        if request.users_limit > 0:
+            users_request = chat_pb2.GetUsersRequest(prefix=request.users_prefix, limit=request.users_limit)
+            # Every node only knows its own users
+            if self.cluster is not None:
+                page = self.cluster.GetUsers(users_request, timeout=CLUSTER_FORWARD_TIMEOUT)
+            else:
+                page = self.users_page(users_request)
+            response.users.extend(page.users)
+            response.users_next_page_token = page.next_page_token
+        return response
+
+    def mark_offline(self, choose):
+        '''Logs out the users choose() returns, calling it under online_lock, and returns those that were online'''
+        with self.online_lock:
+            usernames = [username for username in choose() if username in self.online_username]
+            delivery_queues = [self.online_username.pop(username) for username in usernames]
+            for username in usernames:
+                self.presence.end(username)
+                for watcher in self.presence_watchers:
+                    watcher.changed(username, False)
+            # Queued under the lock, so that a login right after is written after it
+            if self.primary and usernames:
+                offline = self.passwords.write_async(lambda db: db.executemany(
+                    "DELETE FROM OnlineUsers WHERE Username = ?", [(username,) for username in usernames]))
+        if self.primary and usernames:
+            offline.result()
+        for delivery_queue in delivery_queues:
+            # Wake up any subscription stream so that it can end
+            delivery_queue.put(None)
+        return usernames
+
+    def reap_presence(self):
+        '''Runs on the reaper thread, logging out users whose lease has run out'''
+        while not self.reaper_stopped.wait(self.presence.bucket):
+            try:
+                reaped = self.mark_offline(self.presence.expired)
+            except sqlite3.Error:
+                logger.exception("Could not record reaped users as offline")
+                continue
+            if reaped:
+                logger.info("Logged out %d users whose lease ran out", len(reaped))
+
+    def deliver(self, delivery_queue, message):
+        '''Queues message for a subscription stream, unless the queue is full: it is in the inbox for the next sync either way'''
+        if delivery_queue.qsize() < DELIVERY_QUEUE_LIMIT:
+            delivery_queue.put(message)
+
     def ConfirmLogout(self, request, context):
-        print(f"Confirming Logout given {request}")
-        if request.username in self.online_username:
-            del self.online_username[request.username]
+        log_request("ConfirmLogout", request)
+        self.mark_offline(lambda: [request.username])
+        token = session_token(context)
+        if self.sessions.username(token) == request.username:
+            self.sessions.revoke(token)
         return chat_pb2.ConfirmLogoutResponse(status=chat_pb2.Status.SUCCESS)
 
     def GetOnlineUsers(self, request, context):
-        print(f"Getting Online Users")
-        return chat_pb2.GetOnlineUsersResponse(status=chat_pb2.Status.SUCCESS, users=list(self.online_username.keys()))
+        log_request("GetOnlineUsers", request)
+        status = self.stale_status(request.min_commit_token)
+        if status is not None:
+            return chat_pb2.GetOnlineUsersResponse(status=status)
+        if self.replica is not None:
+            # Only the primary knows who is online; it keeps OnlineUsers up to date for its replicas
+            users = [row[0] for row in self.passwords.connection().execute("SELECT Username FROM OnlineUsers")]
+            return chat_pb2.GetOnlineUsersResponse(status=chat_pb2.Status.SUCCESS, users=users)
+        with self.online_lock:
+            users = list(self.online_username.keys())
+        return chat_pb2.GetOnlineUsersResponse(status=chat_pb2.Status.SUCCESS, users=users)
+
+    def Heartbeat(self, request, context):
+        log_request("Heartbeat", request)
+        with self.online_lock:
+            online = request.username in self.online_username
+            if online:
+                self.presence.renew(request.username)
+        if not online:
+            return chat_pb2.HeartbeatResponse(status=chat_pb2.Status.NO_MATCH)
+        return chat_pb2.HeartbeatResponse(status=chat_pb2.Status.SUCCESS, lease_seconds=self.presence.lease)
+
+    def watch_presence(self):
+        '''Starts a WatchPresence stream, returning its PresenceWatcher and the snapshot update to send first'''
+        watcher = PresenceWatcher(self.delivery_queue())
+        with self.online_lock:
+            users = sorted(self.online_username)
+            self.presence_watchers.add(watcher)
+        return watcher, chat_pb2.PresenceUpdate(snapshot=True, joined=users)
+
+    def presence_update(self, watcher):
+        with self.online_lock:
+            return watcher.update()
+
+    def unwatch_presence(self, watcher):
+        with self.online_lock:
+            self.presence_watchers.discard(watcher)
+
+    def WatchPresence(self, request, context):
+        '''
+        Only GRPCAioServer.py serves WatchPresence. Here each stream would hold a worker thread on top of the
+        one its user's SubscribeMessages stream already holds
+        '''
+        log_request("WatchPresence", request)
+        context.abort(grpc.StatusCode.UNIMPLEMENTED, "WatchPresence is only served by GRPCAioServer.py; call GetOnlineUsers instead")
 
     def GetUsers(self, request, context):
-        print(f"Getting Users given {request}")
-        self.passwords_cursor.execute("SELECT Username FROM Passwords WHERE Username Like ?", (request.query, ))
-        result = self.passwords_cursor.fetchall()
+        log_request("GetUsers", request)
+        status = self.stale_status(request.min_commit_token)
+        if status is not None:
+            return chat_pb2.GetUsersResponse(status=status)
+        if request.limit > 0:
+            return self.users_page(request)
+        passwords = self.passwords.connection()
+        result = passwords.execute("SELECT Username FROM Passwords WHERE Username Like ?", (request.query, )).fetchall()
         final_result = [username[0] for username in result]
         return chat_pb2.GetUsersResponse(status=chat_pb2.Status.SUCCESS, users=final_result)
+
+    def users_page(self, request):
+        '''Answers a GetUsers request for a page of request.limit names'''
+        try:
+            after = decode_users_page_token(request.page_token) if request.page_token else ""
+        except ValueError:
+            return chat_pb2.GetUsersResponse(status=chat_pb2.Status.ERROR)
+        # Ask for one extra name to learn whether another page follows
+        users = self.users.search(request.prefix, after, request.limit + 1)
+        next_page_token = encode_users_page_token(users[request.limit - 1]) if len(users) > request.limit else ""
+        return chat_pb2.GetUsersResponse(status=chat_pb2.Status.SUCCESS, users=users[:request.limit], next_page_token=next_page_token)
     
     # Messages
 
     def SendMessage(self, request, context):
-        print(f"Sending Message given {request}")
-        self.passwords_cursor.execute("SELECT Username FROM Passwords WHERE Username = ?", (request.message.recipient,))
-        result = self.passwords_cursor.fetchall()
-        if not result:
+        log_request("SendMessage", request)
+        if request.recipients:
+            return self.send_multicast(request, context)
+        owner = self.owner(request.message.recipient)
+        if owner is not None:
+            return self.forward(owner, request, context).result()
+        if not self.users.contains(request.message.recipient):
             return chat_pb2.SendMessageResponse(status=chat_pb2.Status.NO_MATCH)
+        shard = self.messages.shard(request.message.recipient)
         try:
-            self.messages_cursor.execute(
+            local_id = self.messages.pools[shard].write(lambda db: db.execute(
                 "INSERT INTO Messages (Sender, Recipient, Time_sent, Read, Subject, Body) VALUES (?, ?, ?, ?, ?, ?)",
                 (request.message.sender, request.message.recipient, request.message.time_sent, 
-                 int(request.message.read), request.message.subject, request.message.body)
-            )
-            request.message.id = self.messages_cursor.lastrowid
-            self.messages.commit()
-            if request.message.recipient in self.online_username:
-                self.online_username[request.message.recipient].put(request.message)
+                 int(request.message.read), request.message.subject, compress_body(request.message.body, self.body_compression_threshold))
+            ).lastrowid)
+            request.message.id = self.messages.global_id(shard, local_id)
+            with self.online_lock:
+                delivery_queue = self.online_username.get(request.message.recipient)
+            if delivery_queue is not None:
+                self.deliver(delivery_queue, request.message)
             return chat_pb2.SendMessageResponse(status=chat_pb2.Status.SUCCESS)
         except sqlite3.IntegrityError:
             return chat_pb2.SendMessageResponse(status=chat_pb2.Status.ERROR)
 
+    def forward(self, owner, request, context):
+        '''
+        Passes a SendMessage on to the node owning its recipients and returns a Future for the response.
+        A request that was already forwarded is not passed on again: the nodes disagree about who owns whom
+        '''
+        if is_forwarded(context, self.cluster_secret):
+            logger.warning("Not forwarding SendMessage to %s a second time; check every node has the same --cluster", owner)
+            future = futures.Future()
+            future.set_result(chat_pb2.SendMessageResponse(status=chat_pb2.Status.ERROR))
+            return future
+        return self.cluster.stubs[owner].SendMessage.future(request, metadata=forwarded_metadata(self.cluster_secret),
+                                                            timeout=CLUSTER_FORWARD_TIMEOUT)
+
+    def send_multicast(self, request, context):
+        '''
+        Sends a copy of request.message to every one of request.recipients with one lookup and one write per shard.
+        In a cluster, recipients on other nodes are forwarded to them, one request per node
+        '''
+        recipients = list(dict.fromkeys(request.recipients))
+        remote = {}
+        for recipient in recipients:
+            owner = self.owner(recipient)
+            if owner is not None:
+                remote.setdefault(owner, []).append(recipient)
+        forwarded = {owner: self.forward(owner, chat_pb2.SendMessageRequest(message=request.message, recipients=others), context)
+                     for owner, others in remote.items()}
+        known = self.users.existing([recipient for recipient in recipients if self.owner(recipient) is None])
+        by_shard = {}
+        for recipient in recipients:
+            if recipient in known:
+                by_shard.setdefault(self.messages.shard(recipient), []).append(recipient)
+        message = request.message
+        body = compress_body(message.body, self.body_compression_threshold)
+        def insert_copies(found):
+            def insert(db):
+                db.executemany(
+                    "INSERT INTO Messages (Sender, Recipient, Time_sent, Read, Subject, Body) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(message.sender, recipient, message.time_sent, int(message.read), message.subject, body)
+                     for recipient in found])
+                # The writer is the only one inserting, so the copies got consecutive ids ending at the last one
+                return db.execute("SELECT last_insert_rowid()").fetchone()[0] - len(found) + 1
+            return insert
+        outcomes = self.messages.write_each({shard: insert_copies(found) for shard, found in by_shard.items()})
+        ids, failed = {}, set()
+        for shard, outcome in outcomes.items():
+            error = outcome.exception()
+            if error is not None:
+                # Copies to other shards may have committed, so a storage error only fails this shard's recipients
+                if not isinstance(error, sqlite3.Error):
+                    raise error
+                failed.update(by_shard[shard])
+                continue
+            for i, recipient in enumerate(by_shard[shard]):
+                ids[recipient] = self.messages.global_id(shard, outcome.result() + i)
+
+        with self.online_lock:
+            delivery_queues = [(recipient, self.online_username[recipient]) for recipient in ids if recipient in self.online_username]
+        for recipient, delivery_queue in delivery_queues:
+            copy = chat_pb2.MessageObject()
+            copy.CopyFrom(message)
+            copy.id = ids[recipient]
+            copy.recipient = recipient
+            self.deliver(delivery_queue, copy)
+
+        remote_statuses = {}
+        for owner, future in forwarded.items():
+            try:
+                remote_statuses.update((status.recipient, status) for status in future.result().recipient_statuses)
+            except grpc.RpcError:
+                failed.update(remote[owner])
+        def recipient_status(recipient):
+            if recipient in remote_statuses:
+                return remote_statuses[recipient]
+            if recipient in ids:
+                return chat_pb2.RecipientStatus(recipient=recipient, status=chat_pb2.Status.SUCCESS, message_id=ids[recipient])
+            if recipient in failed:
+                return chat_pb2.RecipientStatus(recipient=recipient, status=chat_pb2.Status.ERROR)
+            return chat_pb2.RecipientStatus(recipient=recipient, status=chat_pb2.Status.NO_MATCH)
+        statuses = [recipient_status(recipient) for recipient in recipients]
+        outcomes = {status.status for status in statuses}
+        status = next((status for status in (chat_pb2.Status.SUCCESS, chat_pb2.Status.ERROR) if status in outcomes), chat_pb2.Status.NO_MATCH)
+        return chat_pb2.SendMessageResponse(status=status, recipient_statuses=statuses)
+
     def GetMessage(self, request, context):
-        print(f"Getting Message given {request}")
-        if request.unread_only:
-            self.messages_cursor.execute(
-                "SELECT * FROM Messages WHERE Recipient = ? AND Read = 0 ORDER BY Time_sent DESC LIMIT ? OFFSET ?;",
-                (request.username, request.limit, request.offset)
+        log_request("GetMessage", request)
+        status = self.stale_status(request.min_commit_token)
+        if status is not None:
+            return chat_pb2.GetMessageResponse(status=status)
+        return self.message_page(request)
+
+    def message_page(self, request):
+        '''Answers a GetMessage request from this server's copy of the inbox'''
+        shard = self.messages.shard(request.username)
+        messages = self.messages.pools[shard].connection()
+        unread_filter = " AND Read = 0" if request.unread_only else ""
+        if request.page_token:
+            try:
+                time_sent, message_id = decode_page_token(request.page_token)
+            except ValueError:
+                return chat_pb2.GetMessageResponse(status=chat_pb2.Status.ERROR)
+            token_shard, message_id = self.messages.local_id(message_id)
+            if token_shard != shard:
+                return chat_pb2.GetMessageResponse(status=chat_pb2.Status.ERROR)
+            # Seek straight past the last message of the previous page, so every page costs the same
+            cursor = messages.execute(
+                f"SELECT * FROM Messages WHERE Recipient = ?{unread_filter} AND (Time_sent, Id) < (?, ?) ORDER BY Time_sent DESC, Id DESC LIMIT ?;",
+                (request.username, time_sent, message_id, request.limit)
             )
         else:
-            self.messages_cursor.execute(
-                "SELECT * FROM Messages WHERE Recipient = ? ORDER BY Time_sent DESC LIMIT ? OFFSET ?;",
+            cursor = messages.execute(
+                f"SELECT * FROM Messages WHERE Recipient = ?{unread_filter} ORDER BY Time_sent DESC, Id DESC LIMIT ? OFFSET ?;",
                 (request.username, request.limit, request.offset)
             )
-        result = self.messages_cursor.fetchall()
+        result = cursor.fetchall()
         messages = []
         for tuple in result:
             messages.append(chat_pb2.MessageObject(
-            id = int(tuple[0]),
+            id = self.messages.global_id(shard, tuple[0]),
+            sender = tuple[1],
+            recipient = tuple[2],
+            time_sent = tuple[3],
+            read = bool(tuple[4]),
+            subject = tuple[5],
+            body = decompress_body(tuple[6])))
+        # A full page may have more after it; a short (or unlimited) one is the last
+        next_page_token = ""
+        if request.limit > 0 and len(result) == request.limit:
+            next_page_token = encode_page_token(result[-1][3], self.messages.global_id(shard, result[-1][0]))
+        return chat_pb2.GetMessageResponse(status=chat_pb2.Status.SUCCESS, messages=messages, next_page_token=next_page_token)
+
+    def GetCounts(self, request, context):
+        log_request("GetCounts", request)
+        if not request.username:
+            return chat_pb2.GetCountsResponse(status=chat_pb2.Status.ERROR)
+        status = self.stale_status(request.min_commit_token)
+        if status is not None:
+            return chat_pb2.GetCountsResponse(status=status)
+        total, unread = self.inbox_counts(request.username)
+        return chat_pb2.GetCountsResponse(status=chat_pb2.Status.SUCCESS, num_unread_msgs=unread, num_total_msgs=total)
+
+    def SyncMessages(self, request, context):
+        log_request("SyncMessages", request)
+        if not request.username or request.since_seq < 0:
+            return chat_pb2.SyncMessagesResponse(status=chat_pb2.Status.ERROR)
+        status = self.stale_status(request.min_commit_token)
+        if status is not None:
+            return chat_pb2.SyncMessagesResponse(status=status)
+        limit = request.limit if request.limit > 0 else SYNC_PAGE_SIZE
+        shard = self.messages.shard(request.username)
+        messages = self.messages.pools[shard].connection()
+        # Read the events and the messages they name from one snapshot, so a message deleted in
+        # between cannot be missing from both
+        messages.execute("BEGIN")
+        try:
+            # Deletion tombstones up to pruned may be gone, so a client that last synced before it could miss some
+            pruned = messages.execute("SELECT Seq FROM MessageEventsPruned WHERE Id = 1").fetchone()[0]
+            if 0 < request.since_seq < pruned:
+                return chat_pb2.SyncMessagesResponse(status=chat_pb2.Status.SUCCESS, resync=True, next_seq=0, has_more=True)
+            events = messages.execute(
+                "SELECT Seq, MessageId, Kind FROM MessageEvents WHERE Recipient = ? AND Seq > ? ORDER BY Seq LIMIT ?",
+                (request.username, request.since_seq, limit)).fetchall()
+            # Keep only each message's last change: an insert then a read is just the (read) message
+            inserted, deleted, read = set(), set(), set()
+            for _, message_id, kind in events:
+                if kind == "insert":
+                    inserted.add(message_id)
+                elif kind == "delete":
+                    inserted.discard(message_id)
+                    read.discard(message_id)
+                    deleted.add(message_id)
+                elif message_id not in inserted:
+                    read.add(message_id)
+            result = messages.execute(
+                "SELECT * FROM Messages WHERE Recipient = ? AND Id IN (SELECT value FROM json_each(?))",
+                (request.username, json.dumps(sorted(inserted)))).fetchall()
+        finally:
+            messages.rollback()
+        added = []
+        for tuple in sorted(result, key=lambda row: (row[3], row[0]), reverse=True):
+            added.append(chat_pb2.MessageObject(
+            id = self.messages.global_id(shard, tuple[0]),
             sender = tuple[1],
             recipient = tuple[2],
             time_sent = tuple[3],
             read = bool(tuple[4]),
             subject = tuple[5],
-            body = tuple[6]))
-        return chat_pb2.GetMessageResponse(status=chat_pb2.Status.SUCCESS, messages=messages)
+            body = decompress_body(tuple[6])))
+        next_seq = events[-1][0] if events else request.since_seq
+        # Seq numbers are per shard, but an inbox never leaves its shard, so they still order its changes
+        return chat_pb2.SyncMessagesResponse(status=chat_pb2.Status.SUCCESS, messages=added,
+                                             deleted_ids=[self.messages.global_id(shard, id) for id in sorted(deleted)],
+                                             read_ids=[self.messages.global_id(shard, id) for id in sorted(read)],
+                                             next_seq=next_seq, has_more=len(events) == limit)
 
     def ConfirmRead(self, request, context):
-        print(f"Confirming Read given {request}")
-        if not request.username or not request.message_id:
+        log_request("ConfirmRead", request)
+        message_ids = list(request.message_ids)
+        if request.message_id:
+            message_ids.append(request.message_id)
+        if not request.username or not (message_ids or request.up_to_id):
             return chat_pb2.ConfirmReadResponse(status=chat_pb2.Status.ERROR)
-        self.messages_cursor.execute(f"UPDATE Messages SET Read = 1 WHERE Recipient = ? AND Id = ?", (request.username, request.message_id,))
-        self.messages.commit()
-        return chat_pb2.ConfirmReadResponse(status=chat_pb2.Status.SUCCESS)
+        # Only ids in the user's shard can be in their inbox
+        shard = self.messages.shard(request.username)
+        message_ids = [local_id for message_shard, local_id in map(self.messages.local_id, message_ids) if message_shard == shard]
+        # The largest Id in this shard whose global id is at most up_to_id
+        up_to_id = (request.up_to_id - shard) // self.messages.count if request.up_to_id else 0
+        def mark_read(db):
+            # Already read messages are skipped, so num_marked only counts messages this call changed
+            marked = 0
+            if message_ids:
+                marked += db.execute(
+                    "UPDATE Messages SET Read = 1 WHERE Recipient = ? AND Read = 0 AND Id IN (SELECT value FROM json_each(?))",
+                    (request.username, json.dumps(message_ids))).rowcount
+            if up_to_id > 0:
+                marked += db.execute(
+                    "UPDATE Messages SET Read = 1 WHERE Recipient = ? AND Read = 0 AND Id <= ?",
+                    (request.username, up_to_id)).rowcount
+            return marked
+        marked = self.messages.pools[shard].write(mark_read)
+        return chat_pb2.ConfirmReadResponse(status=chat_pb2.Status.SUCCESS, num_marked=marked)
+
+    def SearchMessages(self, request, context):
+        log_request("SearchMessages", request)
+        expression = search_expression(request.username, request.query)
+        if expression is None:
+            return chat_pb2.SearchMessagesResponse(status=chat_pb2.Status.ERROR)
+        offset = 0
+        if request.page_token:
+            try:
+                offset = decode_search_page_token(request.page_token)
+            except ValueError:
+                return chat_pb2.SearchMessagesResponse(status=chat_pb2.Status.ERROR)
+        limit = request.limit if request.limit > 0 else SEARCH_PAGE_SIZE
+        # Ranking scores every hit whatever the page, so a page is simply an offset into the ranking.
+        # One extra row tells whether another page follows
+        shard = self.messages.shard(request.username)
+        result = self.messages.pools[shard].connection().execute(
+            "SELECT Messages.* FROM MessagesSearch JOIN Messages ON Messages.Id = MessagesSearch.rowid " +
+            "WHERE MessagesSearch MATCH ? AND Messages.Recipient = ? ORDER BY MessagesSearch.rank LIMIT ? OFFSET ?",
+            (expression, request.username, limit + 1, offset)).fetchall()
+        messages = []
+        for tuple in result[:limit]:
+            messages.append(chat_pb2.MessageObject(
+            id = self.messages.global_id(shard, tuple[0]),
+            sender = tuple[1],
+            recipient = tuple[2],
+            time_sent = tuple[3],
+            read = bool(tuple[4]),
+            subject = tuple[5],
+            body = decompress_body(tuple[6])))
+        next_page_token = encode_search_page_token(offset + limit) if len(result) > limit else ""
+        return chat_pb2.SearchMessagesResponse(status=chat_pb2.Status.SUCCESS, messages=messages, next_page_token=next_page_token)
 
     def DeleteMessage(self, request, context):
-        print(f"Deleting Message given {request}")
+        log_request("DeleteMessage", request)
         if len(request.message_id) == 0:
             return chat_pb2.DeleteMessageResponse(status=chat_pb2.Status.ERROR)
-        format = ','.join('?' for _ in request.message_id)
-        values = []
+        by_shard = {}
         for id in request.message_id:
-            values.append(int(id))
-        self.messages_cursor.execute(f"DELETE FROM Messages WHERE Id IN ({format})", values)
-        self.messages.commit()
+            shard, local_id = self.messages.local_id(int(id))
+            by_shard.setdefault(shard, []).append(local_id)
+        recipient_filter = ""
+        if request.username:
+            # Only the user's own messages, which are all in their shard
+            shard = self.messages.shard(request.username)
+            by_shard = {shard: by_shard[shard]} if shard in by_shard else {}
+            recipient_filter = " AND Recipient = ?"
+        def delete_messages(values):
+            format = ','.join('?' for _ in values)
+            parameters = values + [request.username] if recipient_filter else values
+            return lambda db: db.execute(f"DELETE FROM Messages WHERE Id IN ({format}){recipient_filter}", parameters)
+        # Ids spanning shards are deleted by each shard's writer at once
+        for outcome in self.messages.write_each({shard: delete_messages(values) for shard, values in by_shard.items()}).values():
+            outcome.result()
         return chat_pb2.DeleteMessageResponse(status=chat_pb2.Status.SUCCESS)
 
+    def is_local_sender(self, sender, shard):
+        '''Returns whether a message can be returned to sender by updating it in place in shard'''
+        return self.owner(sender) is None and self.messages.shard(sender) == shard
+
+    def return_to_senders(self, shard, rows):
+        '''
+        Copies unread (Sender, Time_sent, Subject, Body) rows from shard back to senders in other shards
+        or on other nodes, marked NOT SENT
+        '''
+        returned = {}
+        for sender, time_sent, subject, body in rows:
+            if self.is_local_sender(sender, shard):
+                continue
+            owner = self.owner(sender)
+            if owner is not None:
+                message = chat_pb2.MessageObject(sender=sender, recipient=sender, time_sent=time_sent,
+                                                 subject="NOT SENT " + subject, body=decompress_body(body))
+                try:
+                    self.cluster.stubs[owner].SendMessage(chat_pb2.SendMessageRequest(message=message),
+                                                          metadata=forwarded_metadata(self.cluster_secret), timeout=CLUSTER_FORWARD_TIMEOUT)
+                except grpc.RpcError as e:
+                    logger.warning("Could not return a message to %s on %s: %s", sender, owner, e.code())
+                continue
+            returned.setdefault(self.messages.shard(sender), []).append((sender, sender, time_sent, "NOT SENT " + subject, body))
+        def insert_returned(rows):
+            return lambda db: db.executemany(
+                "INSERT INTO Messages (Sender, Recipient, Time_sent, Read, Subject, Body) VALUES (?, ?, ?, 0, ?, ?)", rows)
+        for outcome in self.messages.write_each({sender_shard: insert_returned(rows) for sender_shard, rows in returned.items()}).values():
+            outcome.result()
+
     def DeleteUser(self, request, context):
-        print(f"Deleting User given {request}")
+        log_request("DeleteUser", request)
         if not request.username:
             return chat_pb2.DeleteUserResponse(status=chat_pb2.Status.ERROR)
-        self.messages_cursor.execute("UPDATE Messages SET Recipient = Sender, Subject = 'NOT SENT ' || Subject WHERE Recipient = ? AND Read = 0;", (request.username,))
-        self.messages_cursor.execute("DELETE FROM Messages WHERE Recipient = ?", (request.username,))
-        self.messages.commit()
-        self.passwords_cursor.execute("DELETE FROM Passwords WHERE Username = ?", (request.username,))
-        if self.passwords_cursor.rowcount == 0:
+        shard = self.messages.shard(request.username)
+        move = "UPDATE Messages SET Recipient = Sender, Subject = 'NOT SENT ' || Subject WHERE Recipient = ? AND Read = 0"
+        if self.messages.count == 1 and self.cluster is None:
+            def delete_messages(db):
+                db.execute(move, (request.username,))
+                delete_inbox(db)
+                return []
+        else:
+            # Unread messages go back to their senders. Those whose sender is in another shard or on
+            # another node are copied there before the inbox is deleted, so a failure in between can at worst return
+            # a message twice; the few that arrive in between are copied just after
+            connection = self.messages.pools[shard].connection()
+            last_id = connection.execute("SELECT COALESCE(MAX(Id), 0) FROM Messages").fetchone()[0]
+            self.return_to_senders(shard, connection.execute(
+                "SELECT Sender, Time_sent, Subject, Body FROM Messages WHERE Recipient = ? AND Read = 0 AND Id <= ?",
+                (request.username, last_id)).fetchall())
+            def delete_messages(db):
+                senders = {row[0] for row in db.execute("SELECT Sender FROM Messages WHERE Recipient = ? AND Read = 0",
+                                                         (request.username,))}
+                local = [sender for sender in senders if self.is_local_sender(sender, shard)]
+                db.execute(move + " AND Sender IN (SELECT value FROM json_each(?))", (request.username, json.dumps(local)))
+                late = db.execute("SELECT Sender, Time_sent, Subject, Body FROM Messages WHERE Recipient = ? AND Read = 0 AND Id > ?",
+                                  (request.username, last_id)).fetchall()
+                delete_inbox(db)
+                return late
+        def delete_inbox(db):
+            db.execute("DELETE FROM Messages WHERE Recipient = ?", (request.username,))
+            db.execute("DELETE FROM InboxCounts WHERE Username = ?", (request.username,))
+            db.execute("DELETE FROM MessageEvents WHERE Recipient = ?", (request.username,))
+        self.return_to_senders(shard, self.messages.pools[shard].write(delete_messages))
+        def delete_user(db):
+            deleted = db.execute("DELETE FROM Passwords WHERE Username = ?", (request.username,)).rowcount
+            if deleted:
+                self.users.remove(request.username)
+            return deleted
+        deleted = self.passwords.write(delete_user)
+        if deleted == 0:
             return chat_pb2.DeleteUserResponse(status=chat_pb2.Status.ERROR)
-        self.passwords.commit()
+        self.sessions.revoke_user(request.username)
         return chat_pb2.DeleteUserResponse(status=chat_pb2.Status.SUCCESS)
 
+    # Monitoring
+
+    def GetServerStats(self, request, context):
+        log_request("GetServerStats", request)
+        methods = [chat_pb2.MethodStats(**stats) for stats in self.metrics.snapshot()]
+        return chat_pb2.GetServerStatsResponse(status=chat_pb2.Status.SUCCESS, methods=methods, uptime_seconds=self.metrics.uptime())
+
+    def StartProfiling(self, request, context):
+        log_request("StartProfiling", request)
+        # Anyone else could slow the server down and fill its disk; SIGUSR1 is the other local way in
+        if not is_local(context):
+            return chat_pb2.StartProfilingResponse(status=chat_pb2.Status.ERROR)
+        methods = chat_pb2.DESCRIPTOR.services_by_name["ChatService"].methods_by_name
+        if not 0 < request.calls <= PROFILE_MAX_CALLS or (request.method and request.method not in methods):
+            return chat_pb2.StartProfilingResponse(status=chat_pb2.Status.ERROR)
+        path = self.profiler.arm(request.method, request.calls)
+        if path is None:
+            return chat_pb2.StartProfilingResponse(status=chat_pb2.Status.MATCH)
+        return chat_pb2.StartProfilingResponse(status=chat_pb2.Status.SUCCESS, output_path=str(path))
+
+    # Replication
+
+    def replication_pool(self, database):
+        '''Returns the ConnectionPool a replica asks for by name, or None if this is not a primary or has no such database'''
+        if not self.primary:
+            return None
+        return next((pool for pool in self.databases() if database_name(pool) == database), None)
+
+    def replication_batches(self, pool, since_seq, active):
+        '''Yields the ReplicationBatch messages that bring a replica at since_seq up to date, then new ones as they commit'''
+        seq = since_seq
+        while active():
+            rows = pool.connection().execute("SELECT Seq, Batch FROM ReplicationLog WHERE Seq > ? ORDER BY Seq LIMIT ?",
+                                             (seq, REPLICATION_STREAM_BATCHES)).fetchall()
+            # A new replica, one whose next batches have been trimmed, or one ahead of this primary starts over
+            if seq < 0 or seq > pool.writer.seq or (rows and rows[0][0] != seq + 1):
+                seq, image = snapshot(pool.path)
+                for offset in range(0, len(image), REPLICATION_SNAPSHOT_CHUNK):
+                    yield chat_pb2.ReplicationBatch(seq=seq, snapshot=image[offset:offset + REPLICATION_SNAPSHOT_CHUNK],
+                                                    last_chunk=offset + REPLICATION_SNAPSHOT_CHUNK >= len(image))
+                continue
+            for seq, batch in rows:
+                yield chat_pb2.ReplicationBatch(seq=seq, statements=batch)
+            if not rows:
+                pool.writer.wait_for_commit(seq, SUBSCRIPTION_POLL_INTERVAL)
+
+    def Replicate(self, request, context):
+        log_request("Replicate", request)
+        if not is_replica(context, self.replication_secret):
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, "Replicate needs the replication secret")
+        pool = self.replication_pool(request.database)
+        if pool is None:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, f"Not a primary with a database {request.database!r}")
+        if self.stream_slots is not None and not self.stream_slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          f"This server streams to at most {self.max_streams} users and replicas at once")
+        try:
+            yield from self.replication_batches(pool, request.since_seq, context.is_active)
+        finally:
+            if self.stream_slots is not None:
+                self.stream_slots.release()
+
+    # Live Delivery
+
+    def SubscribeMessages(self, request, context):
+        log_request("SubscribeMessages", request)
+        with self.online_lock:
+            delivery_queue = self.online_username.get(request.username)
+        if delivery_queue is None or not self.authorized(request.username, context):
+            return
+        if self.stream_slots is not None and not self.stream_slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          f"This server streams to at most {self.max_streams} users at once; GRPCAioServer.py has no such limit")
+        # The user stays online for as long as the stream is open
+        self.presence.stream_opened(request.username)
+        try:
+            # Stream until the client cancels or the user logs out (which replaces or removes the queue)
+            while context.is_active():
+                with self.online_lock:
+                    if self.online_username.get(request.username) is not delivery_queue:
+                        return
+                try:
+                    message = delivery_queue.get(timeout=SUBSCRIPTION_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            if self.stream_slots is not None:
+                self.stream_slots.release()
+            self.presence.stream_closed(request.username)
+
 if __name__ == '__main__':
-     # Confirm validity of commandline arguments
-    if len(sys.argv) != 3:
-        print("Usage: python server.py HOSTNAME DATABASE_PORTNAME")
-        sys.exit(1)
-    host, port = sys.argv[1], sys.argv[2]
-
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    chat_pb2_grpc.add_ChatServiceServicer_to_server(ChatServiceServicer(), server)
+    parser = argparse.ArgumentParser(description="Run the gRPC chat server")
+    parser.add_argument("host", help="hostname to listen on")
+    parser.add_argument("port", help="port to listen on")
+    parser.add_argument("--max-streams", type=int, default=MAX_STREAMS,
+                        help="most SubscribeMessages and Replicate streams open at once, each holding a worker thread; " +
+                             "later ones fail with RESOURCE_EXHAUSTED")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"number of worker threads, more than --max-streams (defaults to --max-streams + {MAX_WORKERS})")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="directory holding passwords.db and messages.db (defaults to User_Data)")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default=DEFAULT_DURABILITY,
+                        help="full fsyncs every commit, normal only on checkpoints, async never waits on the disk")
+    parser.add_argument("--commit-window", type=float, default=GROUP_COMMIT_WINDOW,
+                        help="seconds the writer waits for concurrent writes to share a commit")
+    parser.add_argument("--profile-dir", type=Path, default=PROFILE_DIRECTORY,
+                        help="directory StartProfiling and SIGUSR1 write .pstats files to")
+    parser.add_argument("--compression", choices=CHANNEL_COMPRESSION, default=DEFAULT_CHANNEL_COMPRESSION,
+                        help="compression applied to responses")
+    parser.add_argument("--body-compression-threshold", type=int, default=BODY_COMPRESSION_THRESHOLD,
+                        help="store message bodies longer than this many bytes compressed (0 disables)")
+    parser.add_argument("--shards", type=int, default=MESSAGE_SHARDS,
+                        help="number of files messages are split across by recipient, each with its own writer")
+    parser.add_argument("--shard-dirs", type=Path, nargs="+", default=None,
+                        help="one directory per shard (e.g. on separate disks), overriding --shards")
+    parser.add_argument("--cluster", nargs="+", default=None, metavar="NODE",
+                        help="HOST:PORT of every node in the cluster, this one included, the same on every node")
+    parser.add_argument("--cluster-secret", default=os.environ.get(CLUSTER_SECRET_VARIABLE),
+                        help="secret shared by every node in the cluster, which marks the calls they forward to each other " +
+                             f"(defaults to ${CLUSTER_SECRET_VARIABLE}, which keeps it out of the process list)")
+    parser.add_argument("--replication-secret", default=os.environ.get(REPLICATION_SECRET_VARIABLE),
+                        help="secret shared by a primary and its replicas, without which Replicate is refused " +
+                             f"(defaults to ${REPLICATION_SECRET_VARIABLE})")
+    replication = parser.add_mutually_exclusive_group()
+    replication.add_argument("--primary", action="store_true",
+                             help="log committed writes so that replicas can follow this server")
+    replication.add_argument("--replica-of", metavar="PRIMARY",
+                             help="HOST:PORT of a primary to copy the databases from and serve reads for")
+    parser.add_argument("--require-sessions", action="store_true",
+                        help="only serve calls acting as a user if they carry that user's session token")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if args.require_sessions and args.replica_of:
+        parser.error("--require-sessions cannot be used with --replica-of: sessions are only known to the server that issued them")
+    if args.cluster and not args.cluster_secret:
+        parser.error(f"--cluster needs --cluster-secret or ${CLUSTER_SECRET_VARIABLE}, the same on every node")
+    if (args.primary or args.replica_of) and not args.replication_secret:
+        parser.error(f"--primary and --replica-of need --replication-secret or ${REPLICATION_SECRET_VARIABLE}, the same on each server")
+    if args.max_streams < 0:
+        parser.error("--max-streams cannot be negative")
+    if args.workers is None:
+        args.workers = args.max_streams + MAX_WORKERS
+    elif args.workers <= args.max_streams:
+        parser.error("--workers must be more than --max-streams, or open streams can leave no thread for any other call")
+    configure_logging_from_args(args)
+    host, port = args.host, args.port
+    servicer = ChatServiceServicer(*database_paths(args.data_dir), durability=args.durability, commit_window=args.commit_window,
+                                   profile_dir=args.profile_dir, body_compression_threshold=args.body_compression_threshold,
+                                   shards=args.shards, shard_dirs=args.shard_dirs,
+                                   cluster_nodes=args.cluster, node=f"{host}:{port}", compression=grpc_compression(args.compression),
+                                   primary=args.primary, replica_of=args.replica_of, require_sessions=args.require_sessions,
+                                   cluster_secret=args.cluster_secret, max_streams=args.max_streams,
+                                   replication_secret=args.replication_secret)
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.workers),
+                         interceptors=[MetricsInterceptor(servicer.metrics), ProfilingInterceptor(servicer.profiler)],
+                         compression=grpc_compression(args.compression))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
     server.add_insecure_port(f"{host}:{port}")
     server.start()
-    print(f"gRPC Server started on {host}:{port}")
+    logger.info("gRPC Server started on %s:%s with %d workers, at most %d streams and %d message shards",
+                host, port, args.workers, args.max_streams, servicer.messages.count)
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
-        server.stop(0)
\ No newline at end of file
+        server.stop(0)
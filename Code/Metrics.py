@@ -0,0 +1,274 @@
+'''
+This file contains the servers' per-RPC metrics: call and status counts, payload sizes,
+latency histograms, and how much of each call was spent in SQLite.
+
+MetricsInterceptor (grpc.server) and AsyncMetricsInterceptor (grpc.aio.server) time every call
+and hand the totals to a ServerMetrics, which GetServerStats reports. SQLite time reaches the
+call through the current_call context variable: connections made with TimedConnection add the
+time spent executing and fetching to it, and ConnectionPool.write adds the time spent waiting
+for its group commit. Context variables follow a call onto the executor in the asyncio server.
+'''
+
+import bisect
+import contextvars
+import sqlite3
+import threading
+import time
+
+import grpc
+
+# Histogram bucket upper bounds in seconds, each a quarter power of two above the last (about
+# 19% apart), from 1 microsecond to roughly 2 minutes
+LATENCY_BUCKETS = [1e-6 * 2 ** (i / 4) for i in range(108)]
+
+# The CallTimer of the RPC running in this context, if any
+current_call = contextvars.ContextVar("current_call", default=None)
+
+class CallTimer:
+    '''Accumulates the SQLite time of one RPC'''
+    def __init__(self):
+        self.sqlite_seconds = 0.0
+
+def add_sqlite_time(seconds):
+    call = current_call.get()
+    if call is not None:
+        call.sqlite_seconds += seconds
+
+class TimedCursor(sqlite3.Cursor):
+    '''Cursor that charges the time spent executing statements and fetching rows to the current call'''
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            add_sqlite_time(time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    '''Connection whose execute() and executemany() shortcuts hand out TimedCursors'''
+    def execute(self, *args):
+        return self.cursor(TimedCursor).execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor(TimedCursor).executemany(*args)
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the given fraction of samples, in seconds'''
+        if self.total == 0:
+            return 0.0
+        rank = fraction * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+        return LATENCY_BUCKETS[-1]
+
+class MethodMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.statuses = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = LatencyHistogram()
+        self.sqlite = LatencyHistogram()
+
+class ServerMetrics:
+    '''Per-method metrics shared by every worker thread'''
+    def __init__(self):
+        self.started = time.monotonic()
+        self.methods = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, seconds, sqlite_seconds, request_bytes, response_bytes, status=None, error=False):
+        with self.lock:
+            metrics = self.methods.get(method)
+            if metrics is None:
+                metrics = self.methods[method] = MethodMetrics()
+            metrics.calls += 1
+            metrics.errors += error
+            if status is not None:
+                metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.request_bytes += request_bytes
+            metrics.response_bytes += response_bytes
+            metrics.latency.record(seconds)
+            metrics.sqlite.record(sqlite_seconds)
+
+    def snapshot(self):
+        '''Returns a list of per-method summaries (times in milliseconds), sorted by method'''
+        with self.lock:
+            return [{
+                "method": method,
+                "calls": metrics.calls,
+                "errors": metrics.errors,
+                "statuses": dict(metrics.statuses),
+                "request_bytes": metrics.request_bytes,
+                "response_bytes": metrics.response_bytes,
+                "p50_ms": metrics.latency.percentile(0.50) * 1000,
+                "p95_ms": metrics.latency.percentile(0.95) * 1000,
+                "p99_ms": metrics.latency.percentile(0.99) * 1000,
+                "total_ms": metrics.latency.sum * 1000,
+                "sqlite_p50_ms": metrics.sqlite.percentile(0.50) * 1000,
+                "sqlite_p99_ms": metrics.sqlite.percentile(0.99) * 1000,
+                "sqlite_total_ms": metrics.sqlite.sum * 1000,
+            } for method, metrics in sorted(self.methods.items())]
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+def response_status(response):
+    '''Returns the name of a response's Status field, if it has one'''
+    status = getattr(response, "status", None)
+    if status is None:
+        return None
+    return type(response).DESCRIPTOR.fields_by_name["status"].enum_type.values_by_number[status].name
+
+def short_name(method):
+    '''"/chat.ChatService/SendMessage" -> "SendMessage"'''
+    return method.rsplit("/", 1)[-1]
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    '''Times every unary and server-streaming call of a grpc.server into metrics'''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = short_name(handler_call_details.method)
+        if handler.unary_unary:
+            return grpc.unary_unary_rpc_method_handler(self.unary(method, handler.unary_unary),
+                                                       handler.request_deserializer, handler.response_serializer)
+        if handler.unary_stream:
+            return grpc.unary_stream_rpc_method_handler(self.stream(method, handler.unary_stream),
+                                                        handler.request_deserializer, handler.response_serializer)
+        return handler
+
+    def unary(self, method, behavior):
+        def timed(request, context):
+            call = CallTimer()
+            token = current_call.set(call)
+            start = time.perf_counter()
+            response, error = None, True
+            try:
+                response = behavior(request, context)
+                error = False
+                return response
+            finally:
+                current_call.reset(token)
+                self.metrics.record(method, time.perf_counter() - start, call.sqlite_seconds, request.ByteSize(),
+                                    response.ByteSize() if response is not None else 0, response_status(response), error)
+        return timed
+
+    def stream(self, method, behavior):
+        def timed(request, context):
+            call = CallTimer()
+            # The worker thread runs the stream to completion, so the call stays current throughout
+            token = current_call.set(call)
+            start = time.perf_counter()
+            sent, error = 0, True
+            try:
+                for response in behavior(request, context):
+                    sent += response.ByteSize()
+                    yield response
+                error = False
+            finally:
+                current_call.reset(token)
+                self.metrics.record(method, time.perf_counter() - start, call.sqlite_seconds, request.ByteSize(), sent, None, error)
+        return timed
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    '''Times every unary and server-streaming call of a grpc.aio.server into metrics'''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = short_name(handler_call_details.method)
+        if handler.unary_unary:
+            return grpc.unary_unary_rpc_method_handler(self.unary(method, handler.unary_unary),
+                                                       handler.request_deserializer, handler.response_serializer)
+        if handler.unary_stream:
+            return grpc.unary_stream_rpc_method_handler(self.stream(method, handler.unary_stream),
+                                                        handler.request_deserializer, handler.response_serializer)
+        return handler
+
+    def unary(self, method, behavior):
+        async def timed(request, context):
+            call = CallTimer()
+            # Each call runs in its own task, so this only affects this call and the executor work it starts
+            current_call.set(call)
+            start = time.perf_counter()
+            response, error = None, True
+            try:
+                response = await behavior(request, context)
+                error = False
+                return response
+            finally:
+                self.metrics.record(method, time.perf_counter() - start, call.sqlite_seconds, request.ByteSize(),
+                                    response.ByteSize() if response is not None else 0, response_status(response), error)
+        return timed
+
+    def stream(self, method, behavior):
+        async def timed(request, context):
+            call = CallTimer()
+            current_call.set(call)
+            start = time.perf_counter()
+            sent, error = 0, True
+            try:
+                async for response in behavior(request, context):
+                    sent += response.ByteSize()
+                    yield response
+                error = False
+            finally:
+                self.metrics.record(method, time.perf_counter() - start, call.sqlite_seconds, request.ByteSize(), sent, None, error)
+        return timed
@@ -0,0 +1,225 @@
+'''
+This file contains the versioned schema migrations for the chat databases.
+
+Each database file records how many of its migrations have been applied in PRAGMA user_version,
+so opening an older file upgrades it in place by running only the missing migrations, each in
+its own transaction. Migrations are append-only: never edit one that has shipped, add a new one.
+
+Usage: python Migrations.py migrate [DATA_DIR]   (upgrade the databases in DATA_DIR, default User_Data)
+       python Migrations.py check [DATA_DIR]     (confirm every hot query is answered from an index)
+'''
+
+import sqlite3
+import sys
+
+from Constants import PASSWORD_DATABASE_SCHEMA, MESSAGES_DATABASE_SCHEMA, DATABASE_BUSY_TIMEOUT
+from Compression import register_sql_functions
+
+PASSWORDS_MIGRATIONS = [
+    # 1: Initial schema
+    [f"CREATE TABLE IF NOT EXISTS {PASSWORD_DATABASE_SCHEMA}"],
+    # 2: Change counter for the username directory snapshot. Generation is random per database
+    # file and Version counts every change to Passwords' usernames, so a snapshot tagged with
+    # both is known to still match the table
+    ["CREATE TABLE UsersVersion (Id INTEGER PRIMARY KEY CHECK (Id = 1), Generation TEXT NOT NULL, Version INTEGER NOT NULL)",
+     "INSERT INTO UsersVersion (Id, Generation, Version) VALUES (1, lower(hex(randomblob(16))), 0)",
+     """CREATE TRIGGER Passwords_Version_Insert AFTER INSERT ON Passwords BEGIN
+            UPDATE UsersVersion SET Version = Version + 1 WHERE Id = 1;
+        END""",
+     """CREATE TRIGGER Passwords_Version_Delete AFTER DELETE ON Passwords BEGIN
+            UPDATE UsersVersion SET Version = Version + 1 WHERE Id = 1;
+        END""",
+     """CREATE TRIGGER Passwords_Version_Update AFTER UPDATE OF Username ON Passwords BEGIN
+            UPDATE UsersVersion SET Version = Version + 1 WHERE Id = 1;
+        END"""],
+    # 3: Replication. ReplicationLog holds the statements of each committed batch on a primary
+    # (see Replication.py), and OnlineUsers mirrors who is logged in there for its replicas
+    ["CREATE TABLE ReplicationLog (Seq INTEGER PRIMARY KEY AUTOINCREMENT, Batch BLOB NOT NULL)",
+     "CREATE TABLE OnlineUsers (Username TEXT PRIMARY KEY) WITHOUT ROWID"],
+]
+
+MESSAGES_MIGRATIONS = [
+    # 1: Initial schema
+    [f"CREATE TABLE IF NOT EXISTS {MESSAGES_DATABASE_SCHEMA}"],
+    # 2: Inbox indexes. Both also end in the implicit rowid, so they cover the unread/total
+    # counts and return a recipient's messages already sorted by Time_sent
+    ["CREATE INDEX IF NOT EXISTS Messages_Recipient_Read_Time ON Messages (Recipient, Read, Time_sent)",
+     "CREATE INDEX IF NOT EXISTS Messages_Recipient_Time ON Messages (Recipient, Time_sent)"],
+    # 3: Per-user total and unread counters. Triggers keep them in step with Messages inside the
+    # writing transaction, so GetCounts and ConfirmLogin read one row instead of counting
+    ["CREATE TABLE InboxCounts (Username TEXT PRIMARY KEY, Total INTEGER NOT NULL DEFAULT 0, " +
+     "Unread INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID",
+     "INSERT INTO InboxCounts (Username, Total, Unread) SELECT Recipient, COUNT(*), SUM(Read = 0) FROM Messages GROUP BY Recipient",
+     """CREATE TRIGGER Messages_Count_Insert AFTER INSERT ON Messages BEGIN
+            INSERT INTO InboxCounts (Username, Total, Unread) VALUES (NEW.Recipient, 1, NEW.Read = 0)
+            ON CONFLICT (Username) DO UPDATE SET Total = Total + 1, Unread = Unread + excluded.Unread;
+        END""",
+     """CREATE TRIGGER Messages_Count_Delete AFTER DELETE ON Messages BEGIN
+            UPDATE InboxCounts SET Total = Total - 1, Unread = Unread - (OLD.Read = 0) WHERE Username = OLD.Recipient;
+        END""",
+     """CREATE TRIGGER Messages_Count_Update AFTER UPDATE OF Recipient, Read ON Messages
+        WHEN OLD.Recipient IS NOT NEW.Recipient OR OLD.Read IS NOT NEW.Read BEGIN
+            UPDATE InboxCounts SET Total = Total - 1, Unread = Unread - (OLD.Read = 0) WHERE Username = OLD.Recipient;
+            INSERT INTO InboxCounts (Username, Total, Unread) VALUES (NEW.Recipient, 1, NEW.Read = 0)
+            ON CONFLICT (Username) DO UPDATE SET Total = Total + 1, Unread = Unread + excluded.Unread;
+        END"""],
+    # 4: Per-recipient change log for SyncMessages. Seq orders every change to a user's inbox.
+    # Deleting or moving a message drops its earlier events, so the log stays about the size of
+    # the live messages plus their tombstones. Old tombstones are pruned: the partial index finds
+    # them without visiting the rest of the log, and MessageEventsPruned records the Seq up to
+    # which they may be gone, so SyncMessages knows which clients have missed some
+    ["CREATE TABLE MessageEvents (Seq INTEGER PRIMARY KEY AUTOINCREMENT, Recipient TEXT NOT NULL, " +
+     "MessageId INTEGER NOT NULL, Kind TEXT NOT NULL)",
+     "CREATE INDEX MessageEvents_Recipient_Seq ON MessageEvents (Recipient, Seq)",
+     "CREATE INDEX MessageEvents_MessageId ON MessageEvents (MessageId)",
+     "CREATE INDEX MessageEvents_Tombstones ON MessageEvents (Seq) WHERE Kind = 'delete'",
+     "CREATE TABLE MessageEventsPruned (Id INTEGER PRIMARY KEY CHECK (Id = 1), Seq INTEGER NOT NULL)",
+     "INSERT INTO MessageEventsPruned (Id, Seq) VALUES (1, 0)",
+     "INSERT INTO MessageEvents (Recipient, MessageId, Kind) SELECT Recipient, Id, 'insert' FROM Messages ORDER BY Id",
+     """CREATE TRIGGER Messages_Event_Insert AFTER INSERT ON Messages BEGIN
+            INSERT INTO MessageEvents (Recipient, MessageId, Kind) VALUES (NEW.Recipient, NEW.Id, 'insert');
+        END""",
+     """CREATE TRIGGER Messages_Event_Delete AFTER DELETE ON Messages BEGIN
+            DELETE FROM MessageEvents WHERE MessageId = OLD.Id;
+            INSERT INTO MessageEvents (Recipient, MessageId, Kind) VALUES (OLD.Recipient, OLD.Id, 'delete');
+        END""",
+     """CREATE TRIGGER Messages_Event_Move AFTER UPDATE OF Recipient ON Messages
+        WHEN OLD.Recipient IS NOT NEW.Recipient BEGIN
+            DELETE FROM MessageEvents WHERE MessageId = OLD.Id;
+            INSERT INTO MessageEvents (Recipient, MessageId, Kind) VALUES (OLD.Recipient, OLD.Id, 'delete');
+            INSERT INTO MessageEvents (Recipient, MessageId, Kind) VALUES (NEW.Recipient, NEW.Id, 'insert');
+        END""",
+     """CREATE TRIGGER Messages_Event_Read AFTER UPDATE OF Read ON Messages
+        WHEN NEW.Read AND NOT OLD.Read AND OLD.Recipient IS NEW.Recipient BEGIN
+            INSERT INTO MessageEvents (Recipient, MessageId, Kind) VALUES (NEW.Recipient, NEW.Id, 'read');
+        END"""],
+    # 5: Full-text index over Subject and Body for SearchMessages. It stores only the index and
+    # reads nothing back from Messages, so bodies are decompressed as they are indexed. Recipient
+    # is indexed too, with no weight in the ranking, so a search only visits one user's messages
+    ["CREATE VIRTUAL TABLE MessagesSearch USING fts5(Recipient, Subject, Body, content='Messages', content_rowid='Id')",
+     "INSERT INTO MessagesSearch (MessagesSearch, rank) VALUES ('rank', 'bm25(0.0, 2.0, 1.0)')",
+     "INSERT INTO MessagesSearch (rowid, Recipient, Subject, Body) SELECT Id, Recipient, Subject, decompress_body(Body) FROM Messages",
+     """CREATE TRIGGER Messages_Search_Insert AFTER INSERT ON Messages BEGIN
+            INSERT INTO MessagesSearch (rowid, Recipient, Subject, Body) VALUES (NEW.Id, NEW.Recipient, NEW.Subject, decompress_body(NEW.Body));
+        END""",
+     """CREATE TRIGGER Messages_Search_Delete AFTER DELETE ON Messages BEGIN
+            INSERT INTO MessagesSearch (MessagesSearch, rowid, Recipient, Subject, Body)
+            VALUES ('delete', OLD.Id, OLD.Recipient, OLD.Subject, decompress_body(OLD.Body));
+        END""",
+     """CREATE TRIGGER Messages_Search_Update AFTER UPDATE OF Recipient, Subject, Body ON Messages
+        WHEN OLD.Recipient IS NOT NEW.Recipient OR OLD.Subject IS NOT NEW.Subject OR OLD.Body IS NOT NEW.Body BEGIN
+            INSERT INTO MessagesSearch (MessagesSearch, rowid, Recipient, Subject, Body)
+            VALUES ('delete', OLD.Id, OLD.Recipient, OLD.Subject, decompress_body(OLD.Body));
+            INSERT INTO MessagesSearch (rowid, Recipient, Subject, Body) VALUES (NEW.Id, NEW.Recipient, NEW.Subject, decompress_body(NEW.Body));
+        END"""],
+    # 6: Replication log, as in passwords.db
+    ["CREATE TABLE ReplicationLog (Seq INTEGER PRIMARY KEY AUTOINCREMENT, Batch BLOB NOT NULL)"],
+]
+
+# Queries on the request path, as (database, sql). Each must be answered by an index search
+# rather than a table scan or a temporary sort
+HOT_QUERIES = [
+    ("passwords", "SELECT Username FROM Passwords WHERE Username = ?"),
+    ("passwords", "SELECT Password FROM Passwords WHERE Username = ?"),
+    ("passwords", "SELECT Username FROM Passwords WHERE Username IN (SELECT value FROM json_each(?))"),
+    ("passwords", "SELECT Username FROM Passwords WHERE Username >= ? AND Username > ? ORDER BY Username LIMIT ?"),
+    ("passwords", "DELETE FROM Passwords WHERE Username = ?"),
+    ("passwords", "SELECT Generation, Version FROM UsersVersion WHERE Id = 1"),
+    ("passwords", "UPDATE UsersVersion SET Version = Version + 1 WHERE Id = 1"),
+    ("passwords", "INSERT OR IGNORE INTO OnlineUsers (Username) VALUES (?)"),
+    ("passwords", "DELETE FROM OnlineUsers WHERE Username = ?"),
+    ("messages", "SELECT Total, Unread FROM InboxCounts WHERE Username = ?"),
+    ("messages", "UPDATE InboxCounts SET Total = Total - 1, Unread = Unread - 1 WHERE Username = ?"),
+    ("messages", "DELETE FROM InboxCounts WHERE Username = ?"),
+    ("messages", "SELECT Seq, MessageId, Kind FROM MessageEvents WHERE Recipient = ? AND Seq > ? ORDER BY Seq LIMIT ?"),
+    ("messages", "SELECT Seq FROM MessageEventsPruned WHERE Id = 1"),
+    ("messages", "SELECT MAX(Seq) FROM MessageEvents"),
+    ("messages", "SELECT Seq FROM MessageEvents WHERE Kind = 'delete' AND Seq <= ? ORDER BY Seq LIMIT ?"),
+    ("messages", "DELETE FROM MessageEvents WHERE Kind = 'delete' AND Seq <= ?"),
+    ("messages", "SELECT * FROM Messages WHERE Recipient = ? AND Id IN (SELECT value FROM json_each(?))"),
+    ("messages", "DELETE FROM MessageEvents WHERE MessageId = ?"),
+    ("messages", "DELETE FROM MessageEvents WHERE Recipient = ?"),
+    ("messages", "SELECT * FROM Messages WHERE Recipient = ? AND Read = 0 ORDER BY Time_sent DESC, Id DESC LIMIT ? OFFSET ?"),
+    ("messages", "SELECT * FROM Messages WHERE Recipient = ? ORDER BY Time_sent DESC, Id DESC LIMIT ? OFFSET ?"),
+    ("messages", "SELECT * FROM Messages WHERE Recipient = ? AND Read = 0 AND (Time_sent, Id) < (?, ?) ORDER BY Time_sent DESC, Id DESC LIMIT ?"),
+    ("messages", "SELECT * FROM Messages WHERE Recipient = ? AND (Time_sent, Id) < (?, ?) ORDER BY Time_sent DESC, Id DESC LIMIT ?"),
+    ("messages", "UPDATE Messages SET Read = 1 WHERE Recipient = ? AND Read = 0 AND Id IN (SELECT value FROM json_each(?))"),
+    ("messages", "UPDATE Messages SET Read = 1 WHERE Recipient = ? AND Read = 0 AND Id <= ?"),
+    ("messages", "DELETE FROM Messages WHERE Id IN (?, ?)"),
+    ("messages", "DELETE FROM Messages WHERE Id IN (?, ?) AND Recipient = ?"),
+    ("messages", "UPDATE Messages SET Recipient = Sender, Subject = 'NOT SENT ' || Subject WHERE Recipient = ? AND Read = 0"),
+    ("messages", "DELETE FROM Messages WHERE Recipient = ?"),
+    ("messages", "SELECT COALESCE(MAX(Id), 0) FROM Messages"),
+    ("messages", "SELECT Sender, Time_sent, Subject, Body FROM Messages WHERE Recipient = ? AND Read = 0 AND Id <= ?"),
+    ("messages", "SELECT Sender FROM Messages WHERE Recipient = ? AND Read = 0"),
+    ("messages", "UPDATE Messages SET Recipient = Sender, Subject = 'NOT SENT ' || Subject WHERE Recipient = ? AND Read = 0 " +
+                 "AND Sender IN (SELECT value FROM json_each(?))"),
+    ("messages", "SELECT Messages.* FROM MessagesSearch JOIN Messages ON Messages.Id = MessagesSearch.rowid " +
+                 "WHERE MessagesSearch MATCH ? AND Messages.Recipient = ? ORDER BY MessagesSearch.rank LIMIT ? OFFSET ?"),
+    ("messages", "SELECT COALESCE(MAX(Seq), 0) FROM ReplicationLog"),
+    ("messages", "SELECT MIN(Seq) FROM ReplicationLog"),
+    ("messages", "SELECT Seq, Batch FROM ReplicationLog WHERE Seq > ? ORDER BY Seq LIMIT ?"),
+    ("messages", "DELETE FROM ReplicationLog WHERE Seq <= ?"),
+]
+
+def migrate(path, migrations):
+    '''Applies any of migrations that path has not seen yet and returns the resulting version'''
+    connection = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT, isolation_level=None)
+    register_sql_functions(connection)
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        for target in range(version + 1, len(migrations) + 1):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in migrations[target - 1]:
+                    connection.execute(statement)
+                # user_version is transactional, so a failed migration leaves the version untouched
+                connection.execute(f"PRAGMA user_version = {target}")
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        return max(version, len(migrations))
+    finally:
+        connection.close()
+
+def check_query_plans(passwords_path, messages_path):
+    '''Runs EXPLAIN QUERY PLAN on every hot query and returns a list of those not using an index'''
+    failures = []
+    for database, path in (("passwords", passwords_path), ("messages", messages_path)):
+        connection = sqlite3.connect(path)
+        register_sql_functions(connection)
+        try:
+            for query_database, query in HOT_QUERIES:
+                if query_database != database:
+                    continue
+                parameters = (None,) * query.count("?")
+                try:
+                    plan = [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}", parameters)]
+                except sqlite3.OperationalError as e:
+                    # The table the query needs does not exist yet
+                    failures.append((query, [str(e)]))
+                    continue
+                # Scanning json_each walks the list passed in as a parameter, not a table
+                if any((step.startswith("SCAN") and "VIRTUAL TABLE" not in step) or "TEMP B-TREE" in step for step in plan):
+                    failures.append((query, plan))
+        finally:
+            connection.close()
+    return failures
+
+if __name__ == "__main__":
+    from Database import database_paths
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("migrate", "check"):
+        print("Usage: python Migrations.py migrate [DATA_DIR] OR python Migrations.py check [DATA_DIR]")
+        sys.exit(1)
+    passwords_path, messages_path = database_paths(sys.argv[2] if len(sys.argv) == 3 else None)
+
+    print(f"passwords.db at version {migrate(passwords_path, PASSWORDS_MIGRATIONS)}")
+    print(f"messages.db at version {migrate(messages_path, MESSAGES_MIGRATIONS)}")
+    if sys.argv[1] == "check":
+        failures = check_query_plans(passwords_path, messages_path)
+        for query, plan in failures:
+            print(f"NOT INDEXED: {query}\n    " + "\n    ".join(plan))
+        print(f"{len(HOT_QUERIES) - len(failures)}/{len(HOT_QUERIES)} hot queries use an index")
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,49 @@
+'''
+This file contains the opaque page tokens the paginated RPCs hand out. Each one is the
+URL-safe base64 of where the next page starts, so clients cannot depend on what is inside.
+'''
+
+import base64
+import json
+
+def encode_page_token(time_sent, message_id):
+    '''Builds the opaque GetMessage page token that resumes just after the given message'''
+    return base64.urlsafe_b64encode(json.dumps([time_sent, message_id]).encode()).decode()
+
+def decode_page_token(page_token):
+    '''Returns the (time_sent, message_id) inside a page token, raising ValueError if it is malformed'''
+    try:
+        time_sent, message_id = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Malformed page token {page_token!r}")
+    if not isinstance(time_sent, str) or not isinstance(message_id, int):
+        raise ValueError(f"Malformed page token {page_token!r}")
+    return time_sent, message_id
+
+def encode_users_page_token(username):
+    '''Builds the opaque GetUsers page token that resumes just after the given username'''
+    return base64.urlsafe_b64encode(username.encode()).decode()
+
+def decode_users_page_token(page_token):
+    '''Returns the username inside a GetUsers page token, raising ValueError if it is malformed'''
+    try:
+        username = base64.b64decode(page_token.encode(), altchars=b"-_", validate=True).decode()
+    except (ValueError, TypeError):
+        raise ValueError(f"Malformed page token {page_token!r}")
+    if not username:
+        raise ValueError(f"Malformed page token {page_token!r}")
+    return username
+
+def encode_search_page_token(offset):
+    '''Builds the opaque SearchMessages page token that resumes at the given position in the ranking'''
+    return base64.urlsafe_b64encode(json.dumps(offset).encode()).decode()
+
+def decode_search_page_token(page_token):
+    '''Returns the offset inside a SearchMessages page token, raising ValueError if it is malformed'''
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Malformed page token {page_token!r}")
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise ValueError(f"Malformed page token {page_token!r}")
+    return offset
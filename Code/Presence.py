@@ -0,0 +1,108 @@
+'''
+This file contains the leases that keep users online, and the watchers told when they come and go.
+
+Logging in gives a user a lease of PRESENCE_LEASE seconds. A Heartbeat call renews it, and an
+open SubscribeMessages stream holds it for as long as the stream lasts (plus one more lease
+once it closes). The server's reaper logs out every user whose lease has run out, so a client
+that crashed or lost its connection does not stay online with messages queueing up behind it.
+
+As in Sessions.py, leases are filed in buckets by when they run out rather than scanned: a
+renewal files the user again in a later bucket, and when a bucket falls due only the users whose
+latest lease is over are reaped.
+
+Each WatchPresence stream has a PresenceWatcher, which collects who joined and left since the
+stream last sent an update, so that a burst of logins reaches a slow watcher as one update.
+'''
+
+import math
+import threading
+import time
+from collections import deque
+
+import chat_pb2
+
+class Presence:
+    def __init__(self, lease, bucket, clock=time.monotonic):
+        self.lease = lease
+        self.bucket = bucket
+        self.clock = clock
+        # Username -> when their latest lease runs out
+        self.leases = {}
+        # Username -> number of SubscribeMessages streams they have open
+        self.streams = {}
+        # (due time, [usernames]) in order of due time
+        self.expiry = deque()
+        self.lock = threading.Lock()
+
+    def renew(self, username):
+        '''Gives username a fresh lease'''
+        with self.lock:
+            self._renew(username, self.clock())
+
+    def _renew(self, username, now):
+        expires = now + self.lease
+        self.leases[username] = expires
+        due = math.ceil(expires / self.bucket) * self.bucket
+        if not self.expiry or self.expiry[-1][0] != due:
+            self.expiry.append((due, []))
+        self.expiry[-1][1].append(username)
+
+    def end(self, username):
+        '''Forgets username's lease, once they have logged out'''
+        with self.lock:
+            self.leases.pop(username, None)
+
+    def stream_opened(self, username):
+        with self.lock:
+            self.streams[username] = self.streams.get(username, 0) + 1
+
+    def stream_closed(self, username):
+        with self.lock:
+            self.streams[username] -= 1
+            if not self.streams[username]:
+                del self.streams[username]
+            # The lease runs from when the last stream closed
+            if username in self.leases:
+                self._renew(username, self.clock())
+
+    def expired(self):
+        '''Returns (and forgets) the users whose lease has run out without an open stream'''
+        now = self.clock()
+        lapsed = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                for username in self.expiry.popleft()[1]:
+                    expires = self.leases.get(username)
+                    # Logged out, or renewed into a later bucket
+                    if expires is None or expires > now:
+                        continue
+                    if username in self.streams:
+                        self._renew(username, now)
+                    else:
+                        del self.leases[username]
+                        lapsed.append(username)
+        return lapsed
+
+class PresenceWatcher:
+    '''
+    The joins and leaves a WatchPresence stream has yet to send. wake is a delivery queue that is
+    given an item whenever there is something new; changed() and update() are called under the
+    servicer's online_lock
+    '''
+    def __init__(self, wake):
+        self.wake = wake
+        # Username -> whether they are online now
+        self.changes = {}
+
+    def changed(self, username, online):
+        if not self.changes:
+            self.wake.put(True)
+        self.changes[username] = online
+
+    def update(self):
+        '''Returns the PresenceUpdate of everything that changed since the last one, or None if nothing did'''
+        changes, self.changes = self.changes, {}
+        if not changes:
+            return None
+        return chat_pb2.PresenceUpdate(joined=sorted(username for username, online in changes.items() if online),
+                                       left=sorted(username for username, online in changes.items() if not online))
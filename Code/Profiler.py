@@ -0,0 +1,92 @@
+'''
+This file contains the on-demand profiler for a running chat server.
+
+Arming it (with the StartProfiling RPC, or SIGUSR1 for the next PROFILE_SIGNAL_CALLS calls of
+any method) wraps the next N calls of the chosen method in cProfile. Each call is profiled on
+the thread that runs it, the results are merged, and once the last one finishes they are
+written as a .pstats file, which pstats, snakeviz or gprof2dot can load. Calls that are not
+being profiled pay for one lock and a comparison. Profiling slows the server and writes files
+on it, so StartProfiling is only taken from the same machine (see is_local).
+'''
+
+import cProfile
+import pstats
+import threading
+import time
+from pathlib import Path
+
+import grpc
+from Constants import PROFILE_DIRECTORY
+from ServerLog import logger
+
+# Peers on the server's own machine, as grpc names them in context.peer()
+LOCAL_PEERS = ("ipv4:127.", "ipv6:[::1]", "unix:")
+
+def is_local(context):
+    '''Returns whether the call behind context came from the server's own machine'''
+    return context.peer().startswith(LOCAL_PEERS)
+
+class CallProfiler:
+    def __init__(self, directory=PROFILE_DIRECTORY):
+        self.directory = Path(directory)
+        self.lock = threading.Lock()
+        # The armed method (None for any), calls left to start, calls still running and their merged stats
+        self.method = None
+        self.remaining = 0
+        self.running = 0
+        self.stats = None
+        self.path = None
+
+    def arm(self, method, calls):
+        '''Profiles the next calls calls of method (any method if empty). Returns the output path, or None if already armed'''
+        with self.lock:
+            if self.remaining or self.running:
+                return None
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.method = method or None
+            self.remaining = calls
+            self.stats = None
+            self.path = self.directory / f"{method or 'all'}-{time.strftime('%Y%m%d-%H%M%S')}.pstats"
+            logger.info("Profiling the next %d calls of %s into %s", calls, method or "any method", self.path)
+            return self.path
+
+    def call(self, method, function, *args):
+        '''Runs function(*args), under cProfile if the profiler is armed for method'''
+        with self.lock:
+            profiled = self.remaining > 0 and self.method in (None, method)
+            if profiled:
+                self.remaining -= 1
+                self.running += 1
+        if not profiled:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self.collect(profile)
+
+    def collect(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.running -= 1
+            if self.remaining == 0 and self.running == 0:
+                self.stats.dump_stats(self.path)
+                logger.info("Wrote profile %s", self.path)
+                self.stats = None
+
+class ProfilingInterceptor(grpc.ServerInterceptor):
+    '''Runs unary calls of a grpc.server through profiler, so that armed calls are profiled'''
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not handler.unary_unary:
+            return handler
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        behavior = handler.unary_unary
+        return grpc.unary_unary_rpc_method_handler(lambda request, context: self.profiler.call(method, behavior, request, context),
+                                                   handler.request_deserializer, handler.response_serializer)
@@ -0,0 +1,277 @@
+'''
+This file contains the primary/replica replication of the chat databases.
+
+A primary (--primary) notes the statements every write runs, and at each group commit stores
+those of the writes that succeeded as one batch in the database's ReplicationLog, inside the
+same transaction. A batch's Seq is therefore the database's commit sequence. Replicas
+(--replica-of) stream each database's log with the Replicate RPC and replay the batches in
+order through their own writer: the same statements on the same rows give the same ids, counts,
+change log and search index. A replica that is new, or too far behind for the log, is first
+sent a snapshot of the whole file. Replicate hands out every user's messages and password
+hashes, so a primary only serves it to callers carrying the replication secret both are given.
+
+Responses to writes on a primary carry a commit token naming the commit sequence of every
+database. A read sent to a replica with that token as its min_commit_token waits until the
+replica has applied that much, so clients read their own writes. Clients do this through a
+ReplicaStub, which falls back to the primary when the replica cannot catch up in time.
+'''
+
+import base64
+import hmac
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+from Constants import DATABASE_BUSY_TIMEOUT, REPLICATION_LOG_SIZE, REPLICA_READ_WAIT, REPLICA_RETRY_INTERVAL
+from ServerLog import logger
+
+# Statements that only read are left out of a batch
+READ_ONLY_STATEMENTS = ("SELECT", "PRAGMA")
+
+# The RPCs a ReplicaStub sends to the replica. Their requests all have a min_commit_token
+REPLICA_READS = ("GetMessage", "GetUsers", "GetCounts", "SyncMessages")
+
+# Marks a Replicate call from a replica. Its value is the replication secret the primary and its
+# replicas are started with, so that nobody else can copy the databases
+REPLICATION_METADATA_KEY = "chat-replication"
+
+def database_name(pool):
+    '''Returns the name a database goes by in Replicate requests and commit tokens'''
+    return Path(pool.path).name
+
+class RecordingConnection:
+    '''Stands in for the writer's connection during a write, noting every statement it runs that can change the database'''
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, sql, parameters=()):
+        cursor = self.connection.execute(sql, parameters)
+        if not sql.lstrip().upper().startswith(READ_ONLY_STATEMENTS):
+            self.statements.append((sql, list(parameters), False))
+        return cursor
+
+    def executemany(self, sql, parameters):
+        parameters = [list(row) for row in parameters]
+        cursor = self.connection.executemany(sql, parameters)
+        self.statements.append((sql, parameters, True))
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return {"bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot replicate a {type(value).__name__}")
+
+def decode_value(value):
+    return base64.b64decode(value["bytes"]) if set(value) == {"bytes"} else value
+
+def encode_batch(statements):
+    '''Encodes [(sql, parameters, many)] for ReplicationLog. Compressed bodies are the only bytes, and JSON has none'''
+    return json.dumps(statements, default=encode_value).encode()
+
+def decode_batch(batch):
+    return json.loads(batch, object_hook=decode_value)
+
+def log_batch(db, batch, seq=None):
+    '''Appends batch to db's ReplicationLog (as seq, or the next one) within the caller's transaction and returns its seq'''
+    seq = db.execute("INSERT INTO ReplicationLog (Seq, Batch) VALUES (?, ?)", (seq, batch)).lastrowid
+    db.execute("DELETE FROM ReplicationLog WHERE Seq <= ?", (seq - REPLICATION_LOG_SIZE,))
+    return seq
+
+def encode_commit_token(seqs):
+    '''Builds the opaque commit token for {database name: commit sequence}'''
+    return base64.urlsafe_b64encode(json.dumps(seqs).encode()).decode()
+
+def decode_commit_token(commit_token):
+    '''Returns the {database name: commit sequence} inside a commit token, raising ValueError if it is malformed'''
+    try:
+        seqs = json.loads(base64.urlsafe_b64decode(commit_token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Malformed commit token {commit_token!r}")
+    if not isinstance(seqs, dict) or not all(isinstance(seq, int) for seq in seqs.values()):
+        raise ValueError(f"Malformed commit token {commit_token!r}")
+    return seqs
+
+def snapshot(path):
+    '''Returns (seq, image): the whole database at path as of commit sequence seq'''
+    connection = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT, isolation_level=None)
+    try:
+        # One read transaction, so that the image is exactly the database as of seq
+        connection.execute("BEGIN")
+        seq = connection.execute("SELECT COALESCE(MAX(Seq), 0) FROM ReplicationLog").fetchone()[0]
+        image = connection.serialize()
+        connection.execute("COMMIT")
+        return seq, image
+    finally:
+        connection.close()
+
+def restore(connection, image):
+    '''
+    Replaces the database behind connection with a snapshot image, in place. Run on the writer's own
+    connection, outside a transaction, so that it is the first to see the new schema
+    '''
+    image = bytearray(image)
+    # SQLite will not open a WAL mode image in memory, so mark it as using a rollback journal
+    image[18:20] = b"\x01\x01"
+    source = sqlite3.connect(":memory:")
+    try:
+        source.deserialize(bytes(image))
+        # Bumps the schema cookie, so other open connections re-read the schema too
+        source.backup(connection)
+        connection.execute("PRAGMA journal_mode=WAL")
+    finally:
+        source.close()
+
+def replication_metadata(secret):
+    '''Returns the metadata a replica holding secret sends with its Replicate calls'''
+    return ((REPLICATION_METADATA_KEY, secret),)
+
+def is_replica(context, secret):
+    '''Returns whether the call behind context carries the replication secret'''
+    if context is None or not secret:
+        return False
+    return any(key == REPLICATION_METADATA_KEY and hmac.compare_digest(value.encode(), secret.encode())
+               for key, value in context.invocation_metadata() or ())
+
+class Follower:
+    '''
+    Keeps one database of a replica in step with the same database on the primary, on a thread of
+    its own. on_restore(pool) is called after a snapshot replaces the file.
+    '''
+    def __init__(self, stub, pool, on_restore, secret):
+        self.stub = stub
+        self.secret = secret
+        self.pool = pool
+        self.name = database_name(pool)
+        self.on_restore = on_restore
+        # A file that never had a snapshot holds nothing from the primary, so asks for one
+        applied = pool.connection().execute("SELECT MAX(Seq) FROM ReplicationLog").fetchone()[0]
+        self.applied = -1 if applied is None else applied
+        self.resync = applied is None
+        self.condition = threading.Condition()
+        self.closed = threading.Event()
+        self.call = None
+        self.thread = threading.Thread(target=self.run, name=f"Follower-{self.name}", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                since_seq = -1 if self.resync else self.applied
+                self.call = self.stub.Replicate(chat_pb2.ReplicateRequest(database=self.name, since_seq=since_seq),
+                                               metadata=replication_metadata(self.secret))
+                self.follow(self.call)
+            except grpc.RpcError as e:
+                if self.closed.is_set():
+                    return
+                logger.warning("Lost the primary while replicating %s: %s", self.name, e.code())
+            except sqlite3.Error:
+                # The copy no longer matches the primary's, so start again from a snapshot
+                logger.exception("Could not apply a batch to %s", self.name)
+                self.resync = True
+            self.closed.wait(REPLICA_RETRY_INTERVAL)
+
+    def follow(self, batches):
+        chunks = []
+        for batch in batches:
+            if batch.snapshot:
+                chunks.append(batch.snapshot)
+                if batch.last_chunk:
+                    image = b"".join(chunks)
+                    self.pool.writer.submit_alone(lambda db: restore(db, image))
+                    chunks = []
+                    self.resync = False
+                    self.on_restore(self.pool)
+                    logger.info("Restored %s from a snapshot at %d", self.name, batch.seq)
+                    self.advance(batch.seq)
+                continue
+            statements = decode_batch(batch.statements)
+            def replay(db):
+                for sql, parameters, many in statements:
+                    if many:
+                        db.executemany(sql, parameters)
+                    else:
+                        db.execute(sql, parameters)
+                log_batch(db, batch.statements, batch.seq)
+            self.pool.write(replay)
+            self.advance(batch.seq)
+
+    def advance(self, seq):
+        with self.condition:
+            self.applied = seq
+            self.condition.notify_all()
+
+    def wait_for(self, seq, timeout):
+        '''Waits up to timeout seconds for the batch seq to be applied, and returns whether it was'''
+        with self.condition:
+            return self.condition.wait_for(lambda: self.applied >= seq, timeout)
+
+    def close(self):
+        self.closed.set()
+        if self.call is not None:
+            self.call.cancel()
+        self.thread.join()
+
+class Replica:
+    '''Follows every database of a replica from the primary at the given HOST:PORT, which shares its secret'''
+    def __init__(self, primary, pools, on_restore, secret):
+        self.channel = grpc.insecure_channel(primary)
+        stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+        self.followers = {database_name(pool): Follower(stub, pool, on_restore, secret) for pool in pools}
+
+    def caught_up(self, commit_token, timeout=REPLICA_READ_WAIT):
+        '''Waits up to timeout seconds to have applied everything in commit_token, and returns whether it has'''
+        seqs = decode_commit_token(commit_token)
+        if not set(seqs) <= set(self.followers):
+            raise ValueError(f"Commit token for other databases {sorted(seqs)}")
+        deadline = time.monotonic() + timeout
+        return all(self.followers[name].wait_for(seq, max(0, deadline - time.monotonic())) for name, seq in seqs.items())
+
+    def close(self):
+        for follower in self.followers.values():
+            follower.close()
+        self.channel.close()
+
+class ReplicaStub:
+    '''
+    ChatServiceStub look-alike that sends REPLICA_READS to a replica and every other call to the primary.
+    Each read carries the commit token of the last write made through it, and is sent to the primary
+    instead if the replica answers PENDING or cannot be reached
+    '''
+    def __init__(self, stub, replica_stub):
+        self.stub = stub
+        self.replica_stub = replica_stub
+        self.commit_token = ""
+
+    def __getattr__(self, name):
+        if name in REPLICA_READS:
+            return lambda request, **kwargs: self.read(name, request, **kwargs)
+        method = getattr(self.stub, name)
+        def call(request, **kwargs):
+            response = method(request, **kwargs)
+            # Streams have no commit token
+            if getattr(response, "commit_token", ""):
+                self.commit_token = response.commit_token
+            return response
+        return call
+
+    def read(self, name, request, **kwargs):
+        replica_request = type(request)()
+        replica_request.CopyFrom(request)
+        replica_request.min_commit_token = self.commit_token
+        try:
+            response = getattr(self.replica_stub, name)(replica_request, **kwargs)
+            if response.status != chat_pb2.Status.PENDING:
+                return response
+        except grpc.RpcError:
+            # The primary can answer every read, if more slowly
+            pass
+        return getattr(self.stub, name)(request, **kwargs)
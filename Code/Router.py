@@ -0,0 +1,187 @@
+'''
+Thin router in front of a cluster of chat server nodes.
+
+Clients connect to the router as if it were a single server. Each call is sent on to the node
+owning its user (see Cluster.py), or to every node with the answers merged, and errors from a
+node are passed back to the client as they are, as is the session token the client sent. The
+router keeps no state of its own, so any number of them can run side by side. Each open
+SubscribeMessages or WatchPresence stream holds one of its worker threads, so as in
+GRPCServer.py at most --max-streams are let in, and the pool has threads to spare for the rest.
+
+Usage: python Router.py HOSTNAME PORT NODE [NODE ...] [--max-streams N] [--workers N] [--compression gzip]
+       where every NODE is the HOST:PORT a node was started on, listed in the same way
+       as the nodes' own --cluster option
+'''
+
+import argparse
+import queue
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+from Constants import MAX_WORKERS, MAX_STREAMS, DEFAULT_CHANNEL_COMPRESSION
+from Cluster import ClusterStub
+from Sessions import session_metadata
+from Compression import CHANNEL_COMPRESSION, grpc_compression
+from ServerLog import logger, log_request, add_logging_arguments, configure_logging_from_args
+
+# A day, in seconds
+MAX_FORWARDED_TIMEOUT = 86400
+
+def time_remaining(context):
+    '''Returns the seconds left before the client's deadline, or None if it set none'''
+    remaining = context.time_remaining()
+    # Calls without a deadline report one centuries away, which is too far off to pass on
+    return remaining if remaining < MAX_FORWARDED_TIMEOUT else None
+
+def routed(name):
+    '''Builds a handler that makes the call of the same name through the router's ClusterStub'''
+    def handler(self, request, context):
+        try:
+            return getattr(self.cluster, name)(request, timeout=time_remaining(context), metadata=session_metadata(context))
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+    handler.__name__ = name
+    return handler
+
+class RouterServicer(chat_pb2_grpc.ChatServiceServicer):
+    def __init__(self, cluster, max_streams=None):
+        self.cluster = cluster
+        # Streams past max_streams are turned away, so that they cannot hold every worker thread
+        self.max_streams = max_streams
+        self.stream_slots = threading.BoundedSemaphore(max_streams) if max_streams is not None else None
+
+    def take_stream_slot(self, context):
+        '''Takes a stream slot, to be handed back with release_stream_slot(), or aborts with RESOURCE_EXHAUSTED if none is free'''
+        if self.stream_slots is not None and not self.stream_slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, f"This router streams to at most {self.max_streams} clients at once")
+
+    def release_stream_slot(self):
+        if self.stream_slots is not None:
+            self.stream_slots.release()
+
+    # User Account Management
+
+    CheckUsername = routed("CheckUsername")
+    CheckPassword = routed("CheckPassword")
+    CreateUser = routed("CreateUser")
+    ConfirmLogin = routed("ConfirmLogin")
+    Login = routed("Login")
+    ConfirmLogout = routed("ConfirmLogout")
+    GetOnlineUsers = routed("GetOnlineUsers")
+    Heartbeat = routed("Heartbeat")
+    GetUsers = routed("GetUsers")
+
+    # Messages
+
+    SendMessage = routed("SendMessage")
+    GetMessage = routed("GetMessage")
+    GetCounts = routed("GetCounts")
+    SyncMessages = routed("SyncMessages")
+    ConfirmRead = routed("ConfirmRead")
+    SearchMessages = routed("SearchMessages")
+    DeleteMessage = routed("DeleteMessage")
+    DeleteUser = routed("DeleteUser")
+
+    # Monitoring
+
+    GetServerStats = routed("GetServerStats")
+    StartProfiling = routed("StartProfiling")
+
+    # Live Delivery
+
+    def SubscribeMessages(self, request, context):
+        log_request("SubscribeMessages", request)
+        self.take_stream_slot(context)
+        try:
+            subscription = self.cluster.SubscribeMessages(request, metadata=session_metadata(context))
+            # Hang up on the node when the client goes away
+            context.add_callback(subscription.cancel)
+            for message in subscription:
+                yield message
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                context.abort(e.code(), e.details())
+        finally:
+            self.release_stream_slot()
+
+    def WatchPresence(self, request, context):
+        '''
+        Watches every node, each on a thread of its own, and merges their snapshots and then their updates.
+        The nodes have to run GRPCAioServer.py, as GRPCServer.py does not serve WatchPresence
+        '''
+        log_request("WatchPresence", request)
+        self.take_stream_slot(context)
+        updates = queue.Queue()
+        def pump(node, watch):
+            try:
+                for update in watch:
+                    updates.put((node, update))
+            except grpc.RpcError as e:
+                updates.put((node, e))
+        watches = {node: stub.WatchPresence(request) for node, stub in self.cluster.stubs.items()}
+        for node, watch in watches.items():
+            context.add_callback(watch.cancel)
+            threading.Thread(target=pump, args=(node, watch), daemon=True).start()
+        try:
+            # A node's updates can arrive before another's snapshot, so apply everything until all snapshots are in
+            online, waiting = set(), set(watches)
+            while waiting:
+                node, update = updates.get()
+                if isinstance(update, grpc.RpcError):
+                    raise update
+                online.update(update.joined)
+                online.difference_update(update.left)
+                if update.snapshot:
+                    waiting.discard(node)
+            yield chat_pb2.PresenceUpdate(snapshot=True, joined=sorted(online))
+            while True:
+                node, update = updates.get()
+                if isinstance(update, grpc.RpcError):
+                    raise update
+                yield update
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                context.abort(e.code(), e.details())
+        finally:
+            for watch in watches.values():
+                watch.cancel()
+            self.release_stream_slot()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Route chat clients to the nodes of a cluster")
+    parser.add_argument("host", help="hostname to listen on")
+    parser.add_argument("port", help="port to listen on")
+    parser.add_argument("nodes", nargs="+", help="HOST:PORT of every node in the cluster")
+    parser.add_argument("--max-streams", type=int, default=MAX_STREAMS,
+                        help="most SubscribeMessages and WatchPresence streams open at once, each holding a worker thread; " +
+                             "later ones fail with RESOURCE_EXHAUSTED")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"number of worker threads, more than --max-streams (defaults to --max-streams + {MAX_WORKERS})")
+    parser.add_argument("--compression", choices=CHANNEL_COMPRESSION, default=DEFAULT_CHANNEL_COMPRESSION,
+                        help="compression applied to responses and to calls to the nodes")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if args.max_streams < 0:
+        parser.error("--max-streams cannot be negative")
+    if args.workers is None:
+        args.workers = args.max_streams + MAX_WORKERS
+    elif args.workers <= args.max_streams:
+        parser.error("--workers must be more than --max-streams, or open streams can leave no thread for any other call")
+    configure_logging_from_args(args)
+
+    cluster = ClusterStub(args.nodes, grpc_compression(args.compression))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.workers), compression=grpc_compression(args.compression))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(RouterServicer(cluster, args.max_streams), server)
+    server.add_insecure_port(f"{args.host}:{args.port}")
+    server.start()
+    logger.info("gRPC Router started on %s:%s for %d nodes", args.host, args.port, len(cluster.ring.nodes))
+    try:
+        while True:
+            time.sleep(86400)
+    except KeyboardInterrupt:
+        server.stop(0)
+        cluster.close()
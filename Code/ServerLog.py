@@ -0,0 +1,104 @@
+'''
+This file contains the chat servers' logging setup.
+
+Handlers log through the "chat" logger. Records are put on an in-memory queue as they are,
+unformatted, and a QueueListener thread formats and writes them, so a handler never waits on
+stdout or the disk. High-volume RPCs are sampled, logging one call in every LOG_SAMPLE_EVERY,
+and requests are described with message bodies and passwords elided unless asked for.
+'''
+
+import argparse
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+from Constants import DEFAULT_LOG_LEVEL, LOG_SAMPLE_EVERY, SAMPLED_RPCS
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(message)s"
+# Never logged, whatever the configuration
+SECRET_FIELDS = {"password"}
+
+logger = logging.getLogger("chat")
+
+class RequestSummary:
+    '''Formats a request for the log only if the record is written, eliding bodies and passwords'''
+    log_bodies = False
+
+    def __init__(self, request):
+        self.request = request
+
+    def __str__(self):
+        request = type(self.request)()
+        request.CopyFrom(self.request)
+        elide(request, SECRET_FIELDS if self.log_bodies else SECRET_FIELDS | {"body"})
+        # One line per record
+        return str(request).replace("\n", " ").strip()
+
+def elide(message, fields):
+    '''Replaces the named string fields of message, and of any message inside it, with their length'''
+    for field, value in message.ListFields():
+        if field.name in fields and isinstance(value, str):
+            setattr(message, field.name, f"<{len(value)} chars>")
+        elif field.message_type is not None:
+            for item in (value if field.label == field.LABEL_REPEATED else [value]):
+                elide(item, fields)
+
+class SamplingFilter(logging.Filter):
+    '''Passes one record in every `every` for each RPC in rpcs; other records always pass'''
+    def __init__(self, rpcs, every):
+        super().__init__()
+        self.rpcs = rpcs
+        self.every = every
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        rpc = getattr(record, "rpc", None)
+        if self.every <= 1 or rpc not in self.rpcs:
+            return True
+        with self.lock:
+            count = self.counts.get(rpc, 0)
+            self.counts[rpc] = count + 1
+        return count % self.every == 0
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that leaves formatting to the listener thread instead of the logging thread'''
+    def prepare(self, record):
+        return record
+
+def log_request(rpc, request):
+    '''Logs that rpc was called with request, subject to sampling'''
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s given %s", rpc, RequestSummary(request), extra={"rpc": rpc})
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, log_file=None, sample_every=LOG_SAMPLE_EVERY, log_bodies=False):
+    '''Routes the "chat" logger through a background writer. The writer is flushed and stopped at exit'''
+    RequestSummary.log_bodies = log_bodies
+    output = logging.FileHandler(log_file) if log_file else logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter(SAMPLED_RPCS, sample_every))
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def add_logging_arguments(parser):
+    '''Adds the logging options shared by the server entry points'''
+    parser.add_argument("--log-level", default=DEFAULT_LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="least severe level to log")
+    parser.add_argument("--log-file", default=None, help="file to append the log to (defaults to stdout)")
+    parser.add_argument("--log-sample-every", type=int, default=LOG_SAMPLE_EVERY,
+                        help="log one in this many calls to high-volume RPCs (1 logs every call)")
+    parser.add_argument("--log-bodies", action=argparse.BooleanOptionalAction, default=False,
+                        help="include message bodies in request logs")
+
+def configure_logging_from_args(args):
+    return configure_logging(args.log_level, args.log_file, args.log_sample_every, args.log_bodies)
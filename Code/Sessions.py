@@ -0,0 +1,116 @@
+'''
+This file contains the session tokens that authenticate calls after login.
+
+CheckPassword issues a random token on a match, and ConfirmLogin hands back the token it was
+called with (issuing one if the server does not require them). Clients then send the token as
+SESSION_METADATA_KEY metadata with every call; with --require-sessions, calls acting as a user
+are only served if their token belongs to that user, so nobody can read or act on another
+user's inbox by naming them.
+
+Sessions live only in the memory of the node that issued them, in a SessionTable: one dict
+from token to username, checked with a single lookup. Tokens are kept as 16 raw bytes and each
+username is interned, so a user's sessions share one string. Rather than a timestamp per
+session, tokens are filed in SESSION_EXPIRY_BUCKET second buckets by when they expire, and
+whole buckets are dropped once due, so a session outlives SESSION_LIFETIME by at most one
+bucket. A server restart logs everybody out.
+'''
+
+import base64
+import binascii
+import math
+import secrets
+import sys
+import threading
+import time
+from collections import deque
+
+from Constants import SESSION_LIFETIME, SESSION_EXPIRY_BUCKET
+
+SESSION_METADATA_KEY = "chat-session"
+SESSION_TOKEN_BYTES = 16
+
+def encode_session_token(token):
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode()
+
+def decode_session_token(session_token):
+    '''Returns the raw token inside a session token, or None if it is malformed'''
+    try:
+        token = base64.urlsafe_b64decode(session_token + "=" * (-len(session_token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    return token if len(token) == SESSION_TOKEN_BYTES else None
+
+def session_token(context):
+    '''Returns the session token sent with the call behind context, or "" if there is none'''
+    return next((value for key, value in context.invocation_metadata() or () if key == SESSION_METADATA_KEY), "")
+
+def session_metadata(context):
+    '''Returns the metadata that passes the session token of the call behind context on to another server'''
+    token = session_token(context)
+    return ((SESSION_METADATA_KEY, token),) if token else None
+
+class SessionTable:
+    '''Maps session tokens to the users they were issued to until they expire or are revoked'''
+    def __init__(self, lifetime=SESSION_LIFETIME, bucket=SESSION_EXPIRY_BUCKET, clock=time.monotonic):
+        self.lifetime = lifetime
+        self.bucket = bucket
+        self.clock = clock
+        # Raw token -> username
+        self.sessions = {}
+        # (expiry time, [tokens]) in order of expiry time; revoked tokens stay until their bucket is dropped
+        self.expiry = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def issue(self, username):
+        '''Starts a session for username and returns its token'''
+        token = secrets.token_bytes(SESSION_TOKEN_BYTES)
+        now = self.clock()
+        expires = math.ceil((now + self.lifetime) / self.bucket) * self.bucket
+        with self.lock:
+            self.expire(now)
+            self.sessions[token] = sys.intern(username)
+            if not self.expiry or self.expiry[-1][0] != expires:
+                self.expiry.append((expires, []))
+            self.expiry[-1][1].append(token)
+        return encode_session_token(token)
+
+    def username(self, session_token):
+        '''Returns the user session_token was issued to, or None if it is unknown, expired or revoked'''
+        token = decode_session_token(session_token)
+        if token is None:
+            return None
+        now = self.clock()
+        if self.expiry and self.expiry[0][0] <= now:
+            with self.lock:
+                self.expire(now)
+        return self.sessions.get(token)
+
+    def revoke(self, session_token):
+        token = decode_session_token(session_token)
+        if token is not None:
+            self.sessions.pop(token, None)
+
+    def revoke_user(self, username):
+        '''Ends every session of username. This scans the whole table, so it is kept for rare calls like DeleteUser'''
+        with self.lock:
+            for token in [token for token, owner in self.sessions.items() if owner == username]:
+                del self.sessions[token]
+
+    def expire(self, now):
+        # Callers hold self.lock
+        while self.expiry and self.expiry[0][0] <= now:
+            for token in self.expiry.popleft()[1]:
+                self.sessions.pop(token, None)
+
+class SessionStub:
+    '''ChatServiceStub look-alike that sends a session token with every call'''
+    def __init__(self, stub, session_token):
+        self.stub = stub
+        self.metadata = ((SESSION_METADATA_KEY, session_token),)
+
+    def __getattr__(self, name):
+        method = getattr(self.stub, name)
+        return lambda request, **kwargs: method(request, metadata=self.metadata, **kwargs)
@@ -1,30 +1,91 @@
-import sys
+import argparse
 import grpc
 import hashlib
+import threading
 from datetime import datetime, timezone
 
 # Import the generated gRPC modules.
 import chat_pb2
 import chat_pb2_grpc
+from Constants import DEFAULT_CHANNEL_COMPRESSION, PRESENCE_HEARTBEAT_INTERVAL
+from Compression import CHANNEL_COMPRESSION, grpc_compression
+from Sessions import SessionStub
+from Replication import ReplicaStub
 
-def client_user(stub, username):
-    # Confirm login via gRPC.
+# Users printed per "search" page.
+USERS_PAGE_SIZE = 20
+# Newest unread messages printed on login.
+LOGIN_MESSAGES_PAGE_SIZE = 5
+
+def receive_messages(stub, username, subscription, stopped):
+    # Print messages streamed to this user while logged in.
     try:
-        login_response = stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username=username))
+        for msg in subscription:
+            print(f"\nNew message {msg.id} from {msg.sender}: {msg.subject}")
     except grpc.RpcError as e:
-        print("Error during ConfirmLogin:", e)
-        return
+        # The stream is cancelled on logout or when the server goes away.
+        if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+            return
+        print(f"\n{e.details()}. New messages will not be shown as they arrive; use 'sync' to fetch them.")
+        # Without a stream, heartbeats keep the user online until they log out.
+        while not stopped.wait(PRESENCE_HEARTBEAT_INTERVAL):
+            try:
+                stub.Heartbeat(chat_pb2.HeartbeatRequest(username=username))
+            except grpc.RpcError:
+                pass
 
-    if login_response.status == chat_pb2.Status.SUCCESS:
-        print("Logged In")
-        print(f"Unread messages: {login_response.num_unread_msgs}, Total messages: {login_response.num_total_msgs}")
-    elif login_response.status == chat_pb2.Status.MATCH:
-        print("Already Logged In Elsewhere")
-        return
-    else:
-        print("Login Failed")
+def watch_presence(watch, online, online_lock):
+    # Keep the set of online users up to date from a snapshot and then who joined and left.
+    try:
+        for update in watch:
+            with online_lock:
+                if update.snapshot:
+                    online.clear()
+                online.update(update.joined)
+                online.difference_update(update.left)
+    except grpc.RpcError:
+        # The stream is cancelled on logout or when the server goes away, and GRPCServer.py does not serve it;
+        # "get" then asks the server instead.
         return
 
+def client_user(stub, username, login_response):
+    # The Login response already holds the counts and the newest unread messages.
+    print("Logged In")
+    print(f"Unread messages: {login_response.num_unread_msgs}, Total messages: {login_response.num_total_msgs}")
+    for msg in login_response.messages:
+        print(f"Message {msg.id} from {msg.sender} at {msg.time_sent}:\n {msg.subject}\n {msg.body}\n (Read: {msg.read})")
+    if login_response.messages_next_page_token:
+        print("Type 'more' for the next page.")
+
+    subscription = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=username))
+    stopped = threading.Event()
+    threading.Thread(target=receive_messages, args=(stub, username, subscription, stopped), daemon=True).start()
+    # "get" answers from this set instead of downloading the whole list each time.
+    online, online_lock = set(), threading.Lock()
+    watch = stub.WatchPresence(chat_pb2.WatchPresenceRequest())
+    watcher = threading.Thread(target=watch_presence, args=(watch, online, online_lock), daemon=True)
+    watcher.start()
+    try:
+        client_loop(stub, username, login_response, online, online_lock, watcher)
+    finally:
+        stopped.set()
+        subscription.cancel()
+        watch.cancel()
+
+def client_loop(stub, username, login_response, online, online_lock, watcher):
+    # The last "msg" request, and the token for its next page, so that "more" can continue it.
+    # The page of unread messages printed on login counts as the first.
+    last_request = chat_pb2.GetMessageRequest(limit=LOGIN_MESSAGES_PAGE_SIZE, unread_only=True, username=username)
+    next_page_token = login_response.messages_next_page_token
+    # How far "sync" has read the inbox's change log.
+    sync_seq = 0
+    # The last "search" prefix and the token for its next page, so that "moreusers" can continue it.
+    search_prefix = ""
+    users_page_token = ""
+    # The last "find" request and the token for its next page, so that "morefound" can continue it.
+    find_request = None
+    find_page_token = ""
+
     # Main interactive loop.
     while True:
         command = input(f"Enter a message as User {username}: ")
@@ -35,7 +96,11 @@ def client_user(stub, username):
             continue
 
         if lines[0] == "get":
-            # Get online users.
+            # Get online users, from the server only if the presence watch has ended.
+            if watcher.is_alive():
+                with online_lock:
+                    print("Online users:", sorted(online))
+                continue
             try:
                 response = stub.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest())
                 if response.status == chat_pb2.Status.SUCCESS:
@@ -54,19 +119,93 @@ def client_user(stub, username):
                 offset = int(lines[1])
                 limit = int(lines[2])
                 unread_only = (lines[3].lower() == "true")
-                response = stub.GetMessage(chat_pb2.GetMessageRequest(
+                last_request = chat_pb2.GetMessageRequest(
                     offset=offset,
                     limit=limit,
                     unread_only=unread_only,
-                    username=username))
+                    username=username)
+                response = stub.GetMessage(last_request)
                 if response.status == chat_pb2.Status.SUCCESS:
                     for msg in response.messages:
                         print(f"Message {msg.id} from {msg.sender} at {msg.time_sent}:\n {msg.subject}\n {msg.body}\n (Read: {msg.read})")
+                    next_page_token = response.next_page_token
+                    if next_page_token:
+                        print("Type 'more' for the next page.")
                 else:
                     print("Failed to get messages.")
             except Exception as e:
                 print("Error processing msg command:", e)
 
+        elif lines[0] == "more":
+            # Continue the last msg command from where its previous page ended.
+            if not next_page_token:
+                print("No more messages.")
+                continue
+            try:
+                last_request.page_token = next_page_token
+                response = stub.GetMessage(last_request)
+                if response.status == chat_pb2.Status.SUCCESS:
+                    for msg in response.messages:
+                        print(f"Message {msg.id} from {msg.sender} at {msg.time_sent}:\n {msg.subject}\n {msg.body}\n (Read: {msg.read})")
+                    next_page_token = response.next_page_token
+                    if next_page_token:
+                        print("Type 'more' for the next page.")
+                else:
+                    print("Failed to get messages.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
+        elif lines[0] == "counts":
+            # Get the total and unread message counts.
+            try:
+                response = stub.GetCounts(chat_pb2.GetCountsRequest(username=username))
+                if response.status == chat_pb2.Status.SUCCESS:
+                    print(f"Unread messages: {response.num_unread_msgs}, Total messages: {response.num_total_msgs}")
+                else:
+                    print("Failed to get message counts.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
+        elif lines[0] == "sync":
+            # Print only what changed in the inbox since the last sync.
+            try:
+                has_more = True
+                while has_more:
+                    response = stub.SyncMessages(chat_pb2.SyncMessagesRequest(username=username, since_seq=sync_seq))
+                    if response.status != chat_pb2.Status.SUCCESS:
+                        print("Failed to sync messages.")
+                        break
+                    if response.resync:
+                        print("Last synced too long ago; fetching the whole inbox again.")
+                        sync_seq = 0
+                        continue
+                    for msg in response.messages:
+                        print(f"Message {msg.id} from {msg.sender} at {msg.time_sent}:\n {msg.subject}\n {msg.body}\n (Read: {msg.read})")
+                    if response.read_ids:
+                        print("Read:", list(response.read_ids))
+                    if response.deleted_ids:
+                        print("Deleted:", list(response.deleted_ids))
+                    sync_seq = response.next_seq
+                    has_more = response.has_more
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
+        elif lines[0] == "stats":
+            # Print the server's per-RPC metrics.
+            try:
+                response = stub.GetServerStats(chat_pb2.GetServerStatsRequest())
+                if response.status == chat_pb2.Status.SUCCESS:
+                    print(f"Up for {response.uptime_seconds:.0f}s")
+                    print(f"{'RPC':<18}{'calls':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sqlite %':>10}")
+                    for method in response.methods:
+                        sqlite_share = 100 * method.sqlite_total_ms / method.total_ms if method.total_ms else 0
+                        print(f"{method.method:<18}{method.calls:>8}{method.errors:>8}{method.p50_ms:>10.2f}"
+                              f"{method.p95_ms:>10.2f}{method.p99_ms:>10.2f}{sqlite_share:>10.1f}")
+                else:
+                    print("Failed to get server stats.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
         elif lines[0] == "users":
             # Get all registered users.
             try:
@@ -78,6 +217,53 @@ def client_user(stub, username):
             except grpc.RpcError as e:
                 print("RPC error:", e)
 
+        elif lines[0] in ("search", "moreusers"):
+            # Page through users whose names start with a prefix.
+            if lines[0] == "search":
+                search_prefix = lines[1] if len(lines) > 1 else ""
+                users_page_token = ""
+            elif not users_page_token:
+                print("No more users.")
+                continue
+            try:
+                response = stub.GetUsers(chat_pb2.GetUsersRequest(
+                    prefix=search_prefix, limit=USERS_PAGE_SIZE, page_token=users_page_token))
+                if response.status == chat_pb2.Status.SUCCESS:
+                    print("Users:", response.users)
+                    users_page_token = response.next_page_token
+                    if users_page_token:
+                        print("Type 'moreusers' for the next page.")
+                else:
+                    print("Failed to search users.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
+        elif lines[0] in ("find", "morefound"):
+            # Search the inbox for messages containing every given word, best match first.
+            if lines[0] == "find":
+                if len(lines) < 2:
+                    print("Usage: find <words>")
+                    continue
+                find_request = chat_pb2.SearchMessagesRequest(username=username, query=" ".join(lines[1:]))
+            elif not find_page_token:
+                print("No more matches.")
+                continue
+            find_request.page_token = find_page_token if lines[0] == "morefound" else ""
+            try:
+                response = stub.SearchMessages(find_request)
+                if response.status == chat_pb2.Status.SUCCESS:
+                    if not response.messages:
+                        print("No matching messages.")
+                    for msg in response.messages:
+                        print(f"Message {msg.id} from {msg.sender} at {msg.time_sent}:\n {msg.subject}\n {msg.body}\n (Read: {msg.read})")
+                    find_page_token = response.next_page_token
+                    if find_page_token:
+                        print("Type 'morefound' for the next page.")
+                else:
+                    print("Failed to search messages.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
         elif lines[0] == "like":
             # Get users matching a pattern.
             if len(lines) < 2:
@@ -118,19 +304,39 @@ def client_user(stub, username):
                 return
 
         elif lines[0] == "read":
-            # Mark a message as read. (Expecting a single message_id.)
+            # Mark one or more messages as read by id, all in one request.
             if len(lines) < 2:
-                print("Usage: read <message_id>")
+                print("Usage: read <message_id> [<message_id> ...]")
                 continue
             try:
-                message_id = int(lines[1])
+                message_ids = [int(x) for x in lines[1:]]
                 response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(
-                    message_id=message_id,
+                    message_ids=message_ids,
                     username=username))
                 if response.status == chat_pb2.Status.SUCCESS:
-                    print(f"Message {message_id} marked as read.")
+                    print(f"{response.num_marked} message(s) marked as read.")
                 else:
-                    print("Failed to mark message as read.")
+                    print("Failed to mark messages as read.")
+            except ValueError:
+                print("Message ids must be integers.")
+            except grpc.RpcError as e:
+                print("RPC error:", e)
+
+        elif lines[0] == "readall":
+            # Mark every message up to and including the given id as read.
+            if len(lines) < 2:
+                print("Usage: readall <message_id>")
+                continue
+            try:
+                response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(
+                    up_to_id=int(lines[1]),
+                    username=username))
+                if response.status == chat_pb2.Status.SUCCESS:
+                    print(f"{response.num_marked} message(s) marked as read.")
+                else:
+                    print("Failed to mark messages as read.")
+            except ValueError:
+                print("Message id must be an integer.")
             except grpc.RpcError as e:
                 print("RPC error:", e)
 
@@ -141,7 +347,7 @@ def client_user(stub, username):
                 continue
             try:
                 message_ids = [int(x) for x in lines[1:]]
-                response = stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=message_ids))
+                response = stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=message_ids, username=username))
                 if response.status == chat_pb2.Status.SUCCESS:
                     print("Message(s) deleted successfully.")
                 else:
@@ -151,7 +357,8 @@ def client_user(stub, username):
 
         elif lines[0] == "message":
             # Compose and send a new message.
-            recipient = input("Send Message To: ")
+            # Several comma separated recipients are sent in one multicast request.
+            recipients = [name.strip() for name in input("Send Message To: ").split(",") if name.strip()]
             subject = input("Enter Message Subject: ")
             body = input("Enter Message Body: ")
             current_time = datetime.now(timezone.utc)
@@ -160,16 +367,20 @@ def client_user(stub, username):
             message_obj = chat_pb2.MessageObject(
                 id=0,
                 sender=username,
-                recipient=recipient,
+                recipient=recipients[0] if len(recipients) == 1 else "",
                 time_sent=iso_time,
                 read=False,
                 subject=subject,
                 body=body
             )
             try:
-                response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message_obj))
+                response = stub.SendMessage(chat_pb2.SendMessageRequest(
+                    message=message_obj, recipients=recipients if len(recipients) > 1 else []))
                 if response.status == chat_pb2.Status.SUCCESS:
                     print("Message sent successfully.")
+                    for status in response.recipient_statuses:
+                        if status.status != chat_pb2.Status.SUCCESS:
+                            print(f"Not sent to {status.recipient}: no such user.")
                 else:
                     print("Failed to send message.")
             except grpc.RpcError as e:
@@ -223,10 +434,15 @@ def client_login(stub):
         password = input("Enter Password: ")
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
         try:
-            response = stub.CheckPassword(chat_pb2.CheckPasswordRequest(username=username, password=hashed_password))
-            if response.status == chat_pb2.Status.MATCH:
-                print("Logging In")
-                client_user(stub, username)
+            # Check the password, log in and fetch the newest unread messages in one call.
+            response = stub.Login(chat_pb2.LoginRequest(username=username, password=hashed_password,
+                                                        message_limit=LOGIN_MESSAGES_PAGE_SIZE, unread_only=True))
+            if response.status == chat_pb2.Status.SUCCESS:
+                # Every call made while logged in carries the session token
+                client_user(SessionStub(stub, response.session_token), username, response)
+                return
+            elif response.status == chat_pb2.Status.MATCH:
+                print("Already Logged In Elsewhere")
                 return
             elif response.status == chat_pb2.Status.NO_MATCH:
                 print("Wrong Password.")
@@ -236,13 +452,21 @@ def client_login(stub):
             print("RPC error:", e)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python client.py HOSTNAME PORT")
-        exit(1)
-    host, port = sys.argv[1], sys.argv[2]
+    parser = argparse.ArgumentParser(description="Chat in the terminal")
+    parser.add_argument("host", help="hostname of the server")
+    parser.add_argument("port", help="port of the server")
+    # Compress requests; the server picks its own compression for responses
+    parser.add_argument("compression", nargs="?", choices=CHANNEL_COMPRESSION, default=DEFAULT_CHANNEL_COMPRESSION,
+                        help="compression applied to requests")
+    parser.add_argument("--replica", metavar="HOST:PORT",
+                        help="replica of the server to read inboxes, counts and users from (see Replication.py)")
+    args = parser.parse_args()
     # Create a gRPC channel and stub.
-    channel = grpc.insecure_channel(f"{host}:{port}")
+    channel = grpc.insecure_channel(f"{args.host}:{args.port}", compression=grpc_compression(args.compression))
     stub = chat_pb2_grpc.ChatServiceStub(channel)
+    if args.replica:
+        replica_channel = grpc.insecure_channel(args.replica, compression=grpc_compression(args.compression))
+        stub = ReplicaStub(stub, chat_pb2_grpc.ChatServiceStub(replica_channel))
     
     while True:
         client_login(stub)
@@ -0,0 +1,190 @@
+'''
+This file contains the in-memory username directory that answers existence checks
+(CheckUsername, CreateUser and the SendMessage recipient lookups) without touching SQLite.
+
+Below USER_DIRECTORY_BLOOM_THRESHOLD users the directory is an exact set, plus a sorted list
+that answers GetUsers prefix searches by bisection. Above it, a Bloom filter takes their place:
+a "no" is still definite, and only a "maybe" (or a search) falls through to the Passwords table. Changes are applied from inside the write that makes them, on the
+passwords writer thread, so the directory moves in step with the UsersVersion counter.
+
+At shutdown the directory is written to a snapshot file next to passwords.db, tagged with that
+counter. On startup the snapshot is only trusted if the database still carries the same
+generation and version; otherwise the directory is rebuilt from a scan of Passwords.
+'''
+
+import base64
+import bisect
+import hashlib
+import json
+import math
+import os
+import threading
+from pathlib import Path
+
+from Constants import USER_DIRECTORY_BLOOM_THRESHOLD, USER_DIRECTORY_ERROR_RATE
+
+class BloomFilter:
+    '''
+    Fixed size Bloom filter sized for capacity keys at error_rate false positives.
+    Keys cannot be removed, so a deleted user stays a "maybe" until the filter is rebuilt.
+    '''
+    def __init__(self, capacity, error_rate=USER_DIRECTORY_ERROR_RATE, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8) if bits is None else bytearray(bits)
+
+    def positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+class UserDirectory:
+    '''
+    Answers "does this username exist?" for a passwords ConnectionPool. add() and remove()
+    must be called from inside the write (pool.write) that inserts or deletes the user; add()
+    is given that write's connection in case it has to rebuild.
+    '''
+    def __init__(self, pool, snapshot_path, bloom_threshold=USER_DIRECTORY_BLOOM_THRESHOLD):
+        self.pool = pool
+        self.snapshot_path = Path(snapshot_path)
+        self.bloom_threshold = bloom_threshold
+        self.lock = threading.Lock()
+        # Either usernames and its sorted copy (exact) or bloom (approximate) is in use
+        self.usernames = set()
+        self.sorted_usernames = []
+        self.bloom = None
+        self.count = 0
+        self.loaded_from_snapshot = self.load()
+
+    def database_version(self, db):
+        return db.execute("SELECT Generation, Version FROM UsersVersion WHERE Id = 1").fetchone()
+
+    def load(self):
+        '''Fills the directory from the snapshot if it is current, otherwise from Passwords. Returns True for the snapshot'''
+        db = self.pool.connection()
+        generation, version = self.database_version(db)
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+            if snapshot["generation"] == generation and snapshot["version"] == version:
+                self.count = snapshot["count"]
+                if "bloom" in snapshot:
+                    self.bloom = BloomFilter(snapshot["bloom"]["capacity"], snapshot["bloom"]["error_rate"],
+                                             base64.b64decode(snapshot["bloom"]["bits"]))
+                else:
+                    # Snapshots are saved sorted
+                    self.sorted_usernames = snapshot["usernames"]
+                    self.usernames = set(self.sorted_usernames)
+                return True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.rebuild(db)
+        return False
+
+    def rebuild(self, db):
+        '''Refills the directory from a full scan of Passwords'''
+        usernames = [row[0] for row in db.execute("SELECT Username FROM Passwords")]
+        with self.lock:
+            self.fill(usernames)
+
+    def fill(self, usernames):
+        self.count = len(usernames)
+        if self.count > self.bloom_threshold:
+            self.usernames = set()
+            self.sorted_usernames = []
+            self.bloom = BloomFilter(2 * self.count)
+            for username in usernames:
+                self.bloom.add(username)
+        else:
+            self.usernames = set(usernames)
+            self.sorted_usernames = sorted(self.usernames)
+            self.bloom = None
+
+    def contains(self, username):
+        '''Returns whether username exists, asking SQLite only when the Bloom filter says maybe'''
+        if self.bloom is None:
+            return username in self.usernames
+        if username not in self.bloom:
+            return False
+        return self.pool.connection().execute(
+            "SELECT Username FROM Passwords WHERE Username = ?", (username,)).fetchone() is not None
+
+    def existing(self, usernames):
+        '''Returns the subset of usernames that exist, with at most one SQLite query'''
+        if self.bloom is None:
+            return {username for username in usernames if username in self.usernames}
+        maybe = [username for username in usernames if username in self.bloom]
+        if not maybe:
+            return set()
+        return {row[0] for row in self.pool.connection().execute(
+            "SELECT Username FROM Passwords WHERE Username IN (SELECT value FROM json_each(?))", (json.dumps(maybe),))}
+
+    def search(self, prefix, after, limit):
+        '''Returns up to limit usernames starting with prefix, in order, that sort after after'''
+        if self.bloom is not None:
+            # The names are not in memory, so walk the primary key index instead
+            rows = self.pool.connection().execute(
+                "SELECT Username FROM Passwords WHERE Username >= ? AND Username > ? ORDER BY Username LIMIT ?",
+                (prefix, after, limit)).fetchall()
+            return [row[0] for row in rows if row[0].startswith(prefix)]
+        with self.lock:
+            start = max(bisect.bisect_left(self.sorted_usernames, prefix), bisect.bisect_right(self.sorted_usernames, after))
+            candidates = self.sorted_usernames[start:start + limit]
+        return [username for username in candidates if username.startswith(prefix)]
+
+    def add(self, db, username):
+        with self.lock:
+            self.count += 1
+            if self.bloom is not None:
+                self.bloom.add(username)
+                if self.count <= self.bloom.capacity:
+                    return
+                # Past capacity the error rate climbs, so start over with a filter twice the size
+                usernames = None
+            else:
+                self.usernames.add(username)
+                bisect.insort(self.sorted_usernames, username)
+                if self.count <= self.bloom_threshold:
+                    return
+                usernames = list(self.usernames)
+        if usernames is None:
+            self.rebuild(db)
+        else:
+            with self.lock:
+                self.fill(usernames)
+
+    def remove(self, username):
+        with self.lock:
+            self.count -= 1
+            if username in self.usernames:
+                self.usernames.remove(username)
+                del self.sorted_usernames[bisect.bisect_left(self.sorted_usernames, username)]
+
+    def save(self):
+        '''Writes the snapshot, tagged with the current UsersVersion, from the passwords writer thread'''
+        def write_snapshot(db):
+            generation, version = self.database_version(db)
+            with self.lock:
+                snapshot = {"generation": generation, "version": version, "count": self.count}
+                if self.bloom is None:
+                    snapshot["usernames"] = list(self.sorted_usernames)
+                else:
+                    snapshot["bloom"] = {"capacity": self.bloom.capacity, "error_rate": self.bloom.error_rate,
+                                         "bits": base64.b64encode(self.bloom.bits).decode()}
+            # Write to a temporary file first so a crash never leaves a half written snapshot
+            temporary_path = self.snapshot_path.with_suffix(".tmp")
+            with open(temporary_path, "w") as file:
+                json.dump(snapshot, file)
+            os.replace(temporary_path, self.snapshot_path)
+        self.pool.write(write_snapshot)
@@ -1,56 +1,148 @@
 '''
 Generate various timing and message size metrics. 
+
+For GetMessageResponses holding 10 to 500 English or Chinese messages, Generate records the
+serialized size, the time to serialize (SEND_TIME) and parse (RECIEVE_TIME) the response, and
+the full round trip of a GetMessage call against an in-process server (RPC_TIME), both plain
+(GRPC) and gzip compressed (GRPC_GZIP). It also records how well message bodies of growing
+length compress when stored in messages.db, and how long that takes. Times are in seconds.
 '''
 
 import grpc
 import chat_pb2
 import chat_pb2_grpc
 
+import gzip
+import socket
 import sys
+import tempfile
+import time
+from concurrent import futures
 
 import pandas as pd
 import matplotlib.pyplot as plt
 
 from Analytics.Analytics_test_data import SHORT_ENGLISH_MESSAGE, SHORT_CHINESE_MESSAGE
+from Database import database_paths
+from GRPCServer import ChatServiceServicer
+from Constants import BODY_COMPRESSION_THRESHOLD
+from Compression import compress_body, decompress_body
 
 OUTPUT_FILE = "Analytics/results.txt"
 WIRE_PROTOCOL_FILE = "Analytics/wire_protocol_results.txt"
+BODY_COMPRESSION_FILE = "Analytics/body_compression_results.txt"
 PLOT_PATH = "Analytics/Plots/"
+TIMING_REPEATS = 20
+BODY_TIMING_REPEATS = 1000
+MAX_LENGTH = 500
+
+def average_time(function, repeats=TIMING_REPEATS):
+    '''Returns the mean seconds function() takes over repeats calls'''
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+def start_test_server(data_dir, compression):
+    '''Starts an in-process server compressing its responses with compression, and returns it with its address'''
+    servicer = ChatServiceServicer(*database_paths(data_dir), durability="async")
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), compression=compression)
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server, servicer, f"127.0.0.1:{port}"
 
 def generate_timing():
     '''
-    Establish a test socket for sending messages, and check how long it takes to send 
-    messages of various length
+    Serialize and parse GetMessageResponses of various lengths, and time GetMessage calls
+    returning the same number of messages from an in-process server, with and without gzip
     '''
-    with open("Analytics/results.txt", "a") as file:
-        file.write(f"LENGTH\tENCODING_TYPE\tMESSAGE_TYPE\tMESSAGE_SIZE\n")
+    with open(OUTPUT_FILE, "w") as file:
+        file.write(f"LENGTH\tENCODING_TYPE\tMESSAGE_TYPE\tSEND_TIME\tRECIEVE_TIME\tMESSAGE_SIZE\tRPC_TIME\n")
 
     messages = [SHORT_ENGLISH_MESSAGE, SHORT_CHINESE_MESSAGE]
     names = ["ENGLISH_MESSAGE", "CHINESE_MESSAGE"]
-    for datalen in range(10, 510, 10):
-        for index, message in enumerate(messages):
-            message1 = chat_pb2.MessageObject(id=0, sender="a", recipient="b", time_sent="now", read=False, subject=message, body=message)
-
-            request = chat_pb2.GetMessageResponse(status=chat_pb2.Status.SUCCESS, messages=[message1]*datalen)
+    with tempfile.TemporaryDirectory() as data_dir:
+        for encoding, compression in (("GRPC", grpc.Compression.NoCompression), ("GRPC_GZIP", grpc.Compression.Gzip)):
+            # Both requests and responses are compressed in the gzip runs
+            server, servicer, address = start_test_server(data_dir, compression)
+            try:
+                with grpc.insecure_channel(address, compression=compression) as channel:
+                    stub = chat_pb2_grpc.ChatServiceStub(channel)
+                    if encoding == "GRPC":
+                        # One inbox per language, holding enough messages for the longest response
+                        for index, message in enumerate(messages):
+                            stub.CreateUser(chat_pb2.CreateUserRequest(username=names[index], password="password"))
+                            message1 = chat_pb2.MessageObject(sender="a", recipient=names[index], time_sent="now", subject=message, body=message)
+                            for _ in range(MAX_LENGTH):
+                                stub.SendMessage(chat_pb2.SendMessageRequest(message=message1))
+
+                    for datalen in range(10, MAX_LENGTH + 10, 10):
+                        for index, message in enumerate(messages):
+                            message1 = chat_pb2.MessageObject(id=0, sender="a", recipient="b", time_sent="now", read=False, subject=message, body=message)
+
+                            request = chat_pb2.GetMessageResponse(status=chat_pb2.Status.SUCCESS, messages=[message1]*datalen)
+
+                            serialized = request.SerializeToString()
+                            if compression == grpc.Compression.Gzip:
+                                send_time = average_time(lambda: gzip.compress(request.SerializeToString()))
+                                serialized = gzip.compress(serialized)
+                                receive_time = average_time(lambda: chat_pb2.GetMessageResponse.FromString(gzip.decompress(serialized)))
+                            else:
+                                send_time = average_time(request.SerializeToString)
+                                receive_time = average_time(lambda: chat_pb2.GetMessageResponse.FromString(serialized))
+
+                            get_request = chat_pb2.GetMessageRequest(limit=datalen, username=names[index])
+                            rpc_time = average_time(lambda: stub.GetMessage(get_request))
+
+                            with open(OUTPUT_FILE, "a") as file:
+                                file.write(f"{datalen}\t{encoding}\t{names[index]}\t{send_time}\t{receive_time}\t{len(serialized)}\t{rpc_time}\n")
+            finally:
+                server.stop(0)
+                servicer.close()
+
+def generate_body_compression():
+    '''
+    Store the first LENGTH characters of each test message the way messages.db does, recording
+    the stored size against the raw UTF-8 size and the time to compress and decompress it
+    '''
+    with open(BODY_COMPRESSION_FILE, "w") as file:
+        file.write(f"LENGTH\tMESSAGE_TYPE\tRAW_SIZE\tSTORED_SIZE\tRATIO\tCOMPRESS_TIME\tDECOMPRESS_TIME\n")
 
-            message = request.SerializeToString()
-            
-            with open(OUTPUT_FILE, "a") as file:
-                file.write(f"{datalen}\tGRPC\t{names[index]}\t{len(message)}\n")
+    messages = [SHORT_ENGLISH_MESSAGE, SHORT_CHINESE_MESSAGE]
+    names = ["ENGLISH_MESSAGE", "CHINESE_MESSAGE"]
+    for index, message in enumerate(messages):
+        for length in range(10, len(message) + 10, 10):
+            body = message[:length]
+            raw_size = len(body.encode())
+            # A threshold of 1 compresses every body that shrinks, to show where compression starts paying off
+            stored = compress_body(body, 1)
+            stored_size = len(stored) if isinstance(stored, bytes) else raw_size
+            compress_time = average_time(lambda: compress_body(body, 1), BODY_TIMING_REPEATS)
+            decompress_time = average_time(lambda: decompress_body(stored), BODY_TIMING_REPEATS)
+
+            with open(BODY_COMPRESSION_FILE, "a") as file:
+                file.write(f"{length}\t{names[index]}\t{raw_size}\t{stored_size}\t{stored_size / raw_size}\t{compress_time}\t{decompress_time}\n")
 
 def plot_graph(data, data_wire, metric, message_type, ylabel, title, filename):
     plt.figure(figsize=(8, 6))
-    for encoding in ['EncodeType.CUSTOM', 'EncodeType.JSON']:
+    # The wire protocols were never measured end to end over RPC
+    for encoding in ['EncodeType.CUSTOM', 'EncodeType.JSON'] if metric in data_wire else []:
         # Filter by message type and encoding type
         subset = data_wire[(data_wire['MESSAGE_TYPE'] == message_type) &
                       (data_wire['ENCODING_TYPE'] == encoding)]
         if not subset.empty:
             subset = subset.sort_values(by='LENGTH')
             plt.plot(subset['LENGTH'], subset[metric], marker='o', label=encoding)
-    subset = data[(data['MESSAGE_TYPE'] == message_type)]
-    if not subset.empty:
-        subset = subset.sort_values(by='LENGTH')
-        plt.plot(subset['LENGTH'], subset[metric], marker='o', label="Grpc")
+    for encoding, label in [('GRPC', "Grpc"), ('GRPC_GZIP', "Grpc (gzip)")]:
+        subset = data[(data['MESSAGE_TYPE'] == message_type) &
+                      (data['ENCODING_TYPE'] == encoding)]
+        if not subset.empty:
+            subset = subset.sort_values(by='LENGTH')
+            plt.plot(subset['LENGTH'], subset[metric], marker='o', label=label)
     plt.xlabel('Number of Messages in Response')
     plt.ylabel(ylabel)
     plt.title(title)
@@ -59,14 +151,32 @@ def plot_graph(data, data_wire, metric, message_type, ylabel, title, filename):
     plt.savefig(PLOT_PATH + filename, format='png')
     plt.close()
 
+def plot_body_compression(data, metric, ylabel, title, filename):
+    plt.figure(figsize=(8, 6))
+    for message_type, label in [('ENGLISH_MESSAGE', "English"), ('CHINESE_MESSAGE', "Chinese")]:
+        subset = data[data['MESSAGE_TYPE'] == message_type].sort_values(by='RAW_SIZE')
+        plt.plot(subset['RAW_SIZE'], subset[metric], marker='o', label=label)
+    plt.axvline(BODY_COMPRESSION_THRESHOLD, color='gray', linestyle='--', label="Storage threshold")
+    plt.xlabel('Body Size (bytes)')
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(PLOT_PATH + filename, format='png')
+    plt.close()
+
 def analyze():
     data = pd.read_csv(OUTPUT_FILE, sep='\t')
     data['LENGTH'] = pd.to_numeric(data['LENGTH'])
     data['MESSAGE_SIZE'] = pd.to_numeric(data['MESSAGE_SIZE']) / 1024
+    for metric in ['SEND_TIME', 'RECIEVE_TIME', 'RPC_TIME']:
+        data[metric] = pd.to_numeric(data[metric]) * 1000
 
     data_wire = pd.read_csv(WIRE_PROTOCOL_FILE, sep='\t')
     data_wire['LENGTH'] = pd.to_numeric(data_wire['LENGTH'])
     data_wire['MESSAGE_SIZE'] = pd.to_numeric(data_wire['MESSAGE_SIZE']) / 1024
+    for metric in ['SEND_TIME', 'RECIEVE_TIME']:
+        data_wire[metric] = pd.to_numeric(data_wire[metric]) * 1000
 
     language_label = {"ENGLISH_MESSAGE" : "English Messages", "CHINESE_MESSAGE" : "Chinese (Special Character) Messages"}
 
@@ -75,10 +185,27 @@ def analyze():
             ylabel=f"Size of Serialized message (kB)",
             title=f"Size of Serialized message (kB) for\n{language_label[language]} as a function of the\nNumber of Messages in the Response",
             filename=f"{language}_MESSAGE_SIZE.png")
+        for metric, description in [('SEND_TIME', "Serialize Time (ms)"), ('RECIEVE_TIME', "Parse Time (ms)"),
+                                    ('RPC_TIME', "GetMessage Round Trip Time (ms)")]:
+            plot_graph( data, data_wire, metric, language,
+                ylabel=description,
+                title=f"{description} for\n{language_label[language]} as a function of the\nNumber of Messages in the Response",
+                filename=f"{language}_{metric}.png")
+
+    data_body = pd.read_csv(BODY_COMPRESSION_FILE, sep='\t')
+    for metric in ['COMPRESS_TIME', 'DECOMPRESS_TIME']:
+        data_body[metric] = pd.to_numeric(data_body[metric]) * 1e6
+    plot_body_compression(data_body, 'RATIO', "Stored Size / Raw Size",
+        "Stored Message Body Size as a Fraction of its\nRaw Size as a function of the Body Size", "BODY_COMPRESSION_RATIO.png")
+    plot_body_compression(data_body, 'COMPRESS_TIME', "Compression Time (us)",
+        "Time to Compress a Message Body for Storage\nas a function of the Body Size", "BODY_COMPRESS_TIME.png")
+    plot_body_compression(data_body, 'DECOMPRESS_TIME', "Decompression Time (us)",
+        "Time to Decompress a Stored Message Body\nas a function of the Body Size", "BODY_DECOMPRESS_TIME.png")
 
 if __name__ == "__main__":
     if len(sys.argv) == 2 and sys.argv[1] == "Generate":
         generate_timing()
+        generate_body_compression()
     elif len(sys.argv) == 2 and sys.argv[1] == "Analyze":
         analyze()
     elif len(sys.argv) == 2 and sys.argv[1] == "Size":
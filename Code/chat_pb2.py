@@ -24,15 +24,17 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"(\n\x14\x43heckUsernameRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"5\n\x15\x43heckUsernameResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\":\n\x14\x43heckPasswordRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"5\n\x15\x43heckPasswordResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"7\n\x11\x43reateUserRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"2\n\x12\x43reateUserResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"\'\n\x13\x43onfirmLoginRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"e\n\x14\x43onfirmLoginResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x17\n\x0fnum_unread_msgs\x18\x02 \x01(\x03\x12\x16\n\x0enum_total_msgs\x18\x03 \x01(\x03\"(\n\x14\x43onfirmLogoutRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"5\n\x15\x43onfirmLogoutResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"\x17\n\x15GetOnlineUsersRequest\"E\n\x16GetOnlineUsersResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\r\n\x05users\x18\x02 \x03(\t\" \n\x0fGetUsersRequest\x12\r\n\x05query\x18\x01 \x01(\t\"?\n\x10GetUsersResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\r\n\x05users\x18\x02 \x03(\t\"~\n\rMessageObject\x12\n\n\x02id\x18\x01 \x01(\x03\x12\x0e\n\x06sender\x18\x02 \x01(\t\x12\x11\n\trecipient\x18\x03 \x01(\t\x12\x11\n\ttime_sent\x18\x04 \x01(\t\x12\x0c\n\x04read\x18\x05 \x01(\x08\x12\x0f\n\x07subject\x18\x06 \x01(\t\x12\x0c\n\x04\x62ody\x18\x07 \x01(\t\":\n\x12SendMessageRequest\x12$\n\x07message\x18\x01 \x01(\x0b\x32\x13.chat.MessageObject\"3\n\x13SendMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"Y\n\x11GetMessageRequest\x12\x0e\n\x06offset\x18\x01 \x01(\x03\x12\r\n\x05limit\x18\x02 \x01(\x03\x12\x13\n\x0bunread_only\x18\x03 \x01(\x08\x12\x10\n\x08username\x18\x04 \x01(\t\"Y\n\x12GetMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12%\n\x08messages\x18\x02 \x03(\x0b\x32\x13.chat.MessageObject\":\n\x12\x43onfirmReadRequest\x12\x12\n\nmessage_id\x18\x01 \x01(\x03\x12\x10\n\x08username\x18\x02 \x01(\t\"3\n\x13\x43onfirmReadResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"*\n\x14\x44\x65leteMessageRequest\x12\x12\n\nmessage_id\x18\x01 \x03(\x03\"5\n\x15\x44\x65leteMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\"%\n\x11\x44\x65leteUserRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"2\n\x12\x44\x65leteUserResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status*F\n\x06Status\x12\x0b\n\x07PENDING\x10\x00\x12\x0b\n\x07SUCCESS\x10\x01\x12\t\n\x05MATCH\x10\x02\x12\x0c\n\x08NO_MATCH\x10\x03\x12\t\n\x05\x45RROR\x10\x04\x32\xcf\x06\n\x0b\x43hatService\x12H\n\rCheckUsername\x12\x1a.chat.CheckUsernameRequest\x1a\x1b.chat.CheckUsernameResponse\x12H\n\rCheckPassword\x12\x1a.chat.CheckPasswordRequest\x1a\x1b.chat.CheckPasswordResponse\x12?\n\nCreateUser\x12\x17.chat.CreateUserRequest\x1a\x18.chat.CreateUserResponse\x12\x45\n\x0c\x43onfirmLogin\x12\x19.chat.ConfirmLoginRequest\x1a\x1a.chat.ConfirmLoginResponse\x12H\n\rConfirmLogout\x12\x1a.chat.ConfirmLogoutRequest\x1a\x1b.chat.ConfirmLogoutResponse\x12K\n\x0eGetOnlineUsers\x12\x1b.chat.GetOnlineUsersRequest\x1a\x1c.chat.GetOnlineUsersResponse\x12\x39\n\x08GetUsers\x12\x15.chat.GetUsersRequest\x1a\x16.chat.GetUsersResponse\x12\x42\n\x0bSendMessage\x12\x18.chat.SendMessageRequest\x1a\x19.chat.SendMessageResponse\x12?\n\nGetMessage\x12\x17.chat.GetMessageRequest\x1a\x18.chat.GetMessageResponse\x12\x42\n\x0b\x43onfirmRead\x12\x18.chat.ConfirmReadRequest\x1a\x19.chat.ConfirmReadResponse\x12H\n\rDeleteMessage\x12\x1a.chat.DeleteMessageRequest\x1a\x1b.chat.DeleteMessageResponse\x12?\n\nDeleteUser\x12\x17.chat.DeleteUserRequest\x1a\x18.chat.DeleteUserResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"(\n\x14\x43heckUsernameRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"5\n\x15\x43heckUsernameResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\":\n\x14\x43heckPasswordRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"L\n\x15\x43heckPasswordResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x15\n\rsession_token\x18\x02 \x01(\t\"7\n\x11\x43reateUserRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"H\n\x12\x43reateUserResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x14\n\x0c\x63ommit_token\x18\x02 \x01(\t\"\x89\x01\n\x0cLoginRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\x15\n\rmessage_limit\x18\x03 \x01(\x03\x12\x13\n\x0bunread_only\x18\x04 \x01(\x08\x12\x14\n\x0cusers_prefix\x18\x05 \x01(\t\x12\x13\n\x0busers_limit\x18\x06 \x01(\x03\"\x82\x02\n\rLoginResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x15\n\rsession_token\x18\x02 \x01(\t\x12\x17\n\x0fnum_unread_msgs\x18\x03 \x01(\x03\x12\x16\n\x0enum_total_msgs\x18\x04 \x01(\x03\x12%\n\x08messages\x18\x05 \x03(\x0b\x32\x13.chat.MessageObject\x12 \n\x18messages_next_page_token\x18\x06 \x01(\t\x12\r\n\x05users\x18\x07 \x03(\t\x12\x1d\n\x15users_next_page_token\x18\x08 \x01(\t\x12\x14\n\x0c\x63ommit_token\x18\t \x01(\t\"\'\n\x13\x43onfirmLoginRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"\x92\x01\n\x14\x43onfirmLoginResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x17\n\x0fnum_unread_msgs\x18\x02 \x01(\x03\x12\x16\n\x0enum_total_msgs\x18\x03 \x01(\x03\x12\x14\n\x0c\x63ommit_token\x18\x04 \x01(\t\x12\x15\n\rsession_token\x18\x05 \x01(\t\"(\n\x14\x43onfirmLogoutRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"K\n\x15\x43onfirmLogoutResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x14\n\x0c\x63ommit_token\x18\x02 \x01(\t\"1\n\x15GetOnlineUsersRequest\x12\x18\n\x10min_commit_token\x18\x01 \x01(\t\"E\n\x16GetOnlineUsersResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\r\n\x05users\x18\x02 \x03(\t\"$\n\x10HeartbeatRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"H\n\x11HeartbeatResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x15\n\rlease_seconds\x18\x02 \x01(\x01\"\x16\n\x14WatchPresenceRequest\"@\n\x0ePresenceUpdate\x12\x10\n\x08snapshot\x18\x01 \x01(\x08\x12\x0e\n\x06joined\x18\x02 \x03(\t\x12\x0c\n\x04left\x18\x03 \x03(\t\"m\n\x0fGetUsersRequest\x12\r\n\x05query\x18\x01 \x01(\t\x12\x0e\n\x06prefix\x18\x02 \x01(\t\x12\r\n\x05limit\x18\x03 \x01(\x03\x12\x12\n\npage_token\x18\x04 \x01(\t\x12\x18\n\x10min_commit_token\x18\x05 \x01(\t\"X\n\x10GetUsersResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\r\n\x05users\x18\x02 \x03(\t\x12\x17\n\x0fnext_page_token\x18\x03 \x01(\t\"~\n\rMessageObject\x12\n\n\x02id\x18\x01 \x01(\x03\x12\x0e\n\x06sender\x18\x02 \x01(\t\x12\x11\n\trecipient\x18\x03 \x01(\t\x12\x11\n\ttime_sent\x18\x04 \x01(\t\x12\x0c\n\x04read\x18\x05 \x01(\x08\x12\x0f\n\x07subject\x18\x06 \x01(\t\x12\x0c\n\x04\x62ody\x18\x07 \x01(\t\"N\n\x12SendMessageRequest\x12$\n\x07message\x18\x01 \x01(\x0b\x32\x13.chat.MessageObject\x12\x12\n\nrecipients\x18\x02 \x03(\t\"V\n\x0fRecipientStatus\x12\x11\n\trecipient\x18\x01 \x01(\t\x12\x1c\n\x06status\x18\x02 \x01(\x0e\x32\x0c.chat.Status\x12\x12\n\nmessage_id\x18\x03 \x01(\x03\"|\n\x13SendMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x31\n\x12recipient_statuses\x18\x02 \x03(\x0b\x32\x15.chat.RecipientStatus\x12\x14\n\x0c\x63ommit_token\x18\x03 \x01(\t\"\x87\x01\n\x11GetMessageRequest\x12\x0e\n\x06offset\x18\x01 \x01(\x03\x12\r\n\x05limit\x18\x02 \x01(\x03\x12\x13\n\x0bunread_only\x18\x03 \x01(\x08\x12\x10\n\x08username\x18\x04 \x01(\t\x12\x12\n\npage_token\x18\x05 \x01(\t\x12\x18\n\x10min_commit_token\x18\x06 \x01(\t\"r\n\x12GetMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12%\n\x08messages\x18\x02 \x03(\x0b\x32\x13.chat.MessageObject\x12\x17\n\x0fnext_page_token\x18\x03 \x01(\t\">\n\x10GetCountsRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x18\n\x10min_commit_token\x18\x02 \x01(\t\"b\n\x11GetCountsResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x17\n\x0fnum_unread_msgs\x18\x02 \x01(\x03\x12\x16\n\x0enum_total_msgs\x18\x03 \x01(\x03\"c\n\x13SyncMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x11\n\tsince_seq\x18\x02 \x01(\x03\x12\r\n\x05limit\x18\x03 \x01(\x03\x12\x18\n\x10min_commit_token\x18\x04 \x01(\t\"\xb6\x01\n\x14SyncMessagesResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12%\n\x08messages\x18\x02 \x03(\x0b\x32\x13.chat.MessageObject\x12\x13\n\x0b\x64\x65leted_ids\x18\x03 \x03(\x03\x12\x10\n\x08read_ids\x18\x04 \x03(\x03\x12\x10\n\x08next_seq\x18\x05 \x01(\x03\x12\x10\n\x08has_more\x18\x06 \x01(\x08\x12\x0e\n\x06resync\x18\x07 \x01(\x08\"a\n\x12\x43onfirmReadRequest\x12\x12\n\nmessage_id\x18\x01 \x01(\x03\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x03 \x03(\x03\x12\x10\n\x08up_to_id\x18\x04 \x01(\x03\"]\n\x13\x43onfirmReadResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x12\n\nnum_marked\x18\x02 \x01(\x03\x12\x14\n\x0c\x63ommit_token\x18\x03 \x01(\t\"[\n\x15SearchMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\r\n\x05query\x18\x02 \x01(\t\x12\r\n\x05limit\x18\x03 \x01(\x03\x12\x12\n\npage_token\x18\x04 \x01(\t\"v\n\x16SearchMessagesResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12%\n\x08messages\x18\x02 \x03(\x0b\x32\x13.chat.MessageObject\x12\x17\n\x0fnext_page_token\x18\x03 \x01(\t\"<\n\x14\x44\x65leteMessageRequest\x12\x12\n\nmessage_id\x18\x01 \x03(\x03\x12\x10\n\x08username\x18\x02 \x01(\t\"K\n\x15\x44\x65leteMessageResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x14\n\x0c\x63ommit_token\x18\x02 \x01(\t\",\n\x18SubscribeMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"%\n\x11\x44\x65leteUserRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"H\n\x12\x44\x65leteUserResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x14\n\x0c\x63ommit_token\x18\x02 \x01(\t\"7\n\x10ReplicateRequest\x12\x10\n\x08\x64\x61tabase\x18\x01 \x01(\t\x12\x11\n\tsince_seq\x18\x02 \x01(\x03\"Y\n\x10ReplicationBatch\x12\x0b\n\x03seq\x18\x01 \x01(\x03\x12\x12\n\nstatements\x18\x02 \x01(\x0c\x12\x10\n\x08snapshot\x18\x03 \x01(\x0c\x12\x12\n\nlast_chunk\x18\x04 \x01(\x08\"\x17\n\x15GetServerStatsRequest\"\xd8\x02\n\x0bMethodStats\x12\x0e\n\x06method\x18\x01 \x01(\t\x12\r\n\x05\x63\x61lls\x18\x02 \x01(\x03\x12\x0e\n\x06\x65rrors\x18\x03 \x01(\x03\x12\x31\n\x08statuses\x18\x04 \x03(\x0b\x32\x1f.chat.MethodStats.StatusesEntry\x12\x15\n\rrequest_bytes\x18\x05 \x01(\x03\x12\x16\n\x0eresponse_bytes\x18\x06 \x01(\x03\x12\x0e\n\x06p50_ms\x18\x07 \x01(\x01\x12\x0e\n\x06p95_ms\x18\x08 \x01(\x01\x12\x0e\n\x06p99_ms\x18\t \x01(\x01\x12\x10\n\x08total_ms\x18\n \x01(\x01\x12\x15\n\rsqlite_p50_ms\x18\x0b \x01(\x01\x12\x15\n\rsqlite_p99_ms\x18\x0c \x01(\x01\x12\x17\n\x0fsqlite_total_ms\x18\r \x01(\x01\x1a/\n\rStatusesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x03:\x02\x38\x01\"r\n\x16GetServerStatsResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\"\n\x07methods\x18\x02 \x03(\x0b\x32\x11.chat.MethodStats\x12\x16\n\x0euptime_seconds\x18\x03 \x01(\x01\"6\n\x15StartProfilingRequest\x12\x0e\n\x06method\x18\x01 \x01(\t\x12\r\n\x05\x63\x61lls\x18\x02 \x01(\x03\"K\n\x16StartProfilingResponse\x12\x1c\n\x06status\x18\x01 \x01(\x0e\x32\x0c.chat.Status\x12\x13\n\x0boutput_path\x18\x02 \x01(\t*F\n\x06Status\x12\x0b\n\x07PENDING\x10\x00\x12\x0b\n\x07SUCCESS\x10\x01\x12\t\n\x05MATCH\x10\x02\x12\x0c\n\x08NO_MATCH\x10\x03\x12\t\n\x05\x45RROR\x10\x04\x32\xfb\x0b\n\x0b\x43hatService\x12H\n\rCheckUsername\x12\x1a.chat.CheckUsernameRequest\x1a\x1b.chat.CheckUsernameResponse\x12H\n\rCheckPassword\x12\x1a.chat.CheckPasswordRequest\x1a\x1b.chat.CheckPasswordResponse\x12?\n\nCreateUser\x12\x17.chat.CreateUserRequest\x1a\x18.chat.CreateUserResponse\x12\x45\n\x0c\x43onfirmLogin\x12\x19.chat.ConfirmLoginRequest\x1a\x1a.chat.ConfirmLoginResponse\x12\x30\n\x05Login\x12\x12.chat.LoginRequest\x1a\x13.chat.LoginResponse\x12H\n\rConfirmLogout\x12\x1a.chat.ConfirmLogoutRequest\x1a\x1b.chat.ConfirmLogoutResponse\x12K\n\x0eGetOnlineUsers\x12\x1b.chat.GetOnlineUsersRequest\x1a\x1c.chat.GetOnlineUsersResponse\x12<\n\tHeartbeat\x12\x16.chat.HeartbeatRequest\x1a\x17.chat.HeartbeatResponse\x12\x43\n\rWatchPresence\x12\x1a.chat.WatchPresenceRequest\x1a\x14.chat.PresenceUpdate0\x01\x12\x39\n\x08GetUsers\x12\x15.chat.GetUsersRequest\x1a\x16.chat.GetUsersResponse\x12\x42\n\x0bSendMessage\x12\x18.chat.SendMessageRequest\x1a\x19.chat.SendMessageResponse\x12?\n\nGetMessage\x12\x17.chat.GetMessageRequest\x1a\x18.chat.GetMessageResponse\x12<\n\tGetCounts\x12\x16.chat.GetCountsRequest\x1a\x17.chat.GetCountsResponse\x12\x45\n\x0cSyncMessages\x12\x19.chat.SyncMessagesRequest\x1a\x1a.chat.SyncMessagesResponse\x12\x42\n\x0b\x43onfirmRead\x12\x18.chat.ConfirmReadRequest\x1a\x19.chat.ConfirmReadResponse\x12K\n\x0eSearchMessages\x12\x1b.chat.SearchMessagesRequest\x1a\x1c.chat.SearchMessagesResponse\x12H\n\rDeleteMessage\x12\x1a.chat.DeleteMessageRequest\x1a\x1b.chat.DeleteMessageResponse\x12?\n\nDeleteUser\x12\x17.chat.DeleteUserRequest\x1a\x18.chat.DeleteUserResponse\x12J\n\x11SubscribeMessages\x12\x1e.chat.SubscribeMessagesRequest\x1a\x13.chat.MessageObject0\x01\x12=\n\tReplicate\x12\x16.chat.ReplicateRequest\x1a\x16.chat.ReplicationBatch0\x01\x12K\n\x0eGetServerStats\x12\x1b.chat.GetServerStatsRequest\x1a\x1c.chat.GetServerStatsResponse\x12K\n\x0eStartProfiling\x12\x1b.chat.StartProfilingRequest\x1a\x1c.chat.StartProfilingResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
-  _globals['_STATUS']._serialized_start=1503
-  _globals['_STATUS']._serialized_end=1573
+  _globals['_METHODSTATS_STATUSESENTRY']._loaded_options = None
+  _globals['_METHODSTATS_STATUSESENTRY']._serialized_options = b'8\001'
+  _globals['_STATUS']._serialized_start=4221
+  _globals['_STATUS']._serialized_end=4291
   _globals['_CHECKUSERNAMEREQUEST']._serialized_start=20
   _globals['_CHECKUSERNAMEREQUEST']._serialized_end=60
   _globals['_CHECKUSERNAMERESPONSE']._serialized_start=62
@@ -40,49 +42,93 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_CHECKPASSWORDREQUEST']._serialized_start=117
   _globals['_CHECKPASSWORDREQUEST']._serialized_end=175
   _globals['_CHECKPASSWORDRESPONSE']._serialized_start=177
-  _globals['_CHECKPASSWORDRESPONSE']._serialized_end=230
-  _globals['_CREATEUSERREQUEST']._serialized_start=232
-  _globals['_CREATEUSERREQUEST']._serialized_end=287
-  _globals['_CREATEUSERRESPONSE']._serialized_start=289
-  _globals['_CREATEUSERRESPONSE']._serialized_end=339
-  _globals['_CONFIRMLOGINREQUEST']._serialized_start=341
-  _globals['_CONFIRMLOGINREQUEST']._serialized_end=380
-  _globals['_CONFIRMLOGINRESPONSE']._serialized_start=382
-  _globals['_CONFIRMLOGINRESPONSE']._serialized_end=483
-  _globals['_CONFIRMLOGOUTREQUEST']._serialized_start=485
-  _globals['_CONFIRMLOGOUTREQUEST']._serialized_end=525
-  _globals['_CONFIRMLOGOUTRESPONSE']._serialized_start=527
-  _globals['_CONFIRMLOGOUTRESPONSE']._serialized_end=580
-  _globals['_GETONLINEUSERSREQUEST']._serialized_start=582
-  _globals['_GETONLINEUSERSREQUEST']._serialized_end=605
-  _globals['_GETONLINEUSERSRESPONSE']._serialized_start=607
-  _globals['_GETONLINEUSERSRESPONSE']._serialized_end=676
-  _globals['_GETUSERSREQUEST']._serialized_start=678
-  _globals['_GETUSERSREQUEST']._serialized_end=710
-  _globals['_GETUSERSRESPONSE']._serialized_start=712
-  _globals['_GETUSERSRESPONSE']._serialized_end=775
-  _globals['_MESSAGEOBJECT']._serialized_start=777
-  _globals['_MESSAGEOBJECT']._serialized_end=903
-  _globals['_SENDMESSAGEREQUEST']._serialized_start=905
-  _globals['_SENDMESSAGEREQUEST']._serialized_end=963
-  _globals['_SENDMESSAGERESPONSE']._serialized_start=965
-  _globals['_SENDMESSAGERESPONSE']._serialized_end=1016
-  _globals['_GETMESSAGEREQUEST']._serialized_start=1018
-  _globals['_GETMESSAGEREQUEST']._serialized_end=1107
-  _globals['_GETMESSAGERESPONSE']._serialized_start=1109
-  _globals['_GETMESSAGERESPONSE']._serialized_end=1198
-  _globals['_CONFIRMREADREQUEST']._serialized_start=1200
-  _globals['_CONFIRMREADREQUEST']._serialized_end=1258
-  _globals['_CONFIRMREADRESPONSE']._serialized_start=1260
-  _globals['_CONFIRMREADRESPONSE']._serialized_end=1311
-  _globals['_DELETEMESSAGEREQUEST']._serialized_start=1313
-  _globals['_DELETEMESSAGEREQUEST']._serialized_end=1355
-  _globals['_DELETEMESSAGERESPONSE']._serialized_start=1357
-  _globals['_DELETEMESSAGERESPONSE']._serialized_end=1410
-  _globals['_DELETEUSERREQUEST']._serialized_start=1412
-  _globals['_DELETEUSERREQUEST']._serialized_end=1449
-  _globals['_DELETEUSERRESPONSE']._serialized_start=1451
-  _globals['_DELETEUSERRESPONSE']._serialized_end=1501
-  _globals['_CHATSERVICE']._serialized_start=1576
-  _globals['_CHATSERVICE']._serialized_end=2423
+  _globals['_CHECKPASSWORDRESPONSE']._serialized_end=253
+  _globals['_CREATEUSERREQUEST']._serialized_start=255
+  _globals['_CREATEUSERREQUEST']._serialized_end=310
+  _globals['_CREATEUSERRESPONSE']._serialized_start=312
+  _globals['_CREATEUSERRESPONSE']._serialized_end=384
+  _globals['_LOGINREQUEST']._serialized_start=387
+  _globals['_LOGINREQUEST']._serialized_end=524
+  _globals['_LOGINRESPONSE']._serialized_start=527
+  _globals['_LOGINRESPONSE']._serialized_end=785
+  _globals['_CONFIRMLOGINREQUEST']._serialized_start=787
+  _globals['_CONFIRMLOGINREQUEST']._serialized_end=826
+  _globals['_CONFIRMLOGINRESPONSE']._serialized_start=829
+  _globals['_CONFIRMLOGINRESPONSE']._serialized_end=975
+  _globals['_CONFIRMLOGOUTREQUEST']._serialized_start=977
+  _globals['_CONFIRMLOGOUTREQUEST']._serialized_end=1017
+  _globals['_CONFIRMLOGOUTRESPONSE']._serialized_start=1019
+  _globals['_CONFIRMLOGOUTRESPONSE']._serialized_end=1094
+  _globals['_GETONLINEUSERSREQUEST']._serialized_start=1096
+  _globals['_GETONLINEUSERSREQUEST']._serialized_end=1145
+  _globals['_GETONLINEUSERSRESPONSE']._serialized_start=1147
+  _globals['_GETONLINEUSERSRESPONSE']._serialized_end=1216
+  _globals['_HEARTBEATREQUEST']._serialized_start=1218
+  _globals['_HEARTBEATREQUEST']._serialized_end=1254
+  _globals['_HEARTBEATRESPONSE']._serialized_start=1256
+  _globals['_HEARTBEATRESPONSE']._serialized_end=1328
+  _globals['_WATCHPRESENCEREQUEST']._serialized_start=1330
+  _globals['_WATCHPRESENCEREQUEST']._serialized_end=1352
+  _globals['_PRESENCEUPDATE']._serialized_start=1354
+  _globals['_PRESENCEUPDATE']._serialized_end=1418
+  _globals['_GETUSERSREQUEST']._serialized_start=1420
+  _globals['_GETUSERSREQUEST']._serialized_end=1529
+  _globals['_GETUSERSRESPONSE']._serialized_start=1531
+  _globals['_GETUSERSRESPONSE']._serialized_end=1619
+  _globals['_MESSAGEOBJECT']._serialized_start=1621
+  _globals['_MESSAGEOBJECT']._serialized_end=1747
+  _globals['_SENDMESSAGEREQUEST']._serialized_start=1749
+  _globals['_SENDMESSAGEREQUEST']._serialized_end=1827
+  _globals['_RECIPIENTSTATUS']._serialized_start=1829
+  _globals['_RECIPIENTSTATUS']._serialized_end=1915
+  _globals['_SENDMESSAGERESPONSE']._serialized_start=1917
+  _globals['_SENDMESSAGERESPONSE']._serialized_end=2041
+  _globals['_GETMESSAGEREQUEST']._serialized_start=2044
+  _globals['_GETMESSAGEREQUEST']._serialized_end=2179
+  _globals['_GETMESSAGERESPONSE']._serialized_start=2181
+  _globals['_GETMESSAGERESPONSE']._serialized_end=2295
+  _globals['_GETCOUNTSREQUEST']._serialized_start=2297
+  _globals['_GETCOUNTSREQUEST']._serialized_end=2359
+  _globals['_GETCOUNTSRESPONSE']._serialized_start=2361
+  _globals['_GETCOUNTSRESPONSE']._serialized_end=2459
+  _globals['_SYNCMESSAGESREQUEST']._serialized_start=2461
+  _globals['_SYNCMESSAGESREQUEST']._serialized_end=2560
+  _globals['_SYNCMESSAGESRESPONSE']._serialized_start=2563
+  _globals['_SYNCMESSAGESRESPONSE']._serialized_end=2745
+  _globals['_CONFIRMREADREQUEST']._serialized_start=2747
+  _globals['_CONFIRMREADREQUEST']._serialized_end=2844
+  _globals['_CONFIRMREADRESPONSE']._serialized_start=2846
+  _globals['_CONFIRMREADRESPONSE']._serialized_end=2939
+  _globals['_SEARCHMESSAGESREQUEST']._serialized_start=2941
+  _globals['_SEARCHMESSAGESREQUEST']._serialized_end=3032
+  _globals['_SEARCHMESSAGESRESPONSE']._serialized_start=3034
+  _globals['_SEARCHMESSAGESRESPONSE']._serialized_end=3152
+  _globals['_DELETEMESSAGEREQUEST']._serialized_start=3154
+  _globals['_DELETEMESSAGEREQUEST']._serialized_end=3214
+  _globals['_DELETEMESSAGERESPONSE']._serialized_start=3216
+  _globals['_DELETEMESSAGERESPONSE']._serialized_end=3291
+  _globals['_SUBSCRIBEMESSAGESREQUEST']._serialized_start=3293
+  _globals['_SUBSCRIBEMESSAGESREQUEST']._serialized_end=3337
+  _globals['_DELETEUSERREQUEST']._serialized_start=3339
+  _globals['_DELETEUSERREQUEST']._serialized_end=3376
+  _globals['_DELETEUSERRESPONSE']._serialized_start=3378
+  _globals['_DELETEUSERRESPONSE']._serialized_end=3450
+  _globals['_REPLICATEREQUEST']._serialized_start=3452
+  _globals['_REPLICATEREQUEST']._serialized_end=3507
+  _globals['_REPLICATIONBATCH']._serialized_start=3509
+  _globals['_REPLICATIONBATCH']._serialized_end=3598
+  _globals['_GETSERVERSTATSREQUEST']._serialized_start=3600
+  _globals['_GETSERVERSTATSREQUEST']._serialized_end=3623
+  _globals['_METHODSTATS']._serialized_start=3626
+  _globals['_METHODSTATS']._serialized_end=3970
+  _globals['_METHODSTATS_STATUSESENTRY']._serialized_start=3923
+  _globals['_METHODSTATS_STATUSESENTRY']._serialized_end=3970
+  _globals['_GETSERVERSTATSRESPONSE']._serialized_start=3972
+  _globals['_GETSERVERSTATSRESPONSE']._serialized_end=4086
+  _globals['_STARTPROFILINGREQUEST']._serialized_start=4088
+  _globals['_STARTPROFILINGREQUEST']._serialized_end=4142
+  _globals['_STARTPROFILINGRESPONSE']._serialized_start=4144
+  _globals['_STARTPROFILINGRESPONSE']._serialized_end=4219
+  _globals['_CHATSERVICE']._serialized_start=4294
+  _globals['_CHATSERVICE']._serialized_end=5825
 # @@protoc_insertion_point(module_scope)
@@ -56,6 +56,11 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.ConfirmLoginRequest.SerializeToString,
                 response_deserializer=chat__pb2.ConfirmLoginResponse.FromString,
                 _registered_method=True)
+        self.Login = channel.unary_unary(
+                '/chat.ChatService/Login',
+                request_serializer=chat__pb2.LoginRequest.SerializeToString,
+                response_deserializer=chat__pb2.LoginResponse.FromString,
+                _registered_method=True)
         self.ConfirmLogout = channel.unary_unary(
                 '/chat.ChatService/ConfirmLogout',
                 request_serializer=chat__pb2.ConfirmLogoutRequest.SerializeToString,
@@ -66,6 +71,16 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.GetOnlineUsersRequest.SerializeToString,
                 response_deserializer=chat__pb2.GetOnlineUsersResponse.FromString,
                 _registered_method=True)
+        self.Heartbeat = channel.unary_unary(
+                '/chat.ChatService/Heartbeat',
+                request_serializer=chat__pb2.HeartbeatRequest.SerializeToString,
+                response_deserializer=chat__pb2.HeartbeatResponse.FromString,
+                _registered_method=True)
+        self.WatchPresence = channel.unary_stream(
+                '/chat.ChatService/WatchPresence',
+                request_serializer=chat__pb2.WatchPresenceRequest.SerializeToString,
+                response_deserializer=chat__pb2.PresenceUpdate.FromString,
+                _registered_method=True)
         self.GetUsers = channel.unary_unary(
                 '/chat.ChatService/GetUsers',
                 request_serializer=chat__pb2.GetUsersRequest.SerializeToString,
@@ -81,11 +96,26 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.GetMessageRequest.SerializeToString,
                 response_deserializer=chat__pb2.GetMessageResponse.FromString,
                 _registered_method=True)
+        self.GetCounts = channel.unary_unary(
+                '/chat.ChatService/GetCounts',
+                request_serializer=chat__pb2.GetCountsRequest.SerializeToString,
+                response_deserializer=chat__pb2.GetCountsResponse.FromString,
+                _registered_method=True)
+        self.SyncMessages = channel.unary_unary(
+                '/chat.ChatService/SyncMessages',
+                request_serializer=chat__pb2.SyncMessagesRequest.SerializeToString,
+                response_deserializer=chat__pb2.SyncMessagesResponse.FromString,
+                _registered_method=True)
         self.ConfirmRead = channel.unary_unary(
                 '/chat.ChatService/ConfirmRead',
                 request_serializer=chat__pb2.ConfirmReadRequest.SerializeToString,
                 response_deserializer=chat__pb2.ConfirmReadResponse.FromString,
                 _registered_method=True)
+        self.SearchMessages = channel.unary_unary(
+                '/chat.ChatService/SearchMessages',
+                request_serializer=chat__pb2.SearchMessagesRequest.SerializeToString,
+                response_deserializer=chat__pb2.SearchMessagesResponse.FromString,
+                _registered_method=True)
         self.DeleteMessage = channel.unary_unary(
                 '/chat.ChatService/DeleteMessage',
                 request_serializer=chat__pb2.DeleteMessageRequest.SerializeToString,
@@ -96,6 +126,26 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.DeleteUserRequest.SerializeToString,
                 response_deserializer=chat__pb2.DeleteUserResponse.FromString,
                 _registered_method=True)
+        self.SubscribeMessages = channel.unary_stream(
+                '/chat.ChatService/SubscribeMessages',
+                request_serializer=chat__pb2.SubscribeMessagesRequest.SerializeToString,
+                response_deserializer=chat__pb2.MessageObject.FromString,
+                _registered_method=True)
+        self.Replicate = channel.unary_stream(
+                '/chat.ChatService/Replicate',
+                request_serializer=chat__pb2.ReplicateRequest.SerializeToString,
+                response_deserializer=chat__pb2.ReplicationBatch.FromString,
+                _registered_method=True)
+        self.GetServerStats = channel.unary_unary(
+                '/chat.ChatService/GetServerStats',
+                request_serializer=chat__pb2.GetServerStatsRequest.SerializeToString,
+                response_deserializer=chat__pb2.GetServerStatsResponse.FromString,
+                _registered_method=True)
+        self.StartProfiling = channel.unary_unary(
+                '/chat.ChatService/StartProfiling',
+                request_serializer=chat__pb2.StartProfilingRequest.SerializeToString,
+                response_deserializer=chat__pb2.StartProfilingResponse.FromString,
+                _registered_method=True)
 
 
 class ChatServiceServicer(object):
@@ -128,6 +178,12 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Login(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ConfirmLogout(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -140,6 +196,18 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Heartbeat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchPresence(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def GetUsers(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -159,12 +227,30 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def GetCounts(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SyncMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ConfirmRead(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SearchMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def DeleteMessage(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -177,6 +263,32 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SubscribeMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Replicate(self, request, context):
+        """Replication.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetServerStats(self, request, context):
+        """Monitoring.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StartProfiling(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -200,6 +312,11 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.ConfirmLoginRequest.FromString,
                     response_serializer=chat__pb2.ConfirmLoginResponse.SerializeToString,
             ),
+            'Login': grpc.unary_unary_rpc_method_handler(
+                    servicer.Login,
+                    request_deserializer=chat__pb2.LoginRequest.FromString,
+                    response_serializer=chat__pb2.LoginResponse.SerializeToString,
+            ),
             'ConfirmLogout': grpc.unary_unary_rpc_method_handler(
                     servicer.ConfirmLogout,
                     request_deserializer=chat__pb2.ConfirmLogoutRequest.FromString,
@@ -210,6 +327,16 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.GetOnlineUsersRequest.FromString,
                     response_serializer=chat__pb2.GetOnlineUsersResponse.SerializeToString,
             ),
+            'Heartbeat': grpc.unary_unary_rpc_method_handler(
+                    servicer.Heartbeat,
+                    request_deserializer=chat__pb2.HeartbeatRequest.FromString,
+                    response_serializer=chat__pb2.HeartbeatResponse.SerializeToString,
+            ),
+            'WatchPresence': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchPresence,
+                    request_deserializer=chat__pb2.WatchPresenceRequest.FromString,
+                    response_serializer=chat__pb2.PresenceUpdate.SerializeToString,
+            ),
             'GetUsers': grpc.unary_unary_rpc_method_handler(
                     servicer.GetUsers,
                     request_deserializer=chat__pb2.GetUsersRequest.FromString,
@@ -225,11 +352,26 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.GetMessageRequest.FromString,
                     response_serializer=chat__pb2.GetMessageResponse.SerializeToString,
             ),
+            'GetCounts': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetCounts,
+                    request_deserializer=chat__pb2.GetCountsRequest.FromString,
+                    response_serializer=chat__pb2.GetCountsResponse.SerializeToString,
+            ),
+            'SyncMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.SyncMessages,
+                    request_deserializer=chat__pb2.SyncMessagesRequest.FromString,
+                    response_serializer=chat__pb2.SyncMessagesResponse.SerializeToString,
+            ),
             'ConfirmRead': grpc.unary_unary_rpc_method_handler(
                     servicer.ConfirmRead,
                     request_deserializer=chat__pb2.ConfirmReadRequest.FromString,
                     response_serializer=chat__pb2.ConfirmReadResponse.SerializeToString,
             ),
+            'SearchMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.SearchMessages,
+                    request_deserializer=chat__pb2.SearchMessagesRequest.FromString,
+                    response_serializer=chat__pb2.SearchMessagesResponse.SerializeToString,
+            ),
             'DeleteMessage': grpc.unary_unary_rpc_method_handler(
                     servicer.DeleteMessage,
                     request_deserializer=chat__pb2.DeleteMessageRequest.FromString,
@@ -240,6 +382,26 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.DeleteUserRequest.FromString,
                     response_serializer=chat__pb2.DeleteUserResponse.SerializeToString,
             ),
+            'SubscribeMessages': grpc.unary_stream_rpc_method_handler(
+                    servicer.SubscribeMessages,
+                    request_deserializer=chat__pb2.SubscribeMessagesRequest.FromString,
+                    response_serializer=chat__pb2.MessageObject.SerializeToString,
+            ),
+            'Replicate': grpc.unary_stream_rpc_method_handler(
+                    servicer.Replicate,
+                    request_deserializer=chat__pb2.ReplicateRequest.FromString,
+                    response_serializer=chat__pb2.ReplicationBatch.SerializeToString,
+            ),
+            'GetServerStats': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetServerStats,
+                    request_deserializer=chat__pb2.GetServerStatsRequest.FromString,
+                    response_serializer=chat__pb2.GetServerStatsResponse.SerializeToString,
+            ),
+            'StartProfiling': grpc.unary_unary_rpc_method_handler(
+                    servicer.StartProfiling,
+                    request_deserializer=chat__pb2.StartProfilingRequest.FromString,
+                    response_serializer=chat__pb2.StartProfilingResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'chat.ChatService', rpc_method_handlers)
@@ -361,6 +523,33 @@ class ChatService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def Login(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/Login',
+            chat__pb2.LoginRequest.SerializeToString,
+            chat__pb2.LoginResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def ConfirmLogout(request,
             target,
@@ -415,6 +604,60 @@ class ChatService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def Heartbeat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/Heartbeat',
+            chat__pb2.HeartbeatRequest.SerializeToString,
+            chat__pb2.HeartbeatResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def WatchPresence(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/chat.ChatService/WatchPresence',
+            chat__pb2.WatchPresenceRequest.SerializeToString,
+            chat__pb2.PresenceUpdate.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def GetUsers(request,
             target,
@@ -496,6 +739,60 @@ class ChatService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def GetCounts(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/GetCounts',
+            chat__pb2.GetCountsRequest.SerializeToString,
+            chat__pb2.GetCountsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def SyncMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/SyncMessages',
+            chat__pb2.SyncMessagesRequest.SerializeToString,
+            chat__pb2.SyncMessagesResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def ConfirmRead(request,
             target,
@@ -523,6 +820,33 @@ class ChatService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def SearchMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/SearchMessages',
+            chat__pb2.SearchMessagesRequest.SerializeToString,
+            chat__pb2.SearchMessagesResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def DeleteMessage(request,
             target,
@@ -576,3 +900,111 @@ class ChatService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def SubscribeMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/chat.ChatService/SubscribeMessages',
+            chat__pb2.SubscribeMessagesRequest.SerializeToString,
+            chat__pb2.MessageObject.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Replicate(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/chat.ChatService/Replicate',
+            chat__pb2.ReplicateRequest.SerializeToString,
+            chat__pb2.ReplicationBatch.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetServerStats(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/GetServerStats',
+            chat__pb2.GetServerStatsRequest.SerializeToString,
+            chat__pb2.GetServerStatsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def StartProfiling(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/StartProfiling',
+            chat__pb2.StartProfilingRequest.SerializeToString,
+            chat__pb2.StartProfilingResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
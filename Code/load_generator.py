@@ -0,0 +1,260 @@
+'''
+Drive a running chat server with simulated users and report per-RPC throughput and latency.
+
+Simulated users are spread over several processes, each running its users on threads. Users
+arrive (log in with one Login call) as a Poisson process at --arrival-rate per second, then
+repeatedly wait an exponentially distributed think time (mean 1 / --action-rate seconds) and
+perform an action drawn from the workload mix: send a message, poll their counts, sync their
+inbox, read a page and mark it read, or delete messages. Every call after the login carries
+the session token it returned. A share of users hold a SubscribeMessages stream open for
+their whole session, which keeps them online; the rest send a Heartbeat every
+PRESENCE_HEARTBEAT_INTERVAL seconds. Every user logs out when the run ends.
+
+Each open stream holds one of GRPCServer.py's worker threads, and it turns away streams past
+its --max-streams; those users heartbeat instead. Load GRPCAioServer.py for many subscribers.
+
+With --replicas, each user reads their inbox (GetMessage) from one of the given replicas,
+passing the commit token of their last write so that they always see it.
+
+One line per RPC is appended to Analytics/load_results.txt, tab separated like the other
+Analytics results, with throughput and p50/p99/p999 latency in milliseconds.
+
+Usage: python load_generator.py HOSTNAME SERVER_PORT [--users 100] [--processes 4] [--duration 30]
+                                [--mix chat] [--arrival-rate 20] [--action-rate 1] [--subscribers 0.5]
+                                [--replicas HOST:PORT ...]
+'''
+
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+from Constants import PRESENCE_HEARTBEAT_INTERVAL
+from Sessions import SessionStub
+
+OUTPUT_FILE = Path(__file__).parent / "Analytics/load_results.txt"
+
+# Relative weights of each action in a workload mix
+MIXES = {
+    # Mostly reading, with some sending: a typical chat client
+    "chat": {"send": 3, "poll": 3, "sync": 2, "read": 2, "delete": 0.5},
+    # Users catching up on a backlog
+    "reader": {"send": 1, "poll": 2, "sync": 3, "read": 6, "delete": 1},
+    # Bursty announcements and chatter
+    "sender": {"send": 8, "poll": 1, "sync": 1, "read": 1, "delete": 0.5},
+}
+
+def parse_mix(text):
+    '''Returns a preset mix by name, or parses "send=3,read=1,..." into weights'''
+    if text in MIXES:
+        return MIXES[text]
+    mix = {}
+    for part in text.split(","):
+        action, weight = part.split("=")
+        if action not in MIXES["chat"]:
+            raise argparse.ArgumentTypeError(f"Unknown action {action!r}")
+        mix[action] = float(weight)
+    return mix
+
+class Recorder:
+    '''Collects the latency of every call a process makes, per RPC. Calls over timeout seconds count as errors'''
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def call(self, rpc, function, request):
+        start = time.perf_counter()
+        try:
+            response = function(request, timeout=self.timeout)
+        except grpc.RpcError:
+            with self.lock:
+                self.errors[rpc] = self.errors.get(rpc, 0) + 1
+            return None
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.latencies.setdefault(rpc, []).append(elapsed)
+        return response
+
+class SimulatedUser:
+    def __init__(self, stub, recorder, username, usernames, rng, read_stub=None):
+        self.stub = stub
+        # Inbox reads go here (a replica, or the server itself), waiting for commit_token, the user's last write
+        self.read_stub = read_stub or stub
+        self.commit_token = ""
+        self.recorder = recorder
+        self.username = username
+        self.usernames = usernames
+        self.rng = rng
+        self.sync_seq = 0
+        self.inbox = set()
+
+    def send(self):
+        message = chat_pb2.MessageObject(sender=self.username, recipient=self.rng.choice(self.usernames),
+                                         time_sent=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                                         subject="Load", body="Load generator message body " * self.rng.randint(1, 20))
+        self.wrote(self.recorder.call("SendMessage", self.stub.SendMessage, chat_pb2.SendMessageRequest(message=message)))
+
+    def wrote(self, response):
+        if response is not None and response.commit_token:
+            self.commit_token = response.commit_token
+
+    def poll(self):
+        self.recorder.call("GetCounts", self.stub.GetCounts, chat_pb2.GetCountsRequest(username=self.username))
+
+    def sync(self):
+        response = self.recorder.call("SyncMessages", self.stub.SyncMessages,
+                                      chat_pb2.SyncMessagesRequest(username=self.username, since_seq=self.sync_seq))
+        if response is not None and response.resync:
+            self.inbox.clear()
+            self.sync_seq = 0
+        elif response is not None and response.status == chat_pb2.Status.SUCCESS:
+            self.inbox.update(message.id for message in response.messages)
+            self.inbox.difference_update(response.deleted_ids)
+            self.sync_seq = response.next_seq
+
+    def read(self):
+        response = self.recorder.call("GetMessage", self.read_stub.GetMessage, chat_pb2.GetMessageRequest(
+            limit=20, unread_only=True, username=self.username, min_commit_token=self.commit_token))
+        if response is not None and response.messages:
+            self.wrote(self.recorder.call("ConfirmRead", self.stub.ConfirmRead, chat_pb2.ConfirmReadRequest(
+                message_ids=[message.id for message in response.messages], username=self.username)))
+
+    def delete(self):
+        if not self.inbox:
+            return
+        message_ids = self.rng.sample(sorted(self.inbox), min(len(self.inbox), self.rng.randint(1, 5)))
+        self.wrote(self.recorder.call("DeleteMessage", self.stub.DeleteMessage,
+                                      chat_pb2.DeleteMessageRequest(message_id=message_ids, username=self.username)))
+        self.inbox.difference_update(message_ids)
+
+def drain(subscription):
+    try:
+        for _ in subscription:
+            pass
+    except grpc.RpcError:
+        return
+
+def run_user(stub, read_stubs, recorder, username, usernames, mix, args, start_at, deadline, seed):
+    rng = random.Random(seed)
+    time.sleep(max(0, start_at - time.perf_counter()))
+    login = recorder.call("Login", stub.Login, chat_pb2.LoginRequest(username=username, password="password",
+                                                                     message_limit=20, unread_only=True))
+    if login is None or login.status != chat_pb2.Status.SUCCESS:
+        return
+    stub = SessionStub(stub, login.session_token)
+    user = SimulatedUser(stub, recorder, username, usernames, rng, rng.choice(read_stubs) if read_stubs else None)
+    user.wrote(login)
+    subscription = None
+    if rng.random() < args.subscribers:
+        subscription = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=username))
+        threading.Thread(target=drain, args=(subscription,), daemon=True).start()
+    actions, weights = zip(*mix.items())
+    heartbeat_at = time.perf_counter() + PRESENCE_HEARTBEAT_INTERVAL
+    while True:
+        wake = time.perf_counter() + rng.expovariate(args.action_rate)
+        if wake >= deadline:
+            break
+        # Users without a stream (or whose stream the server turned away) keep themselves online
+        while (subscription is None or subscription.done()) and heartbeat_at < wake:
+            time.sleep(max(0, heartbeat_at - time.perf_counter()))
+            recorder.call("Heartbeat", stub.Heartbeat, chat_pb2.HeartbeatRequest(username=username))
+            heartbeat_at += PRESENCE_HEARTBEAT_INTERVAL
+        time.sleep(max(0, wake - time.perf_counter()))
+        getattr(user, rng.choices(actions, weights)[0])()
+    if subscription is not None:
+        subscription.cancel()
+    recorder.call("ConfirmLogout", stub.ConfirmLogout, chat_pb2.ConfirmLogoutRequest(username=username))
+
+def run_process(address, users, usernames, mix, args, start, seed):
+    '''Runs this process' share of users, given as (username, arrival offset), and returns its latencies'''
+    recorder = Recorder(args.timeout)
+    deadline = start + args.duration
+    replica_channels = [grpc.insecure_channel(replica) for replica in args.replicas]
+    read_stubs = [chat_pb2_grpc.ChatServiceStub(channel) for channel in replica_channels]
+    with grpc.insecure_channel(address) as channel:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        # perf_counter is not shared between processes, so rebase the schedule on this process' clock
+        offset = time.perf_counter() - time.time()
+        threads = [threading.Thread(target=run_user, args=(stub, read_stubs, recorder, username, usernames, mix, args,
+                                                           start + offset + arrival, deadline + offset, seed + i))
+                   for i, (username, arrival) in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for replica_channel in replica_channels:
+        replica_channel.close()
+    return recorder.latencies, recorder.errors
+
+def percentile(values, fraction):
+    '''Nearest rank percentile of sorted values'''
+    return values[min(len(values) - 1, max(0, int(fraction * len(values) + 0.5) - 1))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a running chat server with simulated users")
+    parser.add_argument("host", help="server hostname")
+    parser.add_argument("port", help="server port")
+    parser.add_argument("--users", type=int, default=100, help="number of simulated users")
+    parser.add_argument("--processes", type=int, default=4, help="number of client processes the users are spread over")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--mix", type=parse_mix, default="chat",
+                        help=f"workload mix: one of {', '.join(MIXES)}, or weights like send=3,poll=1,sync=1,read=2,delete=1")
+    parser.add_argument("--arrival-rate", type=float, default=20, help="users logging in per second")
+    parser.add_argument("--action-rate", type=float, default=1, help="actions per second per logged in user")
+    parser.add_argument("--subscribers", type=float, default=0.5, help="fraction of users holding a message stream open")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a call counts as an error")
+    parser.add_argument("--seed", type=int, default=2620, help="random seed, so runs are repeatable")
+    parser.add_argument("--replicas", nargs="+", default=[], metavar="HOST:PORT",
+                        help="replicas of the server (started with --replica-of) to read inboxes from")
+    args = parser.parse_args()
+    mix_name = next((name for name, mix in MIXES.items() if mix == args.mix), ",".join(f"{k}={v}" for k, v in args.mix.items()))
+
+    address = f"{args.host}:{args.port}"
+    rng = random.Random(args.seed)
+    usernames = [f"load{args.seed}_{i}" for i in range(args.users)]
+    with grpc.insecure_channel(address) as channel:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        for username in usernames:
+            # MATCH means the user is left over from an earlier run with the same seed, which is fine
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="password"))
+
+    # Poisson arrivals, dealt round robin to the processes
+    arrivals, clock = [], 0.0
+    for username in usernames:
+        clock += rng.expovariate(args.arrival_rate)
+        arrivals.append((username, clock))
+    shares = [arrivals[i::args.processes] for i in range(args.processes)]
+    start = time.time() + 1
+    # Spawn rather than fork: a gRPC channel does not survive being forked from this process
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.starmap(run_process, [(address, share, usernames, args.mix, args, start, args.seed * 1000 + i * args.users)
+                                             for i, share in enumerate(shares)])
+
+    latencies, errors = {}, {}
+    for process_latencies, process_errors in results:
+        for rpc, values in process_latencies.items():
+            latencies.setdefault(rpc, []).extend(values)
+        for rpc, count in process_errors.items():
+            errors[rpc] = errors.get(rpc, 0) + count
+
+    if not OUTPUT_FILE.exists():
+        with open(OUTPUT_FILE, "w") as file:
+            file.write("RPC\tMIX\tUSERS\tPROCESSES\tARRIVAL_RATE\tACTION_RATE\tDURATION\tCALLS\tERRORS\tTHROUGHPUT\tP50_MS\tP99_MS\tP999_MS\n")
+    print(f"{'RPC':<16}{'calls':>8}{'errors':>8}{'calls/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    with open(OUTPUT_FILE, "a") as file:
+        for rpc in sorted(set(latencies) | set(errors)):
+            values = sorted(latencies.get(rpc, [])) or [0.0]
+            calls = len(latencies.get(rpc, []))
+            throughput = calls / args.duration
+            p50, p99, p999 = (percentile(values, fraction) for fraction in (0.5, 0.99, 0.999))
+            print(f"{rpc:<16}{calls:>8}{errors.get(rpc, 0):>8}{throughput:>10.1f}{p50:>10.2f}{p99:>10.2f}{p999:>10.2f}")
+            file.write(f"{rpc}\t{mix_name}\t{args.users}\t{args.processes}\t{args.arrival_rate}\t{args.action_rate}\t{args.duration}\t"
+                       f"{calls}\t{errors.get(rpc, 0)}\t{throughput}\t{p50}\t{p99}\t{p999}\n")
@@ -0,0 +1,118 @@
+'''
+Measure server throughput as a function of the number of worker threads.
+
+For each worker count a fresh server is started on a temporary data directory, seeded with
+users and messages, and then driven by several client processes issuing a read-heavy mix of
+GetMessage and SendMessage calls. Results are appended to Analytics/worker_scaling_results.txt.
+
+Usage: python load_test.py [--workers 1 2 4 8] [--clients 8] [--duration 10] [--read-ratio 0.9] [--durability full]
+'''
+
+import argparse
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+
+OUTPUT_FILE = Path(__file__).parent / "Analytics/worker_scaling_results.txt"
+SERVER_SCRIPT = Path(__file__).parent / "GRPCServer.py"
+SERVER_START_TIMEOUT = 10
+
+def free_port():
+    '''Asks the OS for an unused TCP port'''
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(port, workers, data_dir, durability):
+    '''Starts GRPCServer.py as a subprocess and waits until it accepts connections. No calls here stream, so all workers serve unary calls'''
+    server = subprocess.Popen(
+        [sys.executable, str(SERVER_SCRIPT), "127.0.0.1", str(port), "--workers", str(workers), "--max-streams", "0",
+         "--data-dir", data_dir, "--durability", durability],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+        grpc.channel_ready_future(channel).result(timeout=SERVER_START_TIMEOUT)
+    return server
+
+def seed(address, num_users, messages_per_user):
+    '''Creates num_users accounts, each with messages_per_user messages in their inbox'''
+    with grpc.insecure_channel(address) as channel:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        usernames = [f"user{i}" for i in range(num_users)]
+        for username in usernames:
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="password"))
+        for i in range(messages_per_user):
+            for username in usernames:
+                stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+                    sender=usernames[0], recipient=username, time_sent=f"{i:08d}",
+                    subject=f"Message {i}", body="Load test message body " * 10)))
+        return usernames
+
+def run_client(address, usernames, duration, read_ratio, page_size, seed_value):
+    '''Issues requests until duration has elapsed and returns the number completed'''
+    rng = random.Random(seed_value)
+    completed = 0
+    with grpc.insecure_channel(address) as channel:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            username = rng.choice(usernames)
+            if rng.random() < read_ratio:
+                stub.GetMessage(chat_pb2.GetMessageRequest(offset=0, limit=page_size, unread_only=False, username=username))
+            else:
+                stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+                    sender=rng.choice(usernames), recipient=username, time_sent="load test",
+                    subject="Load test", body="Load test message body " * 10)))
+            completed += 1
+    return completed
+
+def measure(workers, args):
+    '''Runs one load test against a fresh server with the given number of workers'''
+    with tempfile.TemporaryDirectory() as data_dir:
+        port = free_port()
+        address = f"127.0.0.1:{port}"
+        server = start_server(port, workers, data_dir, args.durability)
+        try:
+            usernames = seed(address, args.users, args.messages)
+            client_args = [(address, usernames, args.duration, args.read_ratio, args.page_size, args.seed + i)
+                           for i in range(args.clients)]
+            start = time.perf_counter()
+            with multiprocessing.Pool(args.clients) as pool:
+                completed = sum(pool.starmap(run_client, client_args))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+    return completed, elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure server throughput against worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="worker counts to test")
+    parser.add_argument("--clients", type=int, default=8, help="number of client processes")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each client sends requests for")
+    parser.add_argument("--read-ratio", type=float, default=0.9, help="fraction of requests that are GetMessage")
+    parser.add_argument("--users", type=int, default=20, help="number of seeded users")
+    parser.add_argument("--messages", type=int, default=50, help="number of seeded messages per user")
+    parser.add_argument("--page-size", type=int, default=50, help="messages returned per GetMessage")
+    parser.add_argument("--durability", default="full", help="server durability mode (full, normal or async)")
+    parser.add_argument("--seed", type=int, default=2620, help="random seed, so runs are repeatable")
+    args = parser.parse_args()
+
+    if not OUTPUT_FILE.exists():
+        with open(OUTPUT_FILE, "w") as file:
+            file.write("WORKERS\tCLIENTS\tREAD_RATIO\tDURABILITY\tREQUESTS\tDURATION\tTHROUGHPUT\n")
+
+    for workers in args.workers:
+        completed, elapsed = measure(workers, args)
+        throughput = completed / elapsed
+        print(f"{workers} workers: {completed} requests in {elapsed:.2f}s ({throughput:.1f} requests/s)")
+        with open(OUTPUT_FILE, "a") as file:
+            file.write(f"{workers}\t{args.clients}\t{args.read_ratio}\t{args.durability}\t{completed}\t{elapsed}\t{throughput}\n")
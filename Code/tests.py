@@ -1,8 +1,70 @@
+import asyncio
 import grpc
+import logging
+import pstats
+import sqlite3
+import threading
+import time
+from concurrent import futures
+from pathlib import Path
 
 # Import the generated gRPC modules.
 import chat_pb2
 import chat_pb2_grpc
+from Constants import PASSWORD_DATABASE_SCHEMA, MESSAGES_DATABASE_SCHEMA
+from Migrations import migrate, check_query_plans, PASSWORDS_MIGRATIONS, MESSAGES_MIGRATIONS
+from Database import ConnectionPool, database_paths, shard_paths
+from GRPCServer import ChatServiceServicer
+from GRPCAioServer import AsyncChatServiceServicer
+from Cluster import HashRing, ClusterStub
+from Router import RouterServicer
+from Profiler import is_local
+from Replication import encode_commit_token, ReplicaStub
+from Sessions import SessionTable, SessionStub
+from Presence import Presence
+from UserDirectory import UserDirectory
+from ServerLog import RequestSummary, SamplingFilter
+from Constants import MESSAGES_DATABASE, BODY_COMPRESSION_THRESHOLD
+from Compression import compress_body, decompress_body
+from Analytics.Analytics_test_data import SHORT_CHINESE_MESSAGE
+
+class AioServer:
+    '''
+    A grpc.aio server on an event loop thread of its own, for the streams only GRPCAioServer.py serves. Its
+    address is known from the start, so that cluster nodes can be told about each other before they are served
+    '''
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = self.run(self.create())
+        self.port = self.server.add_insecure_port("127.0.0.1:0")
+        self.address = f"127.0.0.1:{self.port}"
+        self.executor = futures.ThreadPoolExecutor(max_workers=8)
+        self.servicer = None
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def create(self):
+        return grpc.aio.server()
+
+    def start(self, *args, **kwargs):
+        '''Serves an AsyncChatServiceServicer built with args and kwargs, and returns the ChatServiceServicer inside it'''
+        # The servicer installs signal handlers, so it is built on this thread
+        servicer = AsyncChatServiceServicer(self.loop, self.executor, *args, node=self.address, **kwargs)
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, self.server)
+        self.run(self.server.start())
+        self.servicer = servicer.servicer
+        return self.servicer
+
+    def stop(self):
+        self.run(self.server.stop(0))
+        if self.servicer is not None:
+            self.servicer.close()
+        self.executor.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
 
 def test_login():
     channel = grpc.insecure_channel(f"127.0.0.1:2620")
@@ -116,6 +178,441 @@ def test_messages():
 
     channel.close()
 
+def test_subscribe_messages():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    message1 = chat_pb2.MessageObject(id=0, sender="a", recipient="c", time_sent="now", read=False, subject="live", body="body")
+
+    # Subscribing without logging in ends the stream immediately
+    assert list(stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username="c"))) == []
+
+    response = stub.CreateUser(chat_pb2.CreateUserRequest(username="c", password="c"))
+    assert response.status == chat_pb2.Status.SUCCESS
+    response = stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="c"))
+    assert response.status == chat_pb2.Status.SUCCESS
+    stream = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username="c"))
+
+    # Messages sent while logged in are streamed with their assigned id
+    response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message1))
+    assert response.status == chat_pb2.Status.SUCCESS
+    response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message1))
+    assert response.status == chat_pb2.Status.SUCCESS
+    first = next(stream)
+    second = next(stream)
+    assert first.subject == "live" and first.recipient == "c"
+    assert second.id > first.id > 0
+
+    # Other calls are still served while the stream is open
+    response = stub.GetMessage(chat_pb2.GetMessageRequest(offset=0, limit=10, unread_only=True, username="c"))
+    assert len(response.messages) == 2
+
+    # Logging out ends the stream
+    response = stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="c"))
+    assert response.status == chat_pb2.Status.SUCCESS
+    assert list(stream) == []
+
+    channel.close()
+
+def test_concurrent_requests():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    usernames = [f"concurrent{i}" for i in range(20)]
+
+    with futures.ThreadPoolExecutor(max_workers=10) as executor:
+        # Writes from many workers all land
+        created = list(executor.map(lambda username: stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p")), usernames))
+        assert all(response.status == chat_pb2.Status.SUCCESS for response in created)
+        found = list(executor.map(lambda username: stub.CheckUsername(chat_pb2.CheckUsernameRequest(username=username)), usernames))
+        assert all(response.status == chat_pb2.Status.MATCH for response in found)
+
+        # Racing logins for the same user let exactly one through
+        logins = list(executor.map(lambda _: stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="concurrent0")), range(10)))
+        assert sum(response.status == chat_pb2.Status.SUCCESS for response in logins) == 1
+        assert sum(response.status == chat_pb2.Status.MATCH for response in logins) == 9
+
+    response = stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="concurrent0"))
+    assert response.status == chat_pb2.Status.SUCCESS
+
+    channel.close()
+
+def test_stream_limit(tmp_path):
+    # Two streams fit, and the third is turned away at once instead of waiting for a thread
+    servicer = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", max_streams=2)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=3))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    try:
+        usernames = [f"streaming_user{i}" for i in range(3)]
+        for username in usernames:
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+            stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username=username))
+        subscriptions = [stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=username)) for username in usernames[:2]]
+        for username in usernames[:2]:
+            stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+                sender=username, recipient=username, time_sent="1", subject="s", body="b")))
+        assert [next(subscription).body for subscription in subscriptions] == ["b", "b"]
+        try:
+            next(stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=usernames[2]), timeout=5))
+            assert False, "a stream past the limit was let in"
+        except grpc.RpcError as e:
+            assert e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+        # Watching presence would hold a thread too, so only the asyncio server serves it
+        try:
+            next(stub.WatchPresence(chat_pb2.WatchPresenceRequest(), timeout=5))
+            assert False, "the thread pool server served WatchPresence"
+        except grpc.RpcError as e:
+            assert e.code() == grpc.StatusCode.UNIMPLEMENTED
+        # Unary calls still have a thread
+        inbox = stub.GetMessage(chat_pb2.GetMessageRequest(offset=0, limit=10, unread_only=False, username=usernames[0]), timeout=5)
+        assert len(inbox.messages) == 1
+
+        # A closed stream frees its slot once its thread sees that the user logged out
+        subscriptions[0].cancel()
+        stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username=usernames[0]))
+        stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender=usernames[2], recipient=usernames[2], time_sent="2", subject="s", body="late")))
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                subscription = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=usernames[2]))
+                assert next(subscription).body == "late"
+                break
+            except grpc.RpcError as e:
+                assert e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED and time.monotonic() < deadline
+                time.sleep(0.05)
+        subscription.cancel()
+        subscriptions[1].cancel()
+    finally:
+        channel.close()
+        server.stop(0)
+        servicer.close()
+
+def test_group_commit():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    # Every name is submitted twice, so concurrent batches mix successful and failing writes
+    usernames = [f"batched{i % 10}" for i in range(20)]
+
+    with futures.ThreadPoolExecutor(max_workers=10) as executor:
+        created = list(executor.map(lambda username: stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p")), usernames))
+        assert sum(response.status == chat_pb2.Status.SUCCESS for response in created) == 10
+        assert sum(response.status == chat_pb2.Status.MATCH for response in created) == 10
+
+        # A failed write does not roll back the rest of its batch
+        message = chat_pb2.MessageObject(id=0, sender="batched0", recipient="batched1", time_sent="now", read=False, subject="batched", body="body")
+        sent = list(executor.map(lambda _: stub.SendMessage(chat_pb2.SendMessageRequest(message=message)), range(20)))
+        assert all(response.status == chat_pb2.Status.SUCCESS for response in sent)
+
+    # Writes are committed before they are acknowledged
+    response = stub.GetMessage(chat_pb2.GetMessageRequest(offset=0, limit=-1, unread_only=False, username="batched1"))
+    assert len(response.messages) == 20
+    assert len({message.id for message in response.messages}) == 20
+
+    channel.close()
+
+def test_keyset_pagination():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    response = stub.CreateUser(chat_pb2.CreateUserRequest(username="pager", password="p"))
+    assert response.status == chat_pb2.Status.SUCCESS
+
+    # Many messages share a Time_sent, so pages must break ties by id
+    for i in range(25):
+        message = chat_pb2.MessageObject(id=0, sender="a", recipient="pager", time_sent=f"t{i // 4}", read=False, subject=str(i), body="body")
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+        assert response.status == chat_pb2.Status.SUCCESS
+
+    first = stub.GetMessage(chat_pb2.GetMessageRequest(limit=10, username="pager"))
+    assert first.status == chat_pb2.Status.SUCCESS
+    assert len(first.messages) == 10 and first.next_page_token
+
+    # A message arriving between pages does not shift the following pages
+    message = chat_pb2.MessageObject(id=0, sender="a", recipient="pager", time_sent="t9", read=False, subject="late", body="body")
+    response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+    assert response.status == chat_pb2.Status.SUCCESS
+
+    second = stub.GetMessage(chat_pb2.GetMessageRequest(limit=10, username="pager", page_token=first.next_page_token))
+    third = stub.GetMessage(chat_pb2.GetMessageRequest(limit=10, username="pager", page_token=second.next_page_token))
+    assert len(second.messages) == 10 and second.next_page_token
+    assert len(third.messages) == 5 and not third.next_page_token
+    paged = [message.subject for response in (first, second, third) for message in response.messages]
+    assert sorted(paged, key=int) == [str(i) for i in range(25)]
+
+    # Pages match the offset-based order
+    everything = stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username="pager"))
+    assert [message.subject for message in everything.messages if message.subject != "late"] == paged
+
+    # Malformed tokens are rejected
+    response = stub.GetMessage(chat_pb2.GetMessageRequest(limit=10, username="pager", page_token="not a token"))
+    assert response.status == chat_pb2.Status.ERROR
+
+    channel.close()
+
+def test_counts():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    for username in ("counted", "counter"):
+        response = stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        assert response.status == chat_pb2.Status.SUCCESS
+
+    def counts(username):
+        response = stub.GetCounts(chat_pb2.GetCountsRequest(username=username))
+        assert response.status == chat_pb2.Status.SUCCESS
+        return response.num_total_msgs, response.num_unread_msgs
+
+    assert counts("counted") == (0, 0)
+    message = chat_pb2.MessageObject(id=0, sender="counter", recipient="counted", time_sent="now", read=False, subject="count", body="body")
+    for _ in range(3):
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+        assert response.status == chat_pb2.Status.SUCCESS
+    assert counts("counted") == (3, 3)
+    ids = [message.id for message in stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username="counted")).messages]
+
+    # Reading a message twice only counts once
+    for _ in range(2):
+        response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(message_id=ids[0], username="counted"))
+        assert response.status == chat_pb2.Status.SUCCESS
+    assert counts("counted") == (3, 2)
+
+    response = stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[ids[0], ids[1]]))
+    assert response.status == chat_pb2.Status.SUCCESS
+    assert counts("counted") == (1, 1)
+
+    response = stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="counted"))
+    assert (response.num_total_msgs, response.num_unread_msgs) == (1, 1)
+    response = stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="counted"))
+
+    # Deleting the user returns its unread message to the sender
+    response = stub.DeleteUser(chat_pb2.DeleteUserRequest(username="counted"))
+    assert response.status == chat_pb2.Status.SUCCESS
+    assert counts("counted") == (0, 0)
+    assert counts("counter") == (1, 1)
+
+    channel.close()
+
+def test_sync_messages():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    for username in ("syncer", "synced"):
+        response = stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        assert response.status == chat_pb2.Status.SUCCESS
+
+    def sync(since_seq, limit=0):
+        response = stub.SyncMessages(chat_pb2.SyncMessagesRequest(username="synced", since_seq=since_seq, limit=limit))
+        assert response.status == chat_pb2.Status.SUCCESS
+        return response
+
+    response = sync(0)
+    assert not response.messages and response.next_seq == 0 and not response.has_more
+
+    for i in range(3):
+        message = chat_pb2.MessageObject(sender="syncer", recipient="synced", time_sent=f"{i}", subject=f"sync {i}", body="body")
+        assert stub.SendMessage(chat_pb2.SendMessageRequest(message=message)).status == chat_pb2.Status.SUCCESS
+    first = sync(0)
+    assert [message.subject for message in first.messages] == ["sync 2", "sync 1", "sync 0"]
+    ids = [message.id for message in first.messages]
+
+    # Nothing changed, so nothing comes back and the watermark stays put
+    response = sync(first.next_seq)
+    assert not response.messages and not response.read_ids and not response.deleted_ids
+    assert response.next_seq == first.next_seq
+
+    # Only the changes since the watermark come back, as tombstones for messages the client has
+    stub.ConfirmRead(chat_pb2.ConfirmReadRequest(message_id=ids[0], username="synced"))
+    stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[ids[1]]))
+    message = chat_pb2.MessageObject(sender="syncer", recipient="synced", time_sent="3", subject="sync 3", body="body")
+    stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+    second = sync(first.next_seq)
+    assert [message.subject for message in second.messages] == ["sync 3"]
+    assert list(second.read_ids) == [ids[0]]
+    assert list(second.deleted_ids) == [ids[1]]
+
+    # A fresh client sees the current state, paged by limit
+    seen, since_seq, has_more = [], 0, True
+    while has_more:
+        response = sync(since_seq, limit=1)
+        seen += [(message.subject, message.read) for message in response.messages]
+        since_seq, has_more = response.next_seq, response.has_more
+    assert sorted(seen) == [("sync 0", False), ("sync 2", True), ("sync 3", False)]
+    assert since_seq == second.next_seq
+
+    response = stub.SyncMessages(chat_pb2.SyncMessagesRequest(username="synced", since_seq=-1))
+    assert response.status == chat_pb2.Status.ERROR
+    channel.close()
+
+def test_tombstone_pruning(tmp_path):
+    servicer = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", tombstone_retention=2)
+    try:
+        for username in ("pruning_sender", "pruning_recipient"):
+            servicer.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"), None)
+        def send(subject):
+            servicer.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+                sender="pruning_sender", recipient="pruning_recipient", time_sent=subject, subject=subject, body="b")), None)
+        def sync(since_seq):
+            return servicer.SyncMessages(chat_pb2.SyncMessagesRequest(username="pruning_recipient", since_seq=since_seq), None)
+        for i in range(3):
+            send(f"{i}")
+        behind = sync(0)
+        ids = sorted(message.id for message in behind.messages)
+        servicer.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=ids[:2], username="pruning_recipient"), None)
+        caught_up = sync(behind.next_seq)
+        assert sorted(caught_up.deleted_ids) == ids[:2]
+        send("3")
+        send("4")
+
+        # Only the tombstones older than the last two changes go
+        assert servicer.prune_tombstones() == 2
+        assert servicer.prune_tombstones() == 0
+        events = servicer.messages.pools[0].connection().execute("SELECT Kind, COUNT(*) FROM MessageEvents GROUP BY Kind").fetchall()
+        assert dict(events) == {"insert": 3}
+
+        # A client that last synced before them starts again from 0, and one that synced after carries on
+        response = sync(behind.next_seq)
+        assert response.resync and response.next_seq == 0 and response.has_more and not response.messages
+        assert sorted(message.subject for message in sync(0).messages) == ["2", "3", "4"]
+        response = sync(caught_up.next_seq)
+        assert not response.resync and sorted(message.subject for message in response.messages) == ["3", "4"]
+    finally:
+        servicer.close()
+
+def test_bulk_read():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    for username in ("bulkreader", "bulksender"):
+        response = stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        assert response.status == chat_pb2.Status.SUCCESS
+    for i in range(6):
+        message = chat_pb2.MessageObject(sender="bulksender", recipient="bulkreader", time_sent=f"{i}", subject=f"bulk {i}", body="body")
+        assert stub.SendMessage(chat_pb2.SendMessageRequest(message=message)).status == chat_pb2.Status.SUCCESS
+    ids = sorted(message.id for message in stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username="bulkreader")).messages)
+
+    def unread():
+        return stub.GetCounts(chat_pb2.GetCountsRequest(username="bulkreader")).num_unread_msgs
+
+    # Several ids in one request; an id that is already read is not counted again
+    response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(message_ids=[ids[0], ids[1]], username="bulkreader"))
+    assert response.status == chat_pb2.Status.SUCCESS and response.num_marked == 2
+    response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(message_ids=[ids[1], ids[2]], username="bulkreader"))
+    assert response.num_marked == 1
+    assert unread() == 3
+
+    # Another user's messages are never marked
+    response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(up_to_id=ids[-1], username="bulksender"))
+    assert response.num_marked == 0
+    response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(up_to_id=ids[4], username="bulkreader"))
+    assert response.num_marked == 2
+    assert unread() == 1
+
+    response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(username="bulkreader"))
+    assert response.status == chat_pb2.Status.ERROR
+    channel.close()
+
+def test_multicast():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    recipients = [f"multicast{i}" for i in range(5)]
+    for username in ["announcer"] + recipients:
+        response = stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        assert response.status == chat_pb2.Status.SUCCESS
+    stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username=recipients[0]))
+    subscription = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=recipients[0]))
+
+    message = chat_pb2.MessageObject(sender="announcer", time_sent="now", subject="Announcement", body="body")
+    response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message, recipients=recipients + ["nobody", recipients[1]]))
+    assert response.status == chat_pb2.Status.SUCCESS
+    statuses = {status.recipient: status for status in response.recipient_statuses}
+    assert list(statuses) == recipients + ["nobody"]
+    assert statuses["nobody"].status == chat_pb2.Status.NO_MATCH
+    for recipient in recipients:
+        assert statuses[recipient].status == chat_pb2.Status.SUCCESS
+        inbox = stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username=recipient)).messages
+        assert [(m.id, m.recipient, m.subject) for m in inbox] == [(statuses[recipient].message_id, recipient, "Announcement")]
+
+    # The online recipient gets its copy on the stream
+    delivered = next(subscription)
+    assert (delivered.id, delivered.recipient) == (statuses[recipients[0]].message_id, recipients[0])
+    stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username=recipients[0]))
+
+    response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message, recipients=["nobody"]))
+    assert response.status == chat_pb2.Status.NO_MATCH
+    channel.close()
+
+def test_compression():
+    # Long bodies are stored compressed, short ones and incompressible ones as text
+    assert compress_body("short", BODY_COMPRESSION_THRESHOLD) == "short"
+    assert isinstance(compress_body(SHORT_CHINESE_MESSAGE, BODY_COMPRESSION_THRESHOLD), bytes)
+    assert compress_body(SHORT_CHINESE_MESSAGE, 0) == SHORT_CHINESE_MESSAGE
+    assert decompress_body(compress_body(SHORT_CHINESE_MESSAGE, BODY_COMPRESSION_THRESHOLD)) == SHORT_CHINESE_MESSAGE
+    assert decompress_body("plain") == "plain"
+
+    # A gzip channel talks to the server, and bodies come back as they were sent
+    channel = grpc.insecure_channel(f"127.0.0.1:2620", compression=grpc.Compression.Gzip)
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    for username in ["compress_from", "compress_to"]:
+        stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+    for body in [SHORT_CHINESE_MESSAGE, "short body"]:
+        message = chat_pb2.MessageObject(sender="compress_from", recipient="compress_to", time_sent="now", subject="s", body=body)
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+        assert response.status == chat_pb2.Status.SUCCESS
+    inbox = stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username="compress_to")).messages
+    assert sorted(message.body for message in inbox) == sorted([SHORT_CHINESE_MESSAGE, "short body"])
+    synced = stub.SyncMessages(chat_pb2.SyncMessagesRequest(username="compress_to")).messages
+    assert sorted(message.body for message in synced) == sorted([SHORT_CHINESE_MESSAGE, "short body"])
+
+    connection = sqlite3.connect(MESSAGES_DATABASE)
+    stored = dict(connection.execute("SELECT length(CAST(Body AS BLOB)), typeof(Body) FROM Messages WHERE Recipient = 'compress_to'").fetchall())
+    connection.close()
+    assert stored == {len("short body"): "text", len(compress_body(SHORT_CHINESE_MESSAGE, BODY_COMPRESSION_THRESHOLD)): "blob"}
+    channel.close()
+
+def test_search_messages():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    for username in ["inbox_searcher", "search_other"]:
+        stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+    def send(recipient, subject, body):
+        message = chat_pb2.MessageObject(sender="a", recipient=recipient, time_sent="now", subject=subject, body=body)
+        stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+        return stub.GetMessage(chat_pb2.GetMessageRequest(limit=1, username=recipient)).messages[0].id
+    in_subject = send("inbox_searcher", "Lunch plans", "see you there")
+    in_body = send("inbox_searcher", "Hello", "are we still on for lunch tomorrow")
+    # Long bodies are stored compressed, and are still indexed by their text
+    compressed = send("inbox_searcher", "Minutes", "the quarterly budget review " * 100)
+    send("search_other", "Lunch", "lunch for someone else")
+    def search(query, limit=0, page_token=""):
+        return stub.SearchMessages(chat_pb2.SearchMessagesRequest(username="inbox_searcher", query=query, limit=limit, page_token=page_token))
+
+    # Only the user's own messages match, subject hits first; every word has to appear
+    response = search("LUNCH")
+    assert response.status == chat_pb2.Status.SUCCESS
+    assert [message.id for message in response.messages] == [in_subject, in_body]
+    assert [message.id for message in search("lunch tomorrow").messages] == [in_body]
+    assert [message.body for message in search("quarterly budget").messages] == ["the quarterly budget review " * 100]
+    assert search("dinner").messages == []
+
+    # Pages follow the ranking
+    first = search("lunch", limit=1)
+    assert [message.id for message in first.messages] == [in_subject] and first.next_page_token
+    second = search("lunch", limit=1, page_token=first.next_page_token)
+    assert [message.id for message in second.messages] == [in_body] and second.next_page_token == ""
+
+    # Query syntax is taken literally, and blank queries or bad tokens are errors
+    assert search('lunch" OR "budget').status == chat_pb2.Status.SUCCESS
+    assert search("   ").status == chat_pb2.Status.ERROR
+    assert search("lunch", page_token="!").status == chat_pb2.Status.ERROR
+
+    # Deleted messages and users leave the index
+    stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[in_subject, compressed]))
+    assert [message.id for message in search("lunch").messages] == [in_body]
+    assert search("budget").messages == []
+    stub.DeleteUser(chat_pb2.DeleteUserRequest(username="search_other"))
+    response = stub.SearchMessages(chat_pb2.SearchMessagesRequest(username="search_other", query="lunch"))
+    assert response.messages == []
+    channel.close()
+
 def test_delete_user():
     channel = grpc.insecure_channel(f"127.0.0.1:2620")
     stub = chat_pb2_grpc.ChatServiceStub(channel)
@@ -139,15 +636,596 @@ def test_delete_user():
     response = stub.CheckUsername(chat_pb2.CheckUsernameRequest(username="a"))
     assert response.status == chat_pb2.Status.MATCH
 
+def test_sharding(tmp_path):
+    assert shard_paths(tmp_path / "messages.db") == [tmp_path / "messages.db"]
+    assert shard_paths(tmp_path / "messages.db", 2) == [tmp_path / "messages_0_of_2.db", tmp_path / "messages_1_of_2.db"]
+    assert shard_paths(tmp_path / "messages.db", directories=[tmp_path / "a", tmp_path / "b"])[1] == tmp_path / "b" / "messages_1_of_2.db"
+
+    # A three shard server of its own
+    servicer = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", shards=3)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    try:
+        # One user per shard
+        users = {}
+        for i in range(100):
+            users.setdefault(servicer.messages.shard(f"shard_user{i}"), f"shard_user{i}")
+        sender, first, second = users[0], users[1], users[2]
+        for username in users.values():
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+
+        # Ids route back to the recipient's shard, and stay in order within an inbox
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.MessageObject(sender=sender, time_sent="1", subject="s", body="hello"), recipients=[first, second, sender]))
+        ids = {status.recipient: status.message_id for status in response.recipient_statuses}
+        assert {servicer.messages.local_id(ids[username])[0] for username in (sender, first, second)} == {0, 1, 2}
+        for time_sent in ("2", "3"):
+            stub.SendMessage(chat_pb2.SendMessageRequest(
+                message=chat_pb2.MessageObject(sender=sender, recipient=first, time_sent=time_sent, subject="s", body="hello")))
+        page = stub.GetMessage(chat_pb2.GetMessageRequest(limit=2, username=first))
+        rest = stub.GetMessage(chat_pb2.GetMessageRequest(limit=2, username=first, page_token=page.next_page_token))
+        inbox = [message.id for message in page.messages] + [message.id for message in rest.messages]
+        assert inbox == sorted(inbox, reverse=True) and inbox[-1] == ids[first]
+        synced = stub.SyncMessages(chat_pb2.SyncMessagesRequest(username=first))
+        assert sorted(message.id for message in synced.messages) == sorted(inbox)
+        assert [message.id for message in stub.SearchMessages(chat_pb2.SearchMessagesRequest(username=first, query="hello")).messages] != []
+
+        # Marking read up to an id only covers that inbox's older messages
+        response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(username=first, up_to_id=inbox[1]))
+        assert response.num_marked == 2
+        response = stub.ConfirmRead(chat_pb2.ConfirmReadRequest(username=first, message_ids=[ids[second], inbox[0]]))
+        assert response.num_marked == 1
+
+        # Deleting ids from several shards at once
+        stub.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[ids[sender], ids[second]]))
+        for username in (sender, second):
+            assert stub.GetCounts(chat_pb2.GetCountsRequest(username=username)).num_total_msgs == 0
+
+        # A deleted user's unread messages go back to a sender in another shard
+        stub.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.MessageObject(sender=sender, recipient=second, time_sent="4", subject="s", body="unread")))
+        assert stub.DeleteUser(chat_pb2.DeleteUserRequest(username=second)).status == chat_pb2.Status.SUCCESS
+        returned = stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username=sender)).messages
+        assert [(message.subject, message.body) for message in returned] == [("NOT SENT s", "unread")]
+    finally:
+        channel.close()
+        server.stop(0)
+        servicer.close()
+
+def test_hash_ring():
+    keys = [f"ring_user{i}" for i in range(20000)]
+    ring = HashRing(["a:1", "b:1", "c:1"])
+    grown = HashRing(["a:1", "b:1", "c:1", "d:1"])
+    moved = [key for key in keys if ring.owner(key) != grown.owner(key)]
+    # Only the new node's share moves, and all of it moves to the new node
+    assert 0.2 < len(moved) / len(keys) < 0.3
+    assert {grown.owner(key) for key in moved} == {"d:1"}
+    assert {ring.owner(key) for key in keys} == {"a:1", "b:1", "c:1"}
+
+def test_cluster(tmp_path):
+    # Three nodes on grpc.aio, which serves their WatchPresence streams, and a router, each on a port of its own
+    node_servers = [AioServer() for _ in range(3)]
+    nodes = [server.address for server in node_servers]
+    for i, server in enumerate(node_servers):
+        server.start(tmp_path / f"passwords{i}.db", tmp_path / f"messages{i}.db", durability="async",
+                     cluster_nodes=nodes, cluster_secret="test secret")
+    router_server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    router_address = f"127.0.0.1:{router_server.add_insecure_port('127.0.0.1:0')}"
+    cluster = ClusterStub(nodes)
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(RouterServicer(cluster), router_server)
+    router_server.start()
+    channels = {address: grpc.insecure_channel(address) for address in nodes + [router_address]}
+    stubs = {address: chat_pb2_grpc.ChatServiceStub(channel) for address, channel in channels.items()}
+    router = stubs[router_address]
+    try:
+        # One user on each node
+        users = {}
+        for i in range(100):
+            users.setdefault(cluster.owner(f"cluster_user{i}"), f"cluster_user{i}")
+        alice, bob, carol = (users[node] for node in nodes)
+        for username in (alice, bob, carol):
+            assert router.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p")).status == chat_pb2.Status.SUCCESS
+            assert router.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username=username)).status == chat_pb2.Status.SUCCESS
+        assert router.CheckUsername(chat_pb2.CheckUsernameRequest(username=bob)).status == chat_pb2.Status.MATCH
+        # Each user is only stored on their own node
+        assert stubs[nodes[0]].CheckUsername(chat_pb2.CheckUsernameRequest(username=bob)).status == chat_pb2.Status.NO_MATCH
+        assert list(router.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest()).users) == sorted([alice, bob, carol])
+        watch = router.WatchPresence(chat_pb2.WatchPresenceRequest())
+        assert list(next(watch).joined) == sorted([alice, bob, carol])
+        page = router.GetUsers(chat_pb2.GetUsersRequest(prefix="cluster_user", limit=2))
+        rest = router.GetUsers(chat_pb2.GetUsersRequest(prefix="cluster_user", limit=2, page_token=page.next_page_token))
+        assert list(page.users) + list(rest.users) == sorted([alice, bob, carol]) and not rest.next_page_token
+        # Login lists accounts from every node, not just the user's own
+        assert router.CreateUser(chat_pb2.CreateUserRequest(username="cluster_login", password="p")).status == chat_pb2.Status.SUCCESS
+        login = router.Login(chat_pb2.LoginRequest(username="cluster_login", password="p", users_prefix="cluster_user", users_limit=10))
+        assert login.status == chat_pb2.Status.SUCCESS and list(login.users) == sorted([alice, bob, carol])
+        assert list(next(watch).joined) == ["cluster_login"]
+        watch.cancel()
+
+        # A message sent to alice's node for bob is forwarded to bob's node and streamed through the router
+        subscription = router.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username=bob))
+        response = stubs[nodes[0]].SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.MessageObject(sender=alice, recipient=bob, time_sent="1", subject="s", body="forwarded")))
+        assert response.status == chat_pb2.Status.SUCCESS
+        assert next(subscription).body == "forwarded"
+        subscription.cancel()
+
+        # A multicast reaches recipients on every node, with statuses in the order asked for
+        response = router.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.MessageObject(sender=alice, time_sent="2", subject="s", body="everyone"),
+            recipients=[carol, "cluster_nobody", bob, alice]))
+        assert response.status == chat_pb2.Status.SUCCESS
+        assert [status.recipient for status in response.recipient_statuses] == [carol, "cluster_nobody", bob, alice]
+        assert [status.status for status in response.recipient_statuses] == [chat_pb2.Status.SUCCESS, chat_pb2.Status.NO_MATCH,
+                                                                             chat_pb2.Status.SUCCESS, chat_pb2.Status.SUCCESS]
+        assert router.GetCounts(chat_pb2.GetCountsRequest(username=bob)).num_total_msgs == 2
+
+        # Ids are per node, so deleting needs the user to find the right one
+        carol_id = response.recipient_statuses[0].message_id
+        assert router.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[carol_id])).status == chat_pb2.Status.ERROR
+        router.DeleteMessage(chat_pb2.DeleteMessageRequest(message_id=[carol_id], username=carol))
+        assert router.GetCounts(chat_pb2.GetCountsRequest(username=carol)).num_total_msgs == 0
+
+        # Deleting bob returns his unread messages to alice on her own node
+        assert router.DeleteUser(chat_pb2.DeleteUserRequest(username=bob)).status == chat_pb2.Status.SUCCESS
+        returned = router.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username=alice, unread_only=True)).messages
+        assert sorted(message.body for message in returned if message.subject == "NOT SENT s") == ["everyone", "forwarded"]
+    finally:
+        for channel in channels.values():
+            channel.close()
+        router_server.stop(0)
+        for server in node_servers:
+            server.stop()
+        cluster.close()
+
+def test_replication(tmp_path):
+    def start(servicer):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        server.start()
+        channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        return server, channel, chat_pb2_grpc.ChatServiceStub(channel), f"127.0.0.1:{port}"
+
+    primary = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", primary=True, shards=2,
+                                  replication_secret="test secret")
+    primary_server, primary_channel, primary_stub, primary_address = start(primary)
+    replicas = []
+    try:
+        # Writes made before the replica exists reach it in a snapshot
+        for username in ("replicated_alice", "replicated_bob"):
+            primary_stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        primary_stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender="replicated_alice", recipient="replicated_bob", time_sent="1", subject="s", body="before" * 200)))
+        # Only callers holding the replication secret are sent the databases
+        for metadata in ((), (("chat-replication", "wrong secret"),)):
+            try:
+                next(primary_stub.Replicate(chat_pb2.ReplicateRequest(database="passwords.db", since_seq=-1), metadata=metadata))
+                assert False, "Replicate answered without the replication secret"
+            except grpc.RpcError as e:
+                assert e.code() == grpc.StatusCode.PERMISSION_DENIED
+
+        replica = ChatServiceServicer(*database_paths(tmp_path / "replica"),
+                                      durability="async", replica_of=primary_address, shards=2, replication_secret="test secret")
+        replicas.append(start(replica))
+        stub = replicas[0][2]
+
+        # Later ones are replayed, and a read with the write's commit token sees it
+        login = primary_stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="replicated_bob"))
+        created = primary_stub.CreateUser(chat_pb2.CreateUserRequest(username="replicated_carol", password="p"))
+        sent = primary_stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender="replicated_carol", time_sent="2", subject="s", body="after"), recipients=["replicated_alice", "replicated_bob"]))
+        assert created.commit_token and sent.commit_token and login.commit_token
+        inbox = stub.GetMessage(chat_pb2.GetMessageRequest(limit=-1, username="replicated_bob", min_commit_token=sent.commit_token))
+        assert inbox.status == chat_pb2.Status.SUCCESS
+        assert [message.body for message in inbox.messages] == ["after", "before" * 200]
+        assert inbox.messages[0].id == sent.recipient_statuses[1].message_id
+        users = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="replicated_", limit=10, min_commit_token=created.commit_token))
+        assert list(users.users) == ["replicated_alice", "replicated_bob", "replicated_carol"]
+        online = stub.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest(min_commit_token=sent.commit_token))
+        assert list(online.users) == ["replicated_bob"]
+        search = stub.SearchMessages(chat_pb2.SearchMessagesRequest(username="replicated_alice", query="after"))
+        assert len(search.messages) == 1
 
-    
+        # Replicas only serve reads
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender="replicated_alice", recipient="replicated_bob", time_sent="3", subject="s", body="no")))
+        assert response.status == chat_pb2.Status.ERROR
+        assert stub.GetCounts(chat_pb2.GetCountsRequest(username="replicated_bob")).num_total_msgs == 2
 
+        # Clients read through a ReplicaStub, whose reads wait on the replica for their own last write
+        client = ReplicaStub(primary_stub, stub)
+        sent = client.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender="replicated_alice", recipient="replicated_bob", time_sent="3", subject="s", body="through")))
+        assert client.commit_token == sent.commit_token
+        assert client.GetCounts(chat_pb2.GetCountsRequest(username="replicated_bob")).num_total_msgs == 3
+        sync = client.SyncMessages(chat_pb2.SyncMessagesRequest(username="replicated_bob"))
+        assert sync.status == chat_pb2.Status.SUCCESS and "through" in [message.body for message in sync.messages]
+        # and fall back to the primary when the replica cannot catch up in time
+        class PendingStub:
+            def __getattr__(self, name):
+                return lambda request, **kwargs: getattr(chat_pb2, f"{name}Response")(status=chat_pb2.Status.PENDING)
+        client = ReplicaStub(primary_stub, PendingStub())
+        counts = client.GetCounts(chat_pb2.GetCountsRequest(username="replicated_bob"))
+        assert counts.status == chat_pb2.Status.SUCCESS and counts.num_total_msgs == 3
 
+        # Deleting a user reaches the replica's username directory
+        deleted = primary_stub.DeleteUser(chat_pb2.DeleteUserRequest(username="replicated_carol"))
+        stub.GetUsers(chat_pb2.GetUsersRequest(prefix="replicated_", limit=10, min_commit_token=deleted.commit_token))
+        assert stub.CheckUsername(chat_pb2.CheckUsernameRequest(username="replicated_carol")).status == chat_pb2.Status.NO_MATCH
+
+        # A token from writes the replica cannot have seen yet is PENDING, a malformed one an ERROR
+        ahead = encode_commit_token({"passwords.db": 10 ** 9})
+        assert not replica.replica.caught_up(ahead, timeout=0.1)
+        assert stub.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest(min_commit_token="x")).status == chat_pb2.Status.ERROR
+
+        # A replica started again on the same files carries on from where it stopped
+        server, channel, _, _ = replicas.pop()
+        channel.close()
+        server.stop(0)
+        replica.close()
+        logout = primary_stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="replicated_bob"))
+        replica = ChatServiceServicer(*database_paths(tmp_path / "replica"),
+                                      durability="async", replica_of=primary_address, shards=2, replication_secret="test secret")
+        replicas.append(start(replica))
+        online = replicas[0][2].GetOnlineUsers(chat_pb2.GetOnlineUsersRequest(min_commit_token=logout.commit_token))
+        assert online.status == chat_pb2.Status.SUCCESS and list(online.users) == []
+    finally:
+        for server, channel, _, _ in replicas:
+            channel.close()
+            server.stop(0)
+        if replicas:
+            replica.close()
+        primary_channel.close()
+        primary_server.stop(0)
+        primary.close()
+
+def test_sessions(tmp_path):
+    # A one node cluster, so that calls can be marked as forwarded by another node
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    port = server.add_insecure_port("127.0.0.1:0")
+    servicer = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", require_sessions=True,
+                                   cluster_nodes=[f"127.0.0.1:{port}"], node=f"127.0.0.1:{port}", cluster_secret="test secret")
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    server.start()
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    try:
+        for username in ("session_alice", "session_bob"):
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        # Only a matching password starts a session
+        assert stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="session_alice", password="x")).session_token == ""
+        assert stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="session_nobody", password="p")).status == chat_pb2.Status.NO_MATCH
+        alice_token = stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="session_alice", password="p")).session_token
+        bob_token = stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="session_bob", password="p")).session_token
+        alice, bob = SessionStub(stub, alice_token), SessionStub(stub, bob_token)
+
+        # Calls acting as a user need that user's token
+        assert stub.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="session_alice")).status == chat_pb2.Status.ERROR
+        assert bob.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="session_alice")).status == chat_pb2.Status.ERROR
+        login = alice.ConfirmLogin(chat_pb2.ConfirmLoginRequest(username="session_alice"))
+        assert login.status == chat_pb2.Status.SUCCESS and login.session_token == alice_token
+        assert bob.GetCounts(chat_pb2.GetCountsRequest(username="session_alice")).status == chat_pb2.Status.ERROR
+        assert alice.GetCounts(chat_pb2.GetCountsRequest(username="session_alice")).status == chat_pb2.Status.SUCCESS
+        assert list(bob.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username="session_alice"))) == []
+        message = chat_pb2.MessageObject(sender="session_alice", recipient="session_bob", time_sent="1", subject="s", body="b")
+        assert bob.SendMessage(chat_pb2.SendMessageRequest(message=message)).status == chat_pb2.Status.ERROR
+        assert alice.SendMessage(chat_pb2.SendMessageRequest(message=message)).status == chat_pb2.Status.SUCCESS
+        # Only calls carrying the cluster secret are trusted as forwarded by another node
+        for forged in ("1", "wrong secret", ""):
+            response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message), metadata=(("chat-forwarded", forged),))
+            assert response.status == chat_pb2.Status.ERROR
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(message=message), metadata=(("chat-forwarded", "test secret"),))
+        assert response.status == chat_pb2.Status.SUCCESS
+        # Account calls that need no session still work without one
+        assert stub.CheckUsername(chat_pb2.CheckUsernameRequest(username="session_bob")).status == chat_pb2.Status.MATCH
+
+        # Logging out ends the session
+        assert alice.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="session_alice")).status == chat_pb2.Status.SUCCESS
+        assert alice.GetCounts(chat_pb2.GetCountsRequest(username="session_alice")).status == chat_pb2.Status.ERROR
+
+        # Deleting a user ends every one of their sessions
+        other_bob_token = stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="session_bob", password="p")).session_token
+        assert bob.DeleteUser(chat_pb2.DeleteUserRequest(username="session_bob")).status == chat_pb2.Status.SUCCESS
+        assert servicer.sessions.username(other_bob_token) is None and len(servicer.sessions) == 0
+    finally:
+        channel.close()
+        server.stop(0)
+        servicer.close()
+
+    # Sessions expire with their bucket, between lifetime and lifetime + bucket seconds after they start
+    now = [0.0]
+    table = SessionTable(lifetime=10, bucket=5, clock=lambda: now[0])
+    token = table.issue("expiring")
+    now[0] = 9.9
+    assert table.username(token) == "expiring"
+    later = table.issue("expiring")
+    now[0] = 10
+    assert table.username(token) is None and table.username(later) == "expiring"
+    now[0] = 20
+    assert table.username(later) is None and len(table) == 0
+    assert table.username("not a token") is None
+
+def test_login_rpc(tmp_path):
+    servicer = ChatServiceServicer(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", require_sessions=True)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    try:
+        for username in ("login_alice", "login_bob", "login_carol"):
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        bob = SessionStub(stub, stub.CheckPassword(chat_pb2.CheckPasswordRequest(username="login_bob", password="p")).session_token)
+        for i in range(3):
+            bob.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+                sender="login_bob", recipient="login_alice", time_sent=str(i), subject=f"s{i}", body="b")))
+
+        assert stub.Login(chat_pb2.LoginRequest(username="login_alice")).status == chat_pb2.Status.ERROR
+        assert stub.Login(chat_pb2.LoginRequest(username="login_alice", password="x")).status == chat_pb2.Status.NO_MATCH
+        assert stub.Login(chat_pb2.LoginRequest(username="login_nobody", password="p")).status == chat_pb2.Status.NO_MATCH
+
+        # One call returns the session, the counts and the first page of messages and of accounts
+        login = stub.Login(chat_pb2.LoginRequest(username="login_alice", password="p", message_limit=2, unread_only=True,
+                                                 users_prefix="login_", users_limit=2))
+        assert login.status == chat_pb2.Status.SUCCESS
+        assert (login.num_total_msgs, login.num_unread_msgs) == (3, 3)
+        assert [message.subject for message in login.messages] == ["s2", "s1"]
+        assert list(login.users) == ["login_alice", "login_bob"] and login.users_next_page_token
+        alice = SessionStub(stub, login.session_token)
+        more = alice.GetMessage(chat_pb2.GetMessageRequest(username="login_alice", limit=2, unread_only=True,
+                                                           page_token=login.messages_next_page_token))
+        assert [message.subject for message in more.messages] == ["s0"]
+        users = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="login_", limit=2, page_token=login.users_next_page_token))
+        assert list(users.users) == ["login_carol"]
+        assert list(stub.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest()).users) == ["login_alice"]
+
+        # A second login while online is turned away without a session
+        again = stub.Login(chat_pb2.LoginRequest(username="login_alice", password="p"))
+        assert again.status == chat_pb2.Status.MATCH and not again.session_token
+        assert alice.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="login_alice")).status == chat_pb2.Status.SUCCESS
+        login = stub.Login(chat_pb2.LoginRequest(username="login_alice", password="p"))
+        assert login.status == chat_pb2.Status.SUCCESS and not login.messages and not login.users
+    finally:
+        channel.close()
+        server.stop(0)
+        servicer.close()
+
+def test_presence(tmp_path):
+    # Leases run out unless renewed or held by a stream
+    now = [0.0]
+    presence = Presence(lease=10, bucket=5, clock=lambda: now[0])
+    for username in ("idle", "renewed", "streaming"):
+        presence.renew(username)
+    presence.stream_opened("streaming")
+    now[0] = 8
+    presence.renew("renewed")
+    now[0] = 10
+    assert presence.expired() == ["idle"]
+    now[0] = 12
+    presence.stream_closed("streaming")
+    now[0] = 20
+    assert presence.expired() == ["renewed"]
+    now[0] = 25
+    assert presence.expired() == ["streaming"] and not presence.leases
+
+    # WatchPresence is only served on grpc.aio
+    server = AioServer()
+    server.start(tmp_path / "passwords.db", tmp_path / "messages.db", durability="async", presence_lease=0.3)
+    channel = grpc.insecure_channel(server.address)
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    try:
+        for username in ("presence_alice", "presence_bob", "presence_carol"):
+            stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        for username in ("presence_alice", "presence_bob"):
+            assert stub.Login(chat_pb2.LoginRequest(username=username, password="p")).status == chat_pb2.Status.SUCCESS
+        assert stub.Heartbeat(chat_pb2.HeartbeatRequest(username="presence_alice")).lease_seconds == 0.3
+        assert stub.Heartbeat(chat_pb2.HeartbeatRequest(username="presence_carol")).status == chat_pb2.Status.NO_MATCH
+        # Bob's open stream keeps him online
+        subscription = stub.SubscribeMessages(chat_pb2.SubscribeMessagesRequest(username="presence_bob"))
+        stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(
+            sender="presence_alice", recipient="presence_bob", time_sent="1", subject="s", body="b")))
+        assert next(subscription).body == "b"
+
+        # A snapshot, then who joins and leaves
+        watch = stub.WatchPresence(chat_pb2.WatchPresenceRequest())
+        snapshot = next(watch)
+        assert snapshot.snapshot and list(snapshot.joined) == ["presence_alice", "presence_bob"]
+        stub.Login(chat_pb2.LoginRequest(username="presence_carol", password="p"))
+        assert list(next(watch).joined) == ["presence_carol"]
+        stub.ConfirmLogout(chat_pb2.ConfirmLogoutRequest(username="presence_carol"))
+        assert list(next(watch).left) == ["presence_carol"]
+
+        # Alice neither heartbeats nor streams, so the reaper logs her out
+        assert list(next(watch).left) == ["presence_alice"]
+        assert stub.Heartbeat(chat_pb2.HeartbeatRequest(username="presence_alice")).status == chat_pb2.Status.NO_MATCH
+        assert list(stub.GetOnlineUsers(chat_pb2.GetOnlineUsersRequest()).users) == ["presence_bob"]
+        watch.cancel()
+        subscription.cancel()
+    finally:
+        channel.close()
+        server.stop()
+
+def test_migrations(tmp_path):
+    passwords_path, messages_path = tmp_path / "passwords.db", tmp_path / "messages.db"
+
+    # Databases created before the schema was versioned
+    for path, schema in ((passwords_path, PASSWORD_DATABASE_SCHEMA), (messages_path, MESSAGES_DATABASE_SCHEMA)):
+        connection = sqlite3.connect(path)
+        connection.execute(f"CREATE TABLE {schema}")
+        connection.commit()
+        connection.close()
+    connection = sqlite3.connect(messages_path)
+    connection.execute("INSERT INTO Messages (Sender, Recipient, Time_sent, Subject, Body) VALUES ('a', 'b', 'now', 's', 'b')")
+    connection.commit()
+    connection.close()
+    assert check_query_plans(passwords_path, messages_path) != []
+
+    # Upgrading in place keeps the data and indexes every hot query
+    assert migrate(passwords_path, PASSWORDS_MIGRATIONS) == len(PASSWORDS_MIGRATIONS)
+    assert migrate(messages_path, MESSAGES_MIGRATIONS) == len(MESSAGES_MIGRATIONS)
+    assert check_query_plans(passwords_path, messages_path) == []
+    connection = sqlite3.connect(messages_path)
+    assert connection.execute("SELECT COUNT(*) FROM Messages").fetchone()[0] == 1
+    assert connection.execute("SELECT Total, Unread FROM InboxCounts WHERE Username = 'b'").fetchone() == (1, 1)
+    connection.close()
+
+    # Migrating an up to date database is a no-op
+    assert migrate(messages_path, MESSAGES_MIGRATIONS) == len(MESSAGES_MIGRATIONS)
+
+def test_search_users():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    usernames = [f"searched{i:02d}" for i in range(12)]
+    for username in usernames + ["searcher"]:
+        response = stub.CreateUser(chat_pb2.CreateUserRequest(username=username, password="p"))
+        assert response.status == chat_pb2.Status.SUCCESS
+
+    # Pages of 5 follow each other in order until the prefix runs out
+    found, page_token = [], ""
+    while True:
+        response = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="searched", limit=5, page_token=page_token))
+        assert response.status == chat_pb2.Status.SUCCESS
+        assert len(response.users) <= 5
+        found += response.users
+        page_token = response.next_page_token
+        if not page_token:
+            break
+    assert found == usernames
+
+    response = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="searche", limit=100))
+    assert list(response.users) == usernames + ["searcher"] and not response.next_page_token
+    response = stub.DeleteUser(chat_pb2.DeleteUserRequest(username="searched00"))
+    response = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="searched", limit=1))
+    assert list(response.users) == ["searched01"]
+    response = stub.GetUsers(chat_pb2.GetUsersRequest(prefix="searched", limit=1, page_token="!"))
+    assert response.status == chat_pb2.Status.ERROR
+
+    # Without a limit, GetUsers still matches LIKE patterns
+    response = stub.GetUsers(chat_pb2.GetUsersRequest(query="SEARCHED1%"))
+    assert list(response.users) == usernames[10:]
+    channel.close()
+
+def test_server_stats():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+
+    def stats():
+        response = stub.GetServerStats(chat_pb2.GetServerStatsRequest())
+        assert response.status == chat_pb2.Status.SUCCESS and response.uptime_seconds > 0
+        return {method.method: method for method in response.methods}
+
+    before = stats()
+    stub.CreateUser(chat_pb2.CreateUserRequest(username="measured", password="p"))
+    message = chat_pb2.MessageObject(sender="measured", recipient="measured", time_sent="now", subject="s", body="x" * 1000)
+    for _ in range(5):
+        stub.SendMessage(chat_pb2.SendMessageRequest(message=message))
+    stub.SendMessage(chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(recipient="nobody")))
+    stub.GetMessage(chat_pb2.GetMessageRequest(limit=5, username="measured"))
+    after = stats()
+
+    send = after["SendMessage"]
+    sent_before = before["SendMessage"].calls if "SendMessage" in before else 0
+    assert send.calls - sent_before == 6
+    assert send.statuses["SUCCESS"] >= 5 and send.statuses["NO_MATCH"] >= 1
+    assert send.request_bytes >= 5000
+    assert 0 < send.p50_ms <= send.p95_ms <= send.p99_ms
+    # Waiting for the commit is SQLite time, and it cannot exceed the whole call
+    assert 0 < send.sqlite_total_ms <= send.total_ms
+    assert after["GetMessage"].response_bytes >= 5000 and after["GetMessage"].sqlite_total_ms > 0
+    channel.close()
+
+def test_profiling():
+    channel = grpc.insecure_channel(f"127.0.0.1:2620")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+    response = stub.StartProfiling(chat_pb2.StartProfilingRequest(method="NoSuchMethod", calls=3))
+    assert response.status == chat_pb2.Status.ERROR
+
+    response = stub.StartProfiling(chat_pb2.StartProfilingRequest(method="GetMessage", calls=3))
+    assert response.status == chat_pb2.Status.SUCCESS
+    path = Path(response.output_path)
+    assert stub.StartProfiling(chat_pb2.StartProfilingRequest(method="GetMessage", calls=3)).status == chat_pb2.Status.MATCH
+    for _ in range(3):
+        stub.GetCounts(chat_pb2.GetCountsRequest(username="profiled"))
+        assert not path.exists()
+        stub.GetMessage(chat_pb2.GetMessageRequest(limit=5, username="profiled"))
+
+    # The profile is a standard pstats file, covering the handler and the SQLite calls under it
+    stats = pstats.Stats(str(path))
+    functions = {function for _, _, function in stats.stats}
+    assert "GetMessage" in functions and "GetCounts" not in functions
+    assert any("execute" in function for function in functions)
+    path.unlink()
+    channel.close()
 
+    # Only calls from the server's own machine may start it
+    peer = lambda address: type("Context", (), {"peer": lambda self: address})()
+    assert is_local(peer("ipv4:127.0.0.1:50123")) and is_local(peer("ipv6:[::1]:50123"))
+    assert not is_local(peer("ipv4:10.1.2.3:50123")) and not is_local(peer("ipv6:[2001:db8::1]:50123"))
 
+def test_user_directory(tmp_path):
+    passwords_path, snapshot = tmp_path / "passwords.db", tmp_path / "passwords.users"
 
+    def create_user(pool, directory, username):
+        def insert(db):
+            db.execute("INSERT INTO Passwords (Username, Password) VALUES (?, 'p')", (username,))
+            directory.add(db, username)
+        pool.write(insert)
 
+    # Past the threshold of 3 users the exact set becomes a Bloom filter
+    for bloom_threshold in (100, 3):
+        passwords_path.unlink(missing_ok=True)
+        snapshot.unlink(missing_ok=True)
+        pool = ConnectionPool(passwords_path, PASSWORDS_MIGRATIONS)
+        directory = UserDirectory(pool, snapshot, bloom_threshold)
+        assert not directory.loaded_from_snapshot
+        for i in range(5):
+            create_user(pool, directory, f"user{i}")
+        assert (directory.bloom is not None) == (bloom_threshold == 3)
+        assert all(directory.contains(f"user{i}") for i in range(5))
+        assert not directory.contains("user5")
+        assert directory.existing(["user0", "user5", "user4"]) == {"user0", "user4"}
+        assert directory.search("user", "user1", 2) == ["user2", "user3"]
+        assert directory.search("user4", "", 10) == ["user4"]
 
+        # A clean shutdown leaves a snapshot that the next start trusts
+        directory.save()
+        pool.close()
+        pool = ConnectionPool(passwords_path, PASSWORDS_MIGRATIONS)
+        directory = UserDirectory(pool, snapshot, bloom_threshold)
+        assert directory.loaded_from_snapshot
+        assert directory.contains("user4") and not directory.contains("user5")
+        pool.close()
 
+        # A change the snapshot did not see makes the next start rebuild from the table
+        connection = sqlite3.connect(passwords_path)
+        connection.execute("DELETE FROM Passwords WHERE Username = 'user4'")
+        connection.commit()
+        connection.close()
+        pool = ConnectionPool(passwords_path, PASSWORDS_MIGRATIONS)
+        directory = UserDirectory(pool, snapshot, bloom_threshold)
+        assert not directory.loaded_from_snapshot
+        assert directory.contains("user3") and not directory.contains("user4")
+        pool.close()
 
+def test_request_logging():
+    request = chat_pb2.SendMessageRequest(message=chat_pb2.MessageObject(sender="a", recipient="b", subject="hi", body="secret text"))
+    summary = str(RequestSummary(request))
+    assert "secret text" not in summary and "<11 chars>" in summary and 'subject: "hi"' in summary
+    # The request itself is left untouched
+    assert request.message.body == "secret text"
+    summary = str(RequestSummary(chat_pb2.CheckPasswordRequest(username="a", password="hunter2")))
+    assert "hunter2" not in summary
 
+    sampler = SamplingFilter({"GetMessage"}, 10)
+    def record(rpc):
+        record = logging.LogRecord("chat", logging.INFO, __file__, 0, "", (), None)
+        record.rpc = rpc
+        return record
+    assert sum(sampler.filter(record("GetMessage")) for _ in range(100)) == 10
+    assert all(sampler.filter(record("DeleteUser")) for _ in range(10))
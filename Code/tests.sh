@@ -1,26 +1,31 @@
 # May need to run chmod +x tests.sh
 # Exit immediately if a command fails
-set -e  
+set -e
 
 # Clear the databases by deleting them
-rm -f User_Data/messages.db
-rm -f User_Data/passwords.db
-touch User_Data/messages.db
-touch User_Data/passwords.db
+reset_databases() {
+    rm -f User_Data/messages.db
+    rm -f User_Data/passwords.db
+    rm -f User_Data/*.db-wal User_Data/*.db-shm User_Data/*.users
+    touch User_Data/messages.db
+    touch User_Data/passwords.db
+}
 
-# Start the GRPC server in the background
-python GRPCServer.py 127.0.0.1 2620 &
-SERVER_PID=$!
-sleep 2
+# Start the given GRPC server in the background, run pytest on tests.py against it, then stop it
+run_tests() {
+    reset_databases
+    python $1 127.0.0.1 2620 &
+    SERVER_PID=$!
+    sleep 2
+    # Stop the server even when tests fail, then report the failure
+    status=0
+    pytest tests.py || status=$?
+    kill $SERVER_PID
+    wait $SERVER_PID || true
+    return $status
+}
 
-# Run pytest on tests.py
-pytest tests.py
+run_tests GRPCServer.py
+run_tests GRPCAioServer.py
 
-# After tests finish, stop the GRPC server
-kill $SERVER_PID
-
-# Clear the databases by deleting them
-rm -f User_Data/messages.db
-rm -f User_Data/passwords.db
-touch User_Data/messages.db
-touch User_Data/passwords.db
\ No newline at end of file
+reset_databases